@@ -2,6 +2,7 @@
 from numba import njit
 import numpy as np
 from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import LinearOperator
 
 def vertices(voxel, length = 1.0):
     return _vertices(voxel) * length
@@ -20,6 +21,98 @@ def mass_matrix(voxel, density, length):
     )
     return coo_matrix((values, (rows, cols)), shape=(m, n))
 
+def stiff_operator(voxel, youngs, possion, length):
+    return StencilOperator(voxel, _stiff_element_matrix(youngs,possion,length))
+
+def mass_operator(voxel, density, length):
+    return StencilOperator(voxel, _mass_element_matrix(density,length))
+
+class StencilOperator(LinearOperator):
+    '''
+    Matrix-free K or M of a voxel model. Every voxel shares the same 24x24
+    element matrix, so a product gathers the 8 corner displacements of each
+    voxel, multiplies them by the element matrix in one GEMM and scatters the
+    forces back. Only the (hex_num, 8) corner indices are stored, the vertex
+    numbering matches _assemble_matrix.
+    '''
+    def __init__(self, voxel, element_matrix, chunk_size = 32768):
+        self.corners, vertex_num = _hex_corners(np.asarray(voxel))
+        self.element_matrix = element_matrix
+        self.chunk_size = chunk_size
+        super().__init__(np.float64, (3*vertex_num, 3*vertex_num))
+
+    def _matmat(self, X):
+        X = np.asarray(X, dtype = np.float64).reshape(self.shape[0], -1)
+        b = X.shape[1]
+        X = X.reshape(-1, 3, b)
+        Y = np.zeros_like(X)
+        for start in range(0, len(self.corners), self.chunk_size):
+            corners = self.corners[start:start + self.chunk_size]
+            # (24, hex * b) corner displacements -> element forces
+            x = X[corners].reshape(len(corners), 24, b).transpose(1, 0, 2)
+            y = self.element_matrix @ x.reshape(24, -1)
+            _scatter_add(corners, y.reshape(24, len(corners), b), Y)
+        return Y.reshape(self.shape[0], b)
+
+    def _matvec(self, x):
+        return self._matmat(x.reshape(-1, 1)).reshape(x.shape)
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        d = np.zeros((self.shape[0] // 3, 3))
+        element_diagonal = self.element_matrix.diagonal().reshape(8, 3)
+        for c in range(8):
+            np.add.at(d, self.corners[:, c], element_diagonal[c])
+        return d.reshape(-1)
+
+@njit()
+def _scatter_add(corners, y, Y):
+    for h in range(corners.shape[0]):
+        for c in range(8):
+            v = corners[h, c]
+            for i in range(3):
+                for j in range(Y.shape[2]):
+                    Y[v, i, j] += y[c*3 + i, h, j]
+
+@njit()
+def _hex_corners(voxel):
+    res = voxel.shape[-1]
+    vertex = -np.ones((res+1,res+1,res+1), dtype = np.int64)
+    coordinates = np.array([
+        [0,0,0],[1,0,0],
+        [1,1,0],[0,1,0],
+        [0,0,1],[1,0,1],
+        [1,1,1],[0,1,1]
+    ])
+    hex_num = 0
+    for i in range(res):
+        for j in range(res):
+            for k in range(res):
+                if voxel[i,j,k] == 1:
+                    for c in coordinates:
+                        vertex[i+c[0],j+c[1],k+c[2]] = 0
+                    hex_num += 1
+    vertex_num = 0
+    for i in range(res+1):
+        for j in range(res+1):
+            for k in range(res+1):
+                if vertex[i,j,k] == 0:
+                    vertex[i,j,k] = vertex_num
+                    vertex_num += 1
+    corners = np.zeros((hex_num, 8), dtype = np.int64)
+    hex_num = 0
+    for i in range(res):
+        for j in range(res):
+            for k in range(res):
+                if voxel[i,j,k] == 1:
+                    for c_idx in range(8):
+                        c = coordinates[c_idx]
+                        corners[hex_num, c_idx] = vertex[i+c[0],j+c[1],k+c[2]]
+                    hex_num += 1
+    return corners, vertex_num
+
 @njit(parallel=True)
 def _vertices(voxel):
     voxel = voxel.copy()
@@ -75,6 +75,16 @@ class Hexahedron_model(object):
             self.stiff_matrix_ = assembler.stiff_matrix(self.voxel, self.youngs, self.poison, self.length / self.res)
         return self.stiff_matrix_
 
+    @property
+    def mass_operator(self):
+        from . import assembler
+        return assembler.mass_operator(self.voxel, self.density, self.length / self.res)
+
+    @property
+    def stiff_operator(self):
+        from . import assembler
+        return assembler.stiff_operator(self.voxel, self.youngs, self.poison, self.length / self.res)
+
     @property
     def _element_mass_matrix(self):
         from . import assembler
@@ -100,8 +110,11 @@ class Hexahedron_model(object):
             for v in vertices:
                 f.write('v {} {} {}\n'.format(*v))
 
-    def modal_analysis(self, solver):
-        self.vals, self.vecs = solver(self.stiff_matrix, self.mass_matrix)
+    def modal_analysis(self, solver, matrix_free = False):
+        if matrix_free:
+            self.vals, self.vecs = solver(self.stiff_operator, self.mass_operator)
+        else:
+            self.vals, self.vecs = solver(self.stiff_matrix, self.mass_matrix)
 
     @property
     def damps(self):
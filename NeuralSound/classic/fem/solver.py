@@ -1,17 +1,47 @@
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
 
+def _shift(stiff_matrix, mass_matrix, rate = 1e-3):
+    # below the rigid modes at 0, so K - sigma M is positive definite
+    return -rate * (stiff_matrix.diagonal() / mass_matrix.diagonal()).min()
+
+def _shifted_inverse(stiff_matrix, mass_matrix, sigma, tol = 1e-10):
+    # (K - sigma M)^-1 by Jacobi preconditioned CG, for matrix-free K and M
+    from scipy.sparse.linalg import cg
+    A = LinearOperator(stiff_matrix.shape, matvec = lambda x: stiff_matrix @ x - sigma * (mass_matrix @ x), dtype = np.float64)
+    d = stiff_matrix.diagonal() - sigma * mass_matrix.diagonal()
+    P = LinearOperator(stiff_matrix.shape, matvec = lambda x: x.reshape(-1) / d, dtype = np.float64)
+    return LinearOperator(stiff_matrix.shape, matvec = lambda x: cg(A, x, rtol = tol, M = P)[0], dtype = np.float64)
 
 def Lanczos_Solver(k = 30, **kw):
     from scipy.sparse.linalg import eigsh
     def solver(stiff_matrix, mass_matrix):
-        sigma = 0
-        return eigsh(A = stiff_matrix, **kw, M = mass_matrix, which='LM', sigma = sigma, k=k)
+        sigma, options = 0, dict(kw)
+        if isinstance(stiff_matrix, LinearOperator):
+            sigma = _shift(stiff_matrix, mass_matrix)
+            options['OPinv'] = _shifted_inverse(stiff_matrix, mass_matrix, sigma)
+        return eigsh(A = stiff_matrix, **options, M = mass_matrix, which='LM', sigma = sigma, k=k)
     return solver
 
-def LOBPCG_solver(k = 20):
+def LOBPCG_solver(k = 20, tol = 1e-6, maxiter = 500):
     k = k + 6
     from torch import lobpcg
     from .util import scipy2torch
     def solver(stiff_matrix, mass_matrix):
+        if isinstance(stiff_matrix, LinearOperator):
+            # matrix-free operators, scipy LOBPCG with a Jacobi preconditioner
+            # on K and M scaled to unit diagonals, as its tolerance is absolute
+            from scipy.sparse.linalg import lobpcg as scipy_lobpcg
+            k_diag, m_diag = stiff_matrix.diagonal(), mass_matrix.diagonal()
+            k_scale, m_scale = k_diag.max(), m_diag.max()
+            A, B = stiff_matrix * (1 / k_scale), mass_matrix * (1 / m_scale)
+            d = (k_diag - _shift(stiff_matrix, mass_matrix) * m_diag) / k_scale
+            P = LinearOperator(A.shape, matvec = lambda x: x.reshape(-1) / d, matmat = lambda X: X / d[:, None], dtype = np.float64)
+            X = np.random.default_rng(0).random((A.shape[0], k))
+            vals, vecs = scipy_lobpcg(A, X, B = B, M = P, tol = tol, maxiter = maxiter, largest = False)
+            order = np.argsort(vals)
+            vals, vecs = vals[order] * k_scale / m_scale, vecs[:, order] / m_scale**0.5
+            return vals[6:], vecs[:, 6:]
         def tracker(e):
             print(e.R)
             print(e.ivars['istep'])
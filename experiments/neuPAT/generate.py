@@ -20,6 +20,7 @@ import configparser
 import meshio
 import torch
 from src.ffat_solve import monte_carlo_solve, bem_solve
+from src.scene import Scene, RigidBody, quaternion_to_matrix
 
 data_dir = "dataset/NeuPAT/bowl"
 
@@ -116,6 +117,13 @@ gridx, gridy = torch.meshgrid(xs, ys)
 
 check_correct = True
 
+# the bowl and the static objects are sampled once, only the blocks between
+# them are rebuilt for every pose
+scene = Scene(
+    [RigidBody(vertices_vib, triangles_vib), RigidBody(vertices_static, triangles_static)],
+    6000,
+)
+
 
 def calculate_ffat_map():
     r_min = 1.5
@@ -138,17 +146,15 @@ def calculate_ffat_map():
             trg_points = rotate_points(trg_points, src_rot)
             trg_points = trg_points + displacement
             break
-    vertices = torch.cat([vertices_vib_updated, vertices_static], dim=0).cuda()
-    triangles = torch.cat(
-        [triangles_vib, triangles_static + len(vertices_vib)], dim=0
-    ).cuda()
+    scene.set_pose(0, quaternion_to_matrix(src_rot), displacement)
 
     while True:
         ffat_map, convergence = monte_carlo_solve(
-            vertices, triangles, neumann_tri, ks, trg_points, 6000, plot=False
+            None, None, neumann_tri, ks, trg_points, 6000, plot=False, sampler=scene
         )
         if convergence:
             break
+        scene.resample()
     ffat_map = torch.from_numpy(np.abs(ffat_map))
     if check_correct:
         vertices = torch.cat([vertices_vib_updated, vertices_bem], dim=0).cuda()
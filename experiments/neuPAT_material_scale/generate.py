@@ -18,6 +18,7 @@ from src.cuda_imp import (
 )
 import matplotlib.pyplot as plt
 from src.ffat_solve import monte_carlo_solve, bem_solve
+from src.sample_cache import SampleCache
 from src.visualize import plot_point_cloud, plot_mesh, CombinedFig
 from src.solver import BiCGSTAB_batch
 import numpy as np
@@ -63,8 +64,23 @@ print("trg_sample_num:", trg_sample_num)
 print("src_sample_num:", src_sample_num)
 
 
+# only the size changes between samples, so one Poisson-disk set is rescaled
+sample_cache = SampleCache(f"{data_dir}/sample_cache")
+
+
 def monte_carlo_process(vertices, ks, trg_points):
-    return monte_carlo_solve(vertices, triangles, neumann_tri, ks, trg_points, 5000)
+    ffat_map, convergence = monte_carlo_solve(
+        vertices,
+        triangles,
+        neumann_tri,
+        ks,
+        trg_points,
+        5000,
+        sample_cache=sample_cache,
+    )
+    if not convergence:
+        sample_cache.discard(vertices, triangles, 5000)
+    return ffat_map, convergence
 
 
 def bem_process(vertices, ks, trg_points):
@@ -4,6 +4,7 @@ sys.path.append("./")
 
 import torch
 from src.cuda_imp import ImportanceSampler, MonteCarloWeight
+from src.mc_operator import evaluate_potential
 from src.timer import Timer
 from src.modalsound.model import (
     solve_points_dirichlet,
@@ -66,15 +67,9 @@ solver = BiCGSTAB_batch(
 dirichlet, convergence = solver.solve(b_batch, tol=1e-6, nsteps=2000)
 dirichlet = dirichlet.permute(2, 0, 1)
 
-ffat_map = torch.zeros(256, 1, 256, 1, dtype=torch.complex64).cuda()
-points = points.reshape(256, 256, 3)
-for i in range(256):
-    points_batch = points[i]
-    G0_constructor = MonteCarloWeight(points_batch, sampler)
-    G1_constructor = MonteCarloWeight(points_batch, sampler, deriv=True)
-    G0 = G0_constructor.get_weights_potential_ks(ks)
-    G1 = G1_constructor.get_weights_potential_ks(ks)
-    ffat_map[i] = G1 @ dirichlet - G0 @ neumann
+ffat_map = evaluate_potential(
+    points.reshape(-1, 3), sampler, ks, dirichlet.squeeze(-1), neumann.squeeze(-1)
+).reshape(256, 1, 256, 1)
 
 
 np.save(f"{data_dir}/helmholtz_ours.npy", ffat_map.cpu().numpy())
@@ -0,0 +1,51 @@
+import sys
+
+sys.path.append("./")
+
+import torch
+import numpy as np
+import meshio
+from src.cuda_imp import default_device
+from src.ffat_solve import monte_carlo_solve, get_sampler, bem_solve
+from src.mc_operator import precision_report
+from src.modalsound.model import get_spherical_surface_points, SNR
+
+# Accuracy of the reduced-precision boundary weights: the relative matvec
+# error against the complex64 weights, and the error of the Monte Carlo FFAT
+# maps against the bempp solution, which should be dominated by the Monte
+# Carlo noise for every precision.
+
+device = default_device()
+mesh = meshio.read("scripts/bunny_subdiv_1.obj")
+vertices = mesh.points - (mesh.points.max(0) + mesh.points.min(0)) / 2
+vertices = vertices / np.abs(vertices).max() * 0.1
+vertices = torch.tensor(vertices, dtype=torch.float32, device=device)
+triangles = torch.tensor(mesh.cells_dict["triangle"], dtype=torch.int32, device=device)
+ks = torch.tensor([5.0, 10.0, 20.0, 40.0], device=device)
+neumann_tri = torch.ones(len(ks), len(triangles), dtype=torch.complex64, device=device)
+trg_points = get_spherical_surface_points(vertices, 2).to(device)
+
+ffat_map_bem = bem_solve(vertices, triangles, neumann_tri, ks, trg_points)
+
+precisions = ["complex64", "bfloat16", "float16", "int8"]
+for n in [1000, 4000]:
+    sampler, _ = get_sampler(vertices, triangles, n)
+    report = precision_report(sampler, ks, precisions[1:])
+    for precision in precisions:
+        ffat_map, _ = monte_carlo_solve(
+            vertices,
+            triangles,
+            neumann_tri,
+            ks,
+            trg_points,
+            n,
+            check_converge=False,
+            sampler=sampler,
+            method="dense",
+            operator_precision=precision,
+        )
+        line = f"n={n} {precision}: SNR {SNR(ffat_map_bem, ffat_map):.2f}"
+        if precision in report:
+            r = report[precision]
+            line += f", G0 {r['G0']:.1e}, G1 {r['G1']:.1e}, bytes x{r['bytes']:.2f}"
+        print(line)
@@ -0,0 +1,77 @@
+import sys
+
+sys.path.append("./")
+
+import torch
+import numpy as np
+import meshio
+from src.cuda_imp import ImportanceSampler, default_device
+from src.ffat_solve import monte_carlo_solve, get_sampler, bem_solve
+from src.importance import adaptive_importance, quantize_importance
+from src.modalsound.model import get_spherical_surface_points, SNR
+
+# Error of the Monte Carlo FFAT maps against the bempp solution for i.i.d.,
+# Sobol and stratified samples of increasing count, and for the Poisson-disk
+# samples of get_sampler drawn from the same sequences. The "local" case only
+# vibrates half of the mesh and samples with the non-uniform adaptive
+# importance, so the sequence goes through the per-level importance samplers.
+
+device = default_device()
+mesh = meshio.read("scripts/bunny_subdiv_1.obj")
+vertices = mesh.points - (mesh.points.max(0) + mesh.points.min(0)) / 2
+vertices = vertices / np.abs(vertices).max() * 0.1
+vertices = torch.tensor(vertices, dtype=torch.float32, device=device)
+triangles = torch.tensor(mesh.cells_dict["triangle"], dtype=torch.int32, device=device)
+ks = torch.tensor([5.0, 10.0, 20.0, 40.0], device=device)
+trg_points = get_spherical_surface_points(vertices, 2).to(device)
+centroids = vertices[triangles.long()].mean(1)
+cases = {
+    "uniform": torch.ones(len(triangles), device=device),
+    "local": (centroids[:, 0] > 0).float(),
+}
+
+sample_nums = [500, 1000, 2000, 4000, 8000]
+repeats = 4
+for case, vibration in cases.items():
+    neumann_tri = vibration.repeat(len(ks), 1).to(torch.complex64)
+    ffat_map_bem = bem_solve(vertices, triangles, neumann_tri, ks, trg_points)
+    importance, weights = None, torch.ones(len(triangles), device=device)
+    if case != "uniform":
+        importance = quantize_importance(
+            adaptive_importance(vertices, triangles, neumann_tri, ks)
+        ).contiguous()
+        weights = importance
+    for sequence in ["random", "sobol", "stratified"]:
+        for poisson in [False, True]:
+            SNRs = []
+            for n in sample_nums:
+                snr = []
+                for seed in range(repeats):
+                    if poisson:
+                        sampler, _ = get_sampler(
+                            vertices, triangles, n, None, importance, sequence
+                        )
+                    else:
+                        sampler = ImportanceSampler(
+                            vertices,
+                            triangles,
+                            weights,
+                            n,
+                            seed=seed,
+                            sequence=sequence,
+                        )
+                        sampler.update()
+                    ffat_map, _ = monte_carlo_solve(
+                        vertices,
+                        triangles,
+                        neumann_tri,
+                        ks,
+                        trg_points,
+                        n,
+                        check_converge=False,
+                        sampler=sampler,
+                    )
+                    snr.append(SNR(ffat_map_bem, ffat_map))
+                SNRs.append(np.mean(snr))
+            name = f"{case} {sequence}" + (" poisson" if poisson else "")
+            print(name, " ".join(f"{n}: {s:.2f}" for n, s in zip(sample_nums, SNRs)))
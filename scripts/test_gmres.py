@@ -0,0 +1,41 @@
+import sys
+
+sys.path.append("./")
+
+import torch
+from src.solver import GMRES_batch
+
+# GMRES and FGMRES on random diagonally dominant complex systems, without a
+# preconditioner and with a Jacobi preconditioner on either side.
+
+torch.manual_seed(0)
+n, batch_size = 200, 4
+A = torch.randn(batch_size, n, n, dtype=torch.complex64) / n**0.5
+A = A + torch.diag_embed(torch.rand(batch_size, n) + 2).to(A.dtype)
+b = torch.randn(n, 1, batch_size, dtype=torch.complex64)
+inv_diag = 1 / torch.diagonal(A, dim1=1, dim2=2).T.unsqueeze(1)
+
+
+def Ax_gen(x):
+    return torch.bmm(A, x.permute(2, 0, 1)).permute(1, 2, 0)
+
+
+def jacobi(x):
+    return inv_diag * x
+
+
+for flexible in [False, True]:
+    for precond, side in [(None, "right"), (jacobi, "right"), (jacobi, "left")]:
+        solver = GMRES_batch(
+            Ax_gen,
+            device="cpu",
+            restart=20,
+            precond=precond,
+            flexible=flexible,
+            precond_side=side,
+        )
+        x, converged = solver.solve(b, tol=1e-10, nsteps=200)
+        rerr = ((Ax_gen(x) - b).norm() / b.norm()).item()
+        name = "fgmres" if flexible else "gmres"
+        print(f"{name} precond={precond is not None} {side}: rerr {rerr:.1e}")
+        assert converged and rerr < 1e-4
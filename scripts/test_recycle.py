@@ -0,0 +1,56 @@
+import sys
+
+sys.path.append("./")
+
+import torch
+import numpy as np
+import meshio
+from src.cuda_imp import default_device
+from src.ffat_solve import monte_carlo_solve, get_sampler
+from src.solver import RecycleSpace
+from src.modalsound.model import get_spherical_surface_points, SNR
+
+# A wavenumber sweep split over two monte_carlo_solve calls that share one
+# RecycleSpace, with warm starts (bicgstab) and recycled deflation subspaces
+# (gcrodr), against the same sweep solved from scratch.
+
+device = default_device()
+mesh = meshio.read("scripts/bunny_subdiv_1.obj")
+vertices = mesh.points - (mesh.points.max(0) + mesh.points.min(0)) / 2
+vertices = vertices / np.abs(vertices).max() * 0.1
+vertices = torch.tensor(vertices, dtype=torch.float32, device=device)
+triangles = torch.tensor(mesh.cells_dict["triangle"], dtype=torch.int32, device=device)
+ks = torch.linspace(5, 30, 16, device=device)
+neumann_tri = torch.ones(len(ks), len(triangles), dtype=torch.complex64, device=device)
+trg_points = get_spherical_surface_points(vertices, 2).to(device)
+sampler, _ = get_sampler(vertices, triangles, 2000)
+
+
+def solve(ks, neumann_tri, krylov, recycle=False):
+    return monte_carlo_solve(
+        vertices,
+        triangles,
+        neumann_tri,
+        ks,
+        trg_points,
+        2000,
+        batch_step=4,
+        krylov=krylov,
+        recycle=recycle,
+        sampler=sampler,
+    )
+
+
+for krylov in ["bicgstab", "gcrodr"]:
+    ffat_map_ref, convergence = solve(ks, neumann_tri, krylov)
+    assert convergence
+    space = RecycleSpace()
+    maps = []
+    for half in [slice(0, 8), slice(8, 16)]:
+        ffat_map, convergence = solve(ks[half], neumann_tri[half], krylov, space)
+        assert convergence
+        maps.append(ffat_map)
+    assert len(space) == len(ks)
+    snr = SNR(ffat_map_ref, np.concatenate(maps))
+    print(f"{krylov}: SNR of the recycled sweep {snr:.2f}")
+    assert snr > 40
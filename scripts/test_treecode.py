@@ -0,0 +1,53 @@
+import sys
+
+sys.path.append("./")
+
+import torch
+import numpy as np
+import meshio
+from src.cuda_imp import default_device
+from src.ffat_solve import get_sampler
+from src.mc_operator import DenseOperator
+from src.treecode import TreecodeOperator
+from src.timer import Timer
+
+# Treecode boundary operator against the dense weights: the matvec error
+# stays below the tolerance, the far-field proxies are used, and the number
+# of kernel evaluations grows sub-quadratically with the sample count.
+
+device = default_device()
+mesh = meshio.read("scripts/bunny_subdiv_1.obj")
+vertices = mesh.points - (mesh.points.max(0) + mesh.points.min(0)) / 2
+vertices = vertices / np.abs(vertices).max() * 0.1
+vertices = torch.tensor(vertices, dtype=torch.float32, device=device)
+triangles = torch.tensor(mesh.cells_dict["triangle"], dtype=torch.int32, device=device)
+ks = torch.tensor([5.0, 10.0, 20.0, 30.0], device=device)
+tol = 1e-4
+
+evaluations = []
+for n in [4000, 8000, 16000]:
+    sampler, _ = get_sampler(vertices, triangles, n)
+    N = int(sampler.num_samples)
+    x = torch.randn(len(ks), N, 1, dtype=torch.complex64, device=device)
+    for deriv in [False, True]:
+        op = TreecodeOperator(sampler.points, sampler, ks, deriv, True, tol)
+        timer = Timer()
+        y = op.matvec(x)
+        line = f"N={N} deriv={deriv}: treecode {timer.get_time():.2f}s"
+        count = op.evaluations["far"] + op.evaluations["near"]
+        line += f", evaluations / N^2 {count / N**2:.3f}"
+        line += f", far {op.evaluations['far'] / count:.2f}"
+        if n <= 8000:
+            y_dense = DenseOperator.boundary(sampler, ks, deriv).matvec(x)
+            error = ((y - y_dense).norm() / y_dense.norm()).item()
+            line += f", error {error:.1e}"
+            assert error < tol
+        print(line)
+        if not deriv:
+            evaluations.append((N, count))
+    assert op.evaluations["far"] > 0
+
+(N0, count0), (N1, count1) = evaluations[0], evaluations[-1]
+rate = np.log(count1 / count0) / np.log(N1 / N0)
+print(f"kernel evaluations ~ N^{rate:.2f}")
+assert rate < 1.7
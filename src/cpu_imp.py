@@ -0,0 +1,624 @@
+import numpy as np
+import torch
+import numba
+from numba import njit, prange
+
+# CPU counterparts of the kernels exported by src/cuda/bind.cu. Every function
+# keeps the name and argument order of its pybind binding so that the backend
+# registry in cuda_imp.py can dispatch to either module transparently.
+
+EPS = 1e-3
+
+
+def set_num_threads(n):
+    numba.set_num_threads(n)
+    torch.set_num_threads(n)
+
+
+def get_random_states(n, seed=None):
+    return np.random.default_rng(seed)
+
+
+def get_cdf(vertices, triangles, triangle_importance):
+    triangles = triangles.long()
+    v0 = vertices[triangles[:, 0]]
+    v1 = vertices[triangles[:, 1]]
+    v2 = vertices[triangles[:, 2]]
+    area = torch.linalg.norm(torch.cross(v1 - v0, v2 - v0, dim=1), dim=1) / 2
+    return torch.cumsum(area * triangle_importance, dim=0).float()
+
+
+def importance_sample(
+    vertices,
+    triangles,
+    triangles_importance,
+    triangles_neumann,
+    cdf,
+    num_samples,
+    random_states,
+    points,
+    points_normals,
+    points_importance,
+    points_neumann,
+    points_index,
+):
+    rnd = torch.from_numpy(random_states.random((3, num_samples), dtype=np.float32))
+    importance_sample_uniforms(
+        vertices,
+        triangles,
+        triangles_importance,
+        triangles_neumann,
+        cdf,
+        num_samples,
+        rnd,
+        points,
+        points_normals,
+        points_importance,
+        points_neumann,
+        points_index,
+    )
+
+
+def importance_sample_uniforms(
+    vertices,
+    triangles,
+    triangles_importance,
+    triangles_neumann,
+    cdf,
+    num_samples,
+    rnd,
+    points,
+    points_normals,
+    points_importance,
+    points_neumann,
+    points_index,
+):
+    x = rnd[0] * cdf[-1]
+    element_id = torch.searchsorted(cdf, x).clamp_(max=len(cdf) - 1)
+    e1, e2 = rnd[1], rnd[2]
+    u = (1 - e1.sqrt()).unsqueeze(-1)
+    v = (e2 * e1.sqrt()).unsqueeze(-1)
+    w = 1 - u - v
+    tri = triangles[element_id].long()
+    v0 = vertices[tri[:, 0]]
+    v1 = vertices[tri[:, 1]]
+    v2 = vertices[tri[:, 2]]
+    points.copy_(v0 * u + v1 * v + v2 * w)
+    normals = torch.cross(v1 - v0, v2 - v0, dim=1)
+    points_normals.copy_(normals / torch.linalg.norm(normals, dim=1, keepdim=True))
+    points_importance.copy_(triangles_importance[element_id])
+    points_neumann.copy_(triangles_neumann.reshape(-1, 1)[element_id])
+    points_index.copy_(element_id.int())
+
+
+@njit()
+def length(x, y):
+    d0 = x[0] - y[0]
+    d1 = x[1] - y[1]
+    d2 = x[2] - y[2]
+    return np.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+
+
+@njit()
+def green_func(y, x, xn, k, deriv):
+    r = length(x, y)
+    ikr = 1j * k * r
+    if not deriv:
+        if r < EPS:
+            return np.exp(ikr) / (4 * np.pi)
+        return np.exp(ikr) / (4 * np.pi * r)
+    if r < EPS:
+        return 0j
+    dot = (x[0] - y[0]) * xn[0] + (x[1] - y[1]) * xn[1] + (x[2] - y[2]) * xn[2]
+    return -np.exp(ikr) / (4 * np.pi * r * r * r) * (1 - ikr) * dot
+
+
+@njit()
+def patch_radius(cdf_sum, importance, M):
+    # radius of the equal-area disc of a sample, the disc with the surface
+    # area cdf_sum / (importance M) that the sample stands for
+    return np.sqrt(cdf_sum / (np.pi * importance * M))
+
+
+@njit()
+def self_term(k, radius, deriv):
+    """
+    Twice the integral of the Green's function over a flat disc of the given
+    radius around its center. The double layer kernel vanishes on the disc.
+    """
+    if deriv:
+        return 0j
+    if k * radius < 1e-6:
+        return radius + 0j
+    return (np.exp(1j * k * radius) - 1) / (1j * k)
+
+
+# the phase recurrence is re-seeded with an exact exp every this many steps
+PHASE_RESYNC = 64
+
+
+def uniform_step(ks):
+    """
+    Spacing of ks if they form an increasing uniform grid up to float32
+    rounding, else 0.
+    """
+    ks = np.asarray(ks, dtype=np.float64).reshape(-1)
+    if len(ks) < 3:
+        return 0.0
+    dk = (ks[-1] - ks[0]) / (len(ks) - 1)
+    grid = ks[0] + dk * np.arange(len(ks))
+    tol = 4 * np.finfo(np.float32).eps * np.abs(ks).max()
+    if dk > 0 and np.abs(ks - grid).max() <= tol:
+        return float(dk)
+    return 0.0
+
+
+@njit()
+def green_func_ks(y, x, xn, ks, dk, deriv, out):
+    """
+    green_func for every wavenumber of ks in one pass. The distance and
+    geometric factor are shared, and for ks uniformly spaced by dk > 0,
+    exp(ikr) is advanced by the phase recurrence exp(i dk r) instead of one
+    complex exponential per wavenumber.
+    """
+    r = length(x, y)
+    if deriv:
+        if r < EPS:
+            out[:] = 0
+            return
+        dot = (x[0] - y[0]) * xn[0] + (x[1] - y[1]) * xn[1] + (x[2] - y[2]) * xn[2]
+        scale = -dot / (4 * np.pi * r * r * r)
+    else:
+        scale = 1 / (4 * np.pi * r) if r >= EPS else 1 / (4 * np.pi)
+    step = np.exp(1j * dk * r)
+    phase = 0j
+    for k_i in range(len(ks)):
+        if dk <= 0 or k_i % PHASE_RESYNC == 0:
+            phase = np.exp(1j * ks[k_i] * r)
+        if deriv:
+            out[k_i] = scale * phase * (1 - 1j * ks[k_i] * r)
+        else:
+            out[k_i] = scale * phase
+        phase *= step
+
+
+# a target closer to a sample than this fraction of its patch radius sits on
+# the sample and gets the self term of the patch
+COINCIDENT = 1e-3
+
+
+@njit(parallel=True)
+def _monte_carlo_weight(trgs, srcs, normals, importance, k, cdf_sum, deriv, out):
+    N, M = out.shape[0], out.shape[1]
+    for i in prange(N):
+        near_point_num = 0
+        for j in range(M):
+            radius = patch_radius(cdf_sum, importance[j], M)
+            if length(trgs[i], srcs[j]) < COINCIDENT * radius:
+                near_point_num += 1
+        for j in range(M):
+            radius = patch_radius(cdf_sum, importance[j], M)
+            if length(trgs[i], srcs[j]) < COINCIDENT * radius:
+                weight = self_term(k, radius, deriv) / near_point_num
+            else:
+                weight = green_func(trgs[i], srcs[j], normals[j], k, deriv)
+                weight *= 2 * cdf_sum / importance[j] / M
+            out[i, j, 0] = weight.real
+            out[i, j, 1] = weight.imag
+
+
+@njit(parallel=True)
+def _monte_carlo_weight_boundary(
+    trgs, srcs, normals, importance, ks, dk, cdf_sum, deriv, out
+):
+    N, M = out.shape[1], out.shape[2]
+    for i in prange(N):
+        g = np.empty(len(ks), np.complex128)
+        for j in range(M):
+            if i == j:
+                radius = patch_radius(cdf_sum, importance[j], M)
+                for k_i in range(len(ks)):
+                    out[k_i, i, j] = self_term(ks[k_i], radius, deriv)
+                continue
+            W = 2 * cdf_sum / importance[j] / M
+            green_func_ks(trgs[i], srcs[j], normals[j], ks, dk, deriv, g)
+            for k_i in range(len(ks)):
+                out[k_i, i, j] = g[k_i] * W
+
+
+@njit(parallel=True)
+def _monte_carlo_weight_potential(
+    trgs, srcs, normals, importance, ks, dk, cdf_sum, deriv, out
+):
+    N, M = out.shape[1], out.shape[2]
+    for i in prange(N):
+        g = np.empty(len(ks), np.complex128)
+        for j in range(M):
+            W = cdf_sum / importance[j] / M
+            green_func_ks(trgs[i], srcs[j], normals[j], ks, dk, deriv, g)
+            for k_i in range(len(ks)):
+                out[k_i, i, j] = g[k_i] * W
+
+
+def _as_numpy(tensor):
+    return tensor.detach().contiguous().numpy()
+
+
+def _weight(deriv):
+    def get_monte_carlo_weight(
+        trg_points, src_points, src_normals, src_importance, k, cdf_sum, out
+    ):
+        _monte_carlo_weight(
+            _as_numpy(trg_points),
+            _as_numpy(src_points),
+            _as_numpy(src_normals),
+            _as_numpy(src_importance),
+            float(k),
+            float(cdf_sum),
+            deriv,
+            out.numpy(),
+        )
+
+    return get_monte_carlo_weight
+
+
+def _weight_ks(kernel, deriv):
+    def get_monte_carlo_weight_ks(
+        trg_points, src_points, src_normals, src_importance, ks, cdf_sum
+    ):
+        ks = _as_numpy(ks).reshape(-1)
+        out = np.empty((len(ks), len(trg_points), len(src_points)), np.complex64)
+        kernel(
+            _as_numpy(trg_points),
+            _as_numpy(src_points),
+            _as_numpy(src_normals),
+            _as_numpy(src_importance),
+            ks,
+            uniform_step(ks),
+            float(cdf_sum),
+            deriv,
+            out,
+        )
+        return torch.from_numpy(out)
+
+    return get_monte_carlo_weight_ks
+
+
+def _weight_boundary(deriv):
+    kernel = _weight_ks(_monte_carlo_weight_boundary, deriv)
+
+    def get_monte_carlo_weight_boundary(
+        trg_points, src_points, src_normals, src_importance, k, cdf_sum, out
+    ):
+        ks = torch.tensor([k], dtype=torch.float32)
+        result = kernel(
+            trg_points, src_points, src_normals, src_importance, ks, cdf_sum
+        )
+        out.copy_(torch.view_as_real(result[0]))
+
+    return get_monte_carlo_weight_boundary
+
+
+get_monte_carlo_weight0 = _weight(False)
+get_monte_carlo_weight1 = _weight(True)
+get_monte_carlo_weight_boundary0 = _weight_boundary(False)
+get_monte_carlo_weight_boundary1 = _weight_boundary(True)
+get_monte_carlo_weight_boundary_ks0 = _weight_ks(_monte_carlo_weight_boundary, False)
+get_monte_carlo_weight_boundary_ks1 = _weight_ks(_monte_carlo_weight_boundary, True)
+get_monte_carlo_weight_potential_ks0 = _weight_ks(_monte_carlo_weight_potential, False)
+get_monte_carlo_weight_potential_ks1 = _weight_ks(_monte_carlo_weight_potential, True)
+
+
+@njit(parallel=True)
+def _monte_carlo_matvec(
+    trgs, srcs, normals, importance, ks, dk, cdf_sum, deriv, boundary, x, out
+):
+    N, M = len(trgs), len(srcs)
+    B, C = x.shape[0], x.shape[2]
+    for i in prange(N):
+        acc = np.zeros((B, C), np.complex128)
+        g = np.empty(B, np.complex128)
+        for j in range(M):
+            if boundary and i == j:
+                radius = patch_radius(cdf_sum, importance[j], M)
+                for k_i in range(B):
+                    weight = self_term(ks[k_i], radius, deriv)
+                    for c in range(C):
+                        acc[k_i, c] += weight * x[k_i, j, c]
+                continue
+            W = cdf_sum / importance[j] / M
+            if boundary:
+                W *= 2
+            green_func_ks(trgs[i], srcs[j], normals[j], ks, dk, deriv, g)
+            for k_i in range(B):
+                weight = g[k_i] * W
+                for c in range(C):
+                    acc[k_i, c] += weight * x[k_i, j, c]
+        for k_i in range(B):
+            for c in range(C):
+                out[k_i, i, c] = acc[k_i, c]
+
+
+def _matvec(boundary, deriv):
+    def monte_carlo_matvec(
+        trg_points, src_points, src_normals, src_importance, ks, cdf_sum, x
+    ):
+        ks = _as_numpy(ks).reshape(-1)
+        x = _as_numpy(x).astype(np.complex64)
+        out = np.empty((x.shape[0], len(trg_points), x.shape[2]), np.complex64)
+        _monte_carlo_matvec(
+            _as_numpy(trg_points),
+            _as_numpy(src_points),
+            _as_numpy(src_normals),
+            _as_numpy(src_importance),
+            ks,
+            uniform_step(ks),
+            float(cdf_sum),
+            deriv,
+            boundary,
+            x,
+            out,
+        )
+        return torch.from_numpy(out)
+
+    return monte_carlo_matvec
+
+
+monte_carlo_matvec_boundary0 = _matvec(True, False)
+monte_carlo_matvec_boundary1 = _matvec(True, True)
+
+
+@njit(parallel=True)
+def _monte_carlo_potential(
+    trgs, srcs, normals, importance, ks, dk, cdf_sum, dirichlet, neumann, out
+):
+    N, M = len(trgs), len(srcs)
+    B = len(ks)
+    for i in prange(N):
+        acc = np.zeros(B, np.complex128)
+        g0 = np.empty(B, np.complex128)
+        g1 = np.empty(B, np.complex128)
+        for j in range(M):
+            W = cdf_sum / importance[j] / M
+            green_func_ks(trgs[i], srcs[j], normals[j], ks, dk, False, g0)
+            r = length(trgs[i], srcs[j])
+            if r < EPS:
+                g1[:] = 0
+            else:
+                # the double layer kernel shares the phase of the single layer
+                d = srcs[j] - trgs[i]
+                dot = d[0] * normals[j, 0] + d[1] * normals[j, 1] + d[2] * normals[j, 2]
+                for k_i in range(B):
+                    g1[k_i] = -g0[k_i] * dot / (r * r) * (1 - 1j * ks[k_i] * r)
+            for k_i in range(B):
+                acc[k_i] += W * (
+                    g1[k_i] * dirichlet[k_i, j] - g0[k_i] * neumann[k_i, j]
+                )
+        for k_i in range(B):
+            out[k_i, i] = acc[k_i]
+
+
+def monte_carlo_potential(
+    trg_points, src_points, src_normals, src_importance, ks, cdf_sum, dirichlet, neumann
+):
+    """
+    Field G1 dirichlet - G0 neumann of shape (batch, Ntrg) at the targets for
+    densities of shape (batch, M), without storing any weights.
+    """
+    ks = _as_numpy(ks).reshape(-1)
+    out = np.empty((len(ks), len(trg_points)), np.complex64)
+    _monte_carlo_potential(
+        _as_numpy(trg_points),
+        _as_numpy(src_points),
+        _as_numpy(src_normals),
+        _as_numpy(src_importance),
+        ks,
+        uniform_step(ks),
+        float(cdf_sum),
+        _as_numpy(dirichlet).astype(np.complex64),
+        _as_numpy(neumann).astype(np.complex64),
+        out,
+    )
+    return torch.from_numpy(out)
+
+
+def _multipole(M, deriv):
+    def get_multipole_values(x0_, n0_, x_, n_, k):
+        x0 = x0_.reshape(1, 3).double()
+        n0 = n0_.reshape(1, 3).double()
+        x = x_.double()
+        n = n_.double()
+        r = torch.linalg.norm(x0 - x, dim=1)
+        ikr = 1j * k * r
+        if M == 0 and not deriv:
+            out = torch.exp(ikr) / (4 * np.pi * r)
+        elif M == 0 and deriv:
+            out = (
+                -torch.exp(ikr)
+                / (4 * np.pi * r**3)
+                * (1 - ikr)
+                * ((x - x0) * n).sum(-1)
+            )
+        elif M == 1 and not deriv:
+            out = (
+                -torch.exp(ikr)
+                / (4 * np.pi * r**3)
+                * (1 - ikr)
+                * ((x0 - x) * n0).sum(-1)
+            )
+        else:
+            out = (
+                torch.exp(ikr)
+                / (4 * np.pi * r**3)
+                * (
+                    -(-3 + 3 * ikr - ikr * ikr)
+                    * ((x0 - x) * n0).sum(-1)
+                    * ((x - x0) * n).sum(-1)
+                    / (r * r)
+                    + (1 - ikr) * (n0 * n).sum(-1)
+                )
+            )
+        return out.to(torch.complex64)
+
+    return get_multipole_values
+
+
+get_multipole_values_0 = _multipole(0, False)
+get_multipole_values_1 = _multipole(1, False)
+get_multipole_values_0_deriv = _multipole(0, True)
+get_multipole_values_1_deriv = _multipole(1, True)
+
+
+@njit()
+def approx_geo_dist(p1, n1, p2, n2):
+    de = length(p2, p1)
+    v = (p2 - p1) / de
+    c1 = (n1 * v).sum()
+    c2 = (n2 * v).sum()
+    if abs(c1 - c2) < 1e-3:
+        return de / np.sqrt(1 - c1 * c1)
+    return (np.arcsin(c1) - np.arcsin(c2)) / (c1 - c2) * de
+
+
+@njit()
+def _hash_slot(keys, key):
+    # open addressing with linear probing, len(keys) is a power of two
+    mask = len(keys) - 1
+    h = (key * 2654435761) & mask
+    while keys[h] != -1 and keys[h] != key:
+        h = (h + 1) & mask
+    return h
+
+
+@njit()
+def _build_hash(cell_ids, first_point_id):
+    size = 1
+    while size < 2 * len(first_point_id):
+        size *= 2
+    keys = -np.ones(size, np.int64)
+    values = np.empty(size, np.int64)
+    for c in range(len(first_point_id)):
+        h = _hash_slot(keys, cell_ids[first_point_id[c]])
+        keys[h] = cell_ids[first_point_id[c]]
+        values[h] = c
+    return keys, values
+
+
+@njit()
+def _conflict(
+    p_id, c3, points, normals, cell_sample, hash_keys, hash_values, r, grid_res
+):
+    for x in range(-2, 3):
+        for y in range(-2, 3):
+            for z in range(-2, 3):
+                nx, ny, nz = c3[0] + x, c3[1] + y, c3[2] + z
+                if nx < 0 or ny < 0 or nz < 0:
+                    continue
+                if nx >= grid_res or ny >= grid_res or nz >= grid_res:
+                    continue
+                neighbor_id = nx + ny * grid_res + nz * grid_res * grid_res
+                h = _hash_slot(hash_keys, neighbor_id)
+                if hash_keys[h] == -1:
+                    continue
+                q_id = cell_sample[hash_values[h]]
+                if q_id == -1:
+                    continue
+                if (
+                    approx_geo_dist(
+                        points[p_id], normals[p_id], points[q_id], normals[q_id]
+                    )
+                    < r
+                ):
+                    return True
+    return False
+
+
+@njit(parallel=True)
+def _poisson_disk_resample(
+    points,
+    normals,
+    order,
+    cell_ids_3d,
+    first_point_id,
+    cell_end,
+    phase_cells,
+    phase_start,
+    phase_order,
+    hash_keys,
+    hash_values,
+    r,
+    k,
+    grid_res,
+):
+    # cells of one phase group are at least 3 cells apart on some axis, so
+    # their 5^3 neighborhoods never contain each other and the cells of a
+    # group are processed in parallel with the same result as serially
+    cell_sample = -np.ones(len(first_point_id), np.int64)
+    for trial_t in range(k):
+        for phase_group_id in phase_order[trial_t]:
+            for i in prange(
+                phase_start[phase_group_id], phase_start[phase_group_id + 1]
+            ):
+                c = phase_cells[i]
+                sorted_id = first_point_id[c] + trial_t
+                if cell_sample[c] != -1 or sorted_id >= cell_end[c]:
+                    continue
+                p_id = order[sorted_id]
+                if not _conflict(
+                    p_id,
+                    cell_ids_3d[c],
+                    points,
+                    normals,
+                    cell_sample,
+                    hash_keys,
+                    hash_values,
+                    r,
+                    grid_res,
+                ):
+                    cell_sample[c] = p_id
+    return cell_sample
+
+
+def poisson_disk_resample(points, points_normal, min_bound, max_bound, r, k, seed=None):
+    """
+    seed fixes the random phase group order, the result does not depend on
+    the number of threads.
+    """
+    points_ = _as_numpy(points).astype(np.float64)
+    normals_ = _as_numpy(points_normal).astype(np.float64)
+    min_bound = _as_numpy(min_bound).astype(np.float64)
+    max_bound = _as_numpy(max_bound).astype(np.float64)
+    cell_size = r / np.sqrt(3)
+    grid_res = int(np.ceil((max_bound[0] - min_bound[0]) / cell_size))
+    ids_3d = ((points_ - min_bound) / cell_size).astype(np.int64)
+    ids = ids_3d[:, 0] + ids_3d[:, 1] * grid_res + ids_3d[:, 2] * grid_res * grid_res
+    order = np.argsort(ids, kind="stable")
+    cell_ids = ids[order]
+    first_point_id = np.flatnonzero(np.r_[True, cell_ids[1:] != cell_ids[:-1]])
+    cell_end = np.r_[first_point_id[1:], len(cell_ids)]
+    cell_ids_3d = ids_3d[order][first_point_id]
+    phase = (cell_ids_3d % 3) @ np.array([1, 3, 9])
+    phase_cells = np.argsort(phase, kind="stable")
+    phase_start = np.searchsorted(phase[phase_cells], np.arange(28))
+    hash_keys, hash_values = _build_hash(cell_ids, first_point_id)
+    rng = np.random.default_rng(seed)
+    phase_order = np.stack([rng.permutation(27) for _ in range(k)])
+    cell_sample = _poisson_disk_resample(
+        points_,
+        normals_,
+        order,
+        cell_ids_3d,
+        first_point_id,
+        cell_end,
+        phase_cells,
+        phase_start,
+        phase_order,
+        hash_keys,
+        hash_values,
+        r,
+        k,
+        grid_res,
+    )
+    mask = torch.zeros(len(points_), dtype=torch.int32)
+    mask[torch.from_numpy(cell_sample[cell_sample != -1])] = 1
+    return mask
@@ -33,6 +33,29 @@ HOST_DEVICE inline complex Green_func<true>(float3 y, float3 x, float3 xn, float
     return potential;
 }
 
+// Radius of the equal-area disc of a sample, the disc with the surface area
+// cdf_sum / (importance * M) that the sample stands for.
+HOST_DEVICE inline float patch_radius(float cdf_sum, float importance, int M)
+{
+    return sqrt(cdf_sum / (M_PI * importance * M));
+}
+
+// Twice the integral of the Green's function over a flat disc of the given
+// radius around its center. The double layer kernel vanishes on the disc.
+template <bool deriv>
+HOST_DEVICE inline complex self_term(float k, float radius)
+{
+    if (deriv)
+        return 0;
+    if (k * radius < 1e-6f)
+        return radius;
+    return (exp(complex(0, k * radius)) - 1.f) / complex(0, k);
+}
+
+// A target closer to a sample than this fraction of its patch radius sits on
+// the sample and gets the self term of the patch.
+#define COINCIDENT 1e-3f
+
 template <bool deriv>
 void get_monte_carlo_weight(const torch::Tensor trg_points,
                             const torch::Tensor src_points,
@@ -45,9 +68,11 @@ void get_monte_carlo_weight(const torch::Tensor trg_points,
     int N = out.size(0), M = out.size(1);
     GPUMemory<int> near_point_num(N);
     near_point_num.memset(0);
-    parallel_for(N * M, [N, M, k, trgs = (float3 *)trg_points.data_ptr(), srcs = (float3 *)src_points.data_ptr(),
+    parallel_for(N * M, [N, M, cdf_sum, trgs = (float3 *)trg_points.data_ptr(), srcs = (float3 *)src_points.data_ptr(),
+                         src_importance = (float *)src_importance.data_ptr(),
                          near_point_num = near_point_num.device_ptr()] __device__(int i) {
-        if (length(trgs[i / M] - srcs[i % M]) < EPS)
+        float radius = patch_radius(cdf_sum, src_importance[i % M], M);
+        if (length(trgs[i / M] - srcs[i % M]) < COINCIDENT * radius)
             atomicAdd(&near_point_num[i / M], 1);
     });
 
@@ -59,19 +84,15 @@ void get_monte_carlo_weight(const torch::Tensor trg_points,
         float3 trg = trgs[trg_i];
         float3 src = srcs[src_i];
         float3 normal = src_normals[src_i];
-        auto weight = Green_func<deriv>(trg, src, normal, k);
+        float radius = patch_radius(cdf_sum, src_importance[src_i], M);
+        complex weight;
+        if (length(trg - src) < COINCIDENT * radius)
+            weight = self_term<deriv>(k, radius) / float(near_point_num[trg_i]);
+        else
+            weight = Green_func<deriv>(trg, src, normal, k) * (2 * cdf_sum / src_importance[src_i] / M);
         float2 result;
         result.x = weight.real();
         result.y = weight.imag();
-        float near_field_cdf_sum = M_PI * EPS * EPS * src_importance[src_i];
-        if (length(trg - src) < EPS)
-        {
-            result *= 2 * (2 * M_PI * EPS) / near_point_num[trg_i];
-        }
-        else
-        {
-            result *= 2 * (cdf_sum - near_field_cdf_sum) / src_importance[src_i] / (M - near_point_num[trg_i]);
-        }
         out[i] = result;
     });
 }
@@ -125,18 +146,14 @@ void get_monte_carlo_weight_boundary(const torch::Tensor trg_points,
             float3 trg = trgs[trg_i];
             float3 src = srcs[src_i];
             float3 normal = src_normals[src_i];
-            auto weight = Green_func<deriv>(trg, src, normal, k);
+            complex weight;
+            if (trg_i == src_i)
+                weight = self_term<deriv>(k, patch_radius(cdf_sum, src_importance[src_i], M));
+            else
+                weight = Green_func<deriv>(trg, src, normal, k) * (2 * cdf_sum / src_importance[src_i] / M);
             float2 result;
             result.x = weight.real();
             result.y = weight.imag();
-            if (trg_i == src_i)
-            {
-                result *= 2 * (2 * M_PI * EPS);
-            }
-            else
-            {
-                result *= 2 * (cdf_sum - M_PI * EPS * EPS * src_importance[src_i]) / src_importance[src_i] / (M - 1);
-            }
             out[i] = result;
         });
 }
@@ -161,15 +178,18 @@ torch::Tensor get_monte_carlo_weight_boundary_ks(const torch::Tensor trg_points,
                      float3 trg = trgs[trg_i];
                      float3 src = srcs[src_i];
                      float3 normal = src_normals[src_i];
-                     float W;
                      if (trg_i == src_i)
                      {
-                         W = 2 * (2 * M_PI * EPS);
-                     }
-                     else
-                     {
-                         W = 2 * (cdf_sum - M_PI * EPS * EPS * src_importance[src_i]) / src_importance[src_i] / (M - 1);
+                         float radius = patch_radius(cdf_sum, src_importance[src_i], M);
+                         for (int k_i = 0; k_i < batch_size; k_i++)
+                         {
+                             auto weight = self_term<deriv>(ks[k_i], radius);
+                             out(k_i, trg_i, src_i).x = weight.real();
+                             out(k_i, trg_i, src_i).y = weight.imag();
+                         }
+                         return;
                      }
+                     float W = 2 * cdf_sum / src_importance[src_i] / M;
                      for (int k_i = 0; k_i < batch_size; k_i++)
                      {
                          auto weight = Green_func<deriv>(trg, src, normal, ks[k_i]);
@@ -244,18 +264,13 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor> get_monte_carlo_weight_s
             reservoir.update(src_i, p_hat / p, curand_uniform(&state));
         }
         auto src_i = reservoir.y_idx;
-        auto green_func_value = Green_func<deriv>(trg, points[src_i], normals[src_i], k);
-        float2 W = make_float2(green_func_value.real(), green_func_value.imag());
-        W *= (length(trg - points[src_i]) + EPS) * (1.0f / reservoir.M * reservoir.w_sum);
+        float W = (length(trg - points[src_i]) + EPS) * (1.0f / reservoir.M * reservoir.w_sum);
+        complex weight;
         if (trg_i == src_i)
-        {
-            W *= 2 * (2 * M_PI * EPS);
-        }
+            weight = self_term<deriv>(k, patch_radius(cdf_sum, importance[src_i], N));
         else
-        {
-            W *= 2 * (cdf_sum - M_PI * EPS * EPS * importance[src_i]) / importance[src_i] / (N - 1);
-        }
-        values(trg_i, col_i) = W;
+            weight = Green_func<deriv>(trg, points[src_i], normals[src_i], k) * (2 * cdf_sum / importance[src_i] / N);
+        values(trg_i, col_i) = make_float2(weight.real() * W, weight.imag() * W);
         col_indices(trg_i, col_i) = reservoir.y_idx;
         if (i < N + 1)
             row_indices[i] = i * resample_num;
@@ -309,18 +324,13 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor> get_monte_carlo_weight_s
         auto src = points[src_i];
         auto normal = normals[src_i];
         float W = (length(trg - points[src_i]) + EPS) * (1.0f / reservoir.M * reservoir.w_sum);
-        if (trg_i == src_i)
-        {
-            W *= 2 * (2 * M_PI * EPS);
-        }
-        else
-        {
-            W *= 2 * (cdf_sum - M_PI * EPS * EPS * importance[src_i]) / importance[src_i] / (N - 1);
-        }
+        float radius = patch_radius(cdf_sum, importance[src_i], N);
+        if (trg_i != src_i)
+            W *= 2 * cdf_sum / importance[src_i] / N;
         for (int k_i = 0; k_i < M; k_i++)
         {
             float k = ks[k_i];
-            auto weight = Green_func<deriv>(trg, src, normal, k);
+            auto weight = trg_i == src_i ? self_term<deriv>(k, radius) : Green_func<deriv>(trg, src, normal, k);
             values(trg_i, col_i, k_i).x = weight.real() * W;
             values(trg_i, col_i, k_i).y = weight.imag() * W;
         }
@@ -420,6 +430,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m)
     m.def("get_random_states", &get_random_states, "");
     m.def("get_cdf", &get_cdf, "");
     m.def("importance_sample", &importance_sample, "");
+    m.def("importance_sample_uniforms", &importance_sample_uniforms, "");
     m.def("poisson_disk_resample", &poisson_disk_resample, "");
     m.def("allocate_grids_data", &allocate_grids_data, "");
     m.def("FDTD_simulation", &FDTD_simulation, "");
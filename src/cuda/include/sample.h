@@ -93,3 +93,57 @@ void importance_sample(const torch::Tensor vertices,
                      points_index[i] = element_id;
                  });
 }
+
+// Same as importance_sample, with the three uniform numbers of every sample
+// read from a (3, num_samples) tensor, e.g. a Sobol or stratified sequence.
+void importance_sample_uniforms(const torch::Tensor vertices,
+                                const torch::Tensor triangles,
+                                torch::Tensor triangles_importance,
+                                torch::Tensor triangles_neumann,
+                                torch::Tensor cdf,
+                                int num_samples,
+                                const torch::Tensor uniforms,
+                                torch::Tensor points,
+                                torch::Tensor points_normals,
+                                torch::Tensor points_importance,
+                                torch::Tensor points_neumann,
+                                torch::Tensor points_index)
+
+{
+    int triangles_size = triangles.size(0);
+    parallel_for(num_samples,
+                 [vertices = (float3 *)vertices.data_ptr(), triangles = (int3 *)triangles.data_ptr(),
+                  cdf = (float *)cdf.data_ptr(), points = (float3 *)points.data_ptr(),
+                  triangles_importance = (float *)triangles_importance.data_ptr(),
+                  triangles_neumann = (float *)triangles_neumann.data_ptr(),
+                  points_normals = (float3 *)points_normals.data_ptr(),
+                  points_importance = (float *)points_importance.data_ptr(),
+                  points_neumann = (float *)points_neumann.data_ptr(), points_index = (int *)points_index.data_ptr(),
+                  uniforms = (float *)uniforms.data_ptr(), num_samples, triangles_size] __device__(int i) {
+                     float x = uniforms[i] * cdf[triangles_size - 1];
+                     // binary search
+                     uint l = 0, r = triangles_size - 1;
+                     while (l < r)
+                     {
+                         uint mid = (l + r) / 2;
+                         if (cdf[mid] < x)
+                             l = mid + 1;
+                         else
+                             r = mid;
+                     }
+                     uint element_id = l;
+                     float e1 = uniforms[num_samples + i];
+                     float e2 = uniforms[2 * num_samples + i];
+                     float u = 1 - sqrt(e1);
+                     float v = e2 * sqrt(e1);
+                     float w = 1.f - u - v;
+                     float3 v0 = vertices[triangles[element_id].x];
+                     float3 v1 = vertices[triangles[element_id].y];
+                     float3 v2 = vertices[triangles[element_id].z];
+                     points[i] = v0 * u + v1 * v + v2 * w;
+                     points_normals[i] = normalize(cross(v1 - v0, v2 - v0));
+                     points_importance[i] = triangles_importance[element_id];
+                     points_neumann[i] = triangles_neumann[element_id];
+                     points_index[i] = element_id;
+                 });
+}
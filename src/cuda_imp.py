@@ -14,6 +14,12 @@ class CUDA_MODULE:
             CUDA_MODULE.load()
         return getattr(CUDA_MODULE._module, name)
 
+    @staticmethod
+    def has(name):
+        if CUDA_MODULE._module is None:
+            CUDA_MODULE.load()
+        return hasattr(CUDA_MODULE._module, name)
+
     @staticmethod
     def load(Debug=False, MemoryCheck=False, Verbose=False):
         src_dir = os.path.dirname(os.path.abspath(__file__)) + "/cuda"
@@ -39,7 +45,59 @@ class CUDA_MODULE:
         return CUDA_MODULE._module
 
 
-CUDA_MODULE.load(Debug=False, MemoryCheck=False, Verbose=False)
+class CPU_MODULE:
+    _module = None
+
+    @staticmethod
+    def get(name):
+        if CPU_MODULE._module is None:
+            CPU_MODULE.load()
+        if not hasattr(CPU_MODULE._module, name):
+            raise NotImplementedError(f"{name} has no CPU implementation")
+        return getattr(CPU_MODULE._module, name)
+
+    @staticmethod
+    def has(name):
+        if CPU_MODULE._module is None:
+            CPU_MODULE.load()
+        return hasattr(CPU_MODULE._module, name)
+
+    @staticmethod
+    def load(num_threads=None):
+        from . import cpu_imp
+
+        if num_threads is not None:
+            cpu_imp.set_num_threads(num_threads)
+        CPU_MODULE._module = cpu_imp
+        return CPU_MODULE._module
+
+
+BACKENDS = {"cuda": CUDA_MODULE, "cpu": CPU_MODULE}
+
+
+def register_backend(device_type, module):
+    """
+    Register a kernel module for tensors on the given device type. The module
+    must provide static ``get(name)`` and ``has(name)`` lookups of its kernels.
+    """
+    BACKENDS[device_type] = module
+
+
+def get_backend(device):
+    if isinstance(device, torch.Tensor):
+        device = device.device
+    device_type = torch.device(device).type
+    if device_type not in BACKENDS:
+        raise NotImplementedError(f"no backend registered for device {device_type}")
+    return BACKENDS[device_type]
+
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+if torch.cuda.is_available():
+    CUDA_MODULE.load(Debug=False, MemoryCheck=False, Verbose=False)
 
 
 def multipole(x0, n0, x, n, k, M, deriv):
@@ -52,12 +110,12 @@ def multipole(x0, n0, x, n, k, M, deriv):
     cuda_method_name = "get_multipole_values_" + str(M)
     if deriv:
         cuda_method_name += "_deriv"
-    return CUDA_MODULE.get(cuda_method_name)(x0, n0, x, n, k)
+    return get_backend(x).get(cuda_method_name)(x0, n0, x, n, k)
 
 
 def check_tensor(tensor, dtype):
     assert tensor.dtype == dtype
-    assert tensor.is_cuda
+    assert tensor.device.type in BACKENDS
     assert tensor.is_contiguous()
 
 
@@ -75,15 +133,45 @@ def get_bound_info(vertices, padding=0.1):
 
 class ImportanceSampler:
     def __init__(
-        self, vertices, triangles, importance, num_samples, neumann_coeff=None
+        self,
+        vertices,
+        triangles,
+        importance,
+        num_samples,
+        neumann_coeff=None,
+        seed=None,
+        sequence="random",
     ):
+        """
+        seed makes the samples reproducible on backends that support it (CPU).
+        sequence is "random" for i.i.d. samples, "sobol" for a scrambled Sobol
+        sequence or "stratified" for one jittered sample per equal-importance
+        stratum of the triangle cdf, so every triangle gets close to its
+        expected number of samples.
+        """
+        if sequence not in ("random", "sobol", "stratified"):
+            raise ValueError(f"unknown sample sequence {sequence}")
         check_tensor(vertices, torch.float32)
         check_tensor(triangles, torch.int32)
         self.vertices = vertices
         self.triangles = triangles
         self.triangle_importance = importance
-        self.cdf = CUDA_MODULE.get("get_cdf")(vertices, triangles, importance)
-        self.random_state = CUDA_MODULE.get("get_random_states")(num_samples)
+        self.backend = get_backend(vertices)
+        self.cdf = self.backend.get("get_cdf")(vertices, triangles, importance)
+        # the CUDA kernels draw their seeds from the host clock
+        cpu_seed = seed is not None and self.backend is CPU_MODULE
+        self.seed_args = (seed,) if cpu_seed else ()
+        self.sequence = sequence
+        if sequence == "sobol":
+            self.sobol = torch.quasirandom.SobolEngine(3, scramble=True, seed=seed)
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.random_state = self.backend.get("get_random_states")(
+            num_samples, *self.seed_args
+        )
         self.points = torch.empty(
             (num_samples, 3), dtype=torch.float32, device=self.vertices.device
         )
@@ -107,18 +195,34 @@ class ImportanceSampler:
         )
         self.min_bound, self.max_bound, self.bound_size = get_bound_info(vertices)
 
+    def uniforms(self):
+        """
+        (3, num_samples) numbers in [0, 1) of the low-discrepancy sequence.
+        """
+        n = self.num_samples
+        if self.sequence == "sobol":
+            rnd = self.sobol.draw(n).T.contiguous()
+        else:
+            rnd = torch.rand(3, n, generator=self.generator)
+            rnd[0] = (torch.arange(n) + rnd[0]) / n
+        return rnd.clamp_(max=1 - 1e-7).to(self.vertices.device)
+
     def update(self):
         """
         Sample points on the surface of the mesh.
         """
-        CUDA_MODULE.get("importance_sample")(
+        if self.sequence == "random":
+            name, rnd = "importance_sample", self.random_state
+        else:
+            name, rnd = "importance_sample_uniforms", self.uniforms()
+        self.backend.get(name)(
             self.vertices,
             self.triangles,
             self.triangle_importance,
             self.triangle_neumann,
             self.cdf,
             self.num_samples,
-            self.random_state,
+            rnd,
             self.points,
             self.points_normals,
             self.points_importance,
@@ -130,13 +234,14 @@ class ImportanceSampler:
         """
         Sample points on the surface of the mesh.
         """
-        mask = CUDA_MODULE.get("poisson_disk_resample")(
+        mask = self.backend.get("poisson_disk_resample")(
             self.points,
             self.points_normals,
             self.min_bound,
             self.max_bound,
             r,
             k,
+            *self.seed_args,
         ).bool()
         N = mask.sum()
         self.points = self.points[mask]
@@ -155,7 +260,7 @@ def get_weights_potential_ks_base(
 ):
     ks = torch.as_tensor(ks, dtype=torch.float32, device=trg_points.device)
     cuda_method_name = "get_monte_carlo_weight_potential_ks" + str(int(deriv))
-    return CUDA_MODULE.get(cuda_method_name)(
+    return get_backend(trg_points).get(cuda_method_name)(
         trg_points,
         points,
         normals,
@@ -168,7 +273,7 @@ def get_weights_potential_ks_base(
 def get_weights_boundary_ks_base(ks, points, normals, importance, cdf, deriv):
     ks = torch.as_tensor(ks, dtype=torch.float32, device=points.device)
     cuda_method_name = "get_monte_carlo_weight_boundary_ks" + str(int(deriv))
-    return CUDA_MODULE.get(cuda_method_name)(
+    return get_backend(points).get(cuda_method_name)(
         points,
         points,
         normals,
@@ -191,14 +296,15 @@ class MonteCarloWeight:
         )
         self.k = k
         self.deriv = deriv
+        self.backend = get_backend(trg_points)
 
     def init_random_states(self, resample_num):
         N = self.src_sample.num_samples
-        self.random_state = CUDA_MODULE.get("get_random_states")(N * resample_num)
+        self.random_state = self.backend.get("get_random_states")(N * resample_num)
 
     def get_weights(self, k=None):
         cuda_method_name = "get_monte_carlo_weight" + str(int(self.deriv))
-        CUDA_MODULE.get(cuda_method_name)(
+        self.backend.get(cuda_method_name)(
             self.trg_points,
             self.src_sample.points,
             self.src_sample.points_normals,
@@ -212,7 +318,7 @@ class MonteCarloWeight:
     def get_weights_potential_ks(self, ks):
         ks = torch.as_tensor(ks, dtype=torch.float32, device=self.trg_points.device)
         cuda_method_name = "get_monte_carlo_weight_potential_ks" + str(int(self.deriv))
-        return CUDA_MODULE.get(cuda_method_name)(
+        return self.backend.get(cuda_method_name)(
             self.trg_points,
             self.src_sample.points,
             self.src_sample.points_normals,
@@ -223,7 +329,7 @@ class MonteCarloWeight:
 
     def get_weights_boundary(self, k=None):
         cuda_method_name = "get_monte_carlo_weight_boundary" + str(int(self.deriv))
-        CUDA_MODULE.get(cuda_method_name)(
+        self.backend.get(cuda_method_name)(
             self.trg_points,
             self.src_sample.points,
             self.src_sample.points_normals,
@@ -237,7 +343,7 @@ class MonteCarloWeight:
     def get_weights_boundary_ks(self, ks):
         ks = torch.as_tensor(ks, dtype=torch.float32, device=self.trg_points.device)
         cuda_method_name = "get_monte_carlo_weight_boundary_ks" + str(int(self.deriv))
-        return CUDA_MODULE.get(cuda_method_name)(
+        return self.backend.get(cuda_method_name)(
             self.trg_points,
             self.src_sample.points,
             self.src_sample.points_normals,
@@ -246,9 +352,54 @@ class MonteCarloWeight:
             self.src_sample.cdf[-1],
         )
 
+    def get_treecode_boundary_ks(self, ks, tol=1e-4, **kwargs):
+        """
+        Treecode approximation of get_weights_boundary_ks, applied by matvec.
+        """
+        from .treecode import TreecodeOperator
+
+        return TreecodeOperator(
+            self.trg_points,
+            self.src_sample,
+            ks,
+            deriv=self.deriv,
+            boundary=True,
+            tol=tol,
+            **kwargs,
+        )
+
+    def get_treecode_potential_ks(self, ks, tol=1e-4, **kwargs):
+        """
+        Treecode approximation of get_weights_potential_ks, applied by matvec.
+        """
+        from .treecode import TreecodeOperator
+
+        return TreecodeOperator(
+            self.trg_points,
+            self.src_sample,
+            ks,
+            deriv=self.deriv,
+            boundary=False,
+            tol=tol,
+            **kwargs,
+        )
+
+    def get_hmatrix_boundary_ks(self, ks, tol=1e-4, cache_dir=None, **kwargs):
+        """
+        H-matrix compression of get_weights_boundary_ks, applied by matvec.
+        With cache_dir the compressed operator is stored there and reloaded by
+        later calls on the same samples and wavenumbers.
+        """
+        from .hmatrix import HMatrixOperator
+
+        args = (self.trg_points, self.src_sample, ks, self.deriv, True, tol)
+        if cache_dir is not None:
+            return HMatrixOperator.cached(cache_dir, *args, **kwargs)
+        return HMatrixOperator(*args, **kwargs)
+
     def get_weights_sparse(self, resample_num, k=None):
         cuda_method_name = "get_monte_carlo_weight_sparse" + str(int(self.deriv))
-        row_indices, col_indices, values = CUDA_MODULE.get(cuda_method_name)(
+        row_indices, col_indices, values = self.backend.get(cuda_method_name)(
             self.src_sample.points,
             self.src_sample.points_normals,
             self.src_sample.points_importance,
@@ -269,7 +420,7 @@ class MonteCarloWeight:
     def get_weights_sparse_ks(self, resample_num, ks):
         ks = torch.as_tensor(ks, dtype=torch.float32, device=self.trg_points.device)
         cuda_method_name = "get_monte_carlo_weight_sparse_ks" + str(int(self.deriv))
-        row_indices, col_indices, values = CUDA_MODULE.get(cuda_method_name)(
+        row_indices, col_indices, values = self.backend.get(cuda_method_name)(
             self.src_sample.points,
             self.src_sample.points_normals,
             self.src_sample.points_importance,
@@ -298,7 +449,7 @@ class MonteCarloWeight:
     def get_weights_sparse_ks_fast(self, resample_num, ks):
         ks = torch.as_tensor(ks, dtype=torch.float32, device=self.trg_points.device)
         cuda_method_name = "get_monte_carlo_weight_sparse_ks" + str(int(self.deriv))
-        row_indices, col_indices, values = CUDA_MODULE.get(cuda_method_name)(
+        row_indices, col_indices, values = self.backend.get(cuda_method_name)(
             self.src_sample.points,
             self.src_sample.points_normals,
             self.src_sample.points_importance,
@@ -311,11 +462,11 @@ class MonteCarloWeight:
 
 
 def fast_sparse_matrix_vector_mul(col_indices, values, x):
-    return CUDA_MODULE.get("sparse_matrix_vector_mul")(col_indices, values, x)
+    return get_backend(x).get("sparse_matrix_vector_mul")(col_indices, values, x)
 
 
 def fast_sparse_matrix_vector_mul2(col_indices, values, x):
-    return CUDA_MODULE.get("sparse_matrix_vector_mul_fast")(col_indices, values, x)
+    return get_backend(x).get("sparse_matrix_vector_mul_fast")(col_indices, values, x)
 
 
 class FDTDSimulator:
@@ -11,8 +11,29 @@ from .modalsound.model import (
 )
 import numpy as np
 from .visualize import plot_mesh, plot_point_cloud, CombinedFig
-from .solver import BiCGSTAB, BiCGSTAB_batch, BiCGSTAB_batch2
+from .solver import (
+    BiCGSTAB,
+    BiCGSTAB_batch,
+    BiCGSTAB_batch2,
+    GMRES_batch,
+    GCRODR_batch,
+    RecycleSpace,
+    warm_start,
+)
+from .mc_operator import (
+    get_boundary_operators,
+    get_potential_operators,
+    evaluate_potential,
+    NearFieldPreconditioner,
+    DENSE_MEMORY_BUDGET,
+)
+from .importance import (
+    adaptive_importance,
+    quantize_importance,
+    poisson_importance_sampler,
+)
 import os
+import copy
 from glob import glob
 from tqdm import tqdm
 from numba import njit
@@ -32,23 +53,141 @@ def compute_sample_r(vertices, triangles, n):
     return (total_area.item() / (2 * n)) ** 0.5
 
 
-def get_sampler(vertices, triangles, n):
-    importance = torch.ones(len(triangles), dtype=torch.float32).cuda()
-    if n > 0:
+def get_sampler(vertices, triangles, n, cache=None, importance=None, sequence="random"):
+    """
+    cache is an optional SampleCache that returns the Poisson-disk samples of
+    an earlier call on the same, possibly uniformly scaled, mesh. importance
+    is an optional per-triangle sample density, e.g. from adaptive_importance.
+    sequence selects the ImportanceSampler sequence of the candidates.
+    """
+    if importance is not None and n > 0:
+        importance = quantize_importance(importance).float().contiguous()
+    elif importance is None:
+        importance = torch.ones(
+            len(triangles), dtype=torch.float32, device=vertices.device
+        )
+    if n > 0 and cache is not None:
+        timer = Timer()
+        sampler = cache.load(vertices, triangles, importance, n, sequence)
+        if sampler is not None:
+            return sampler, timer.get_time()
+    if n > 0 and not (importance == 1).all():
+        timer = Timer()
+        sampler = poisson_importance_sampler(
+            vertices, triangles, importance, n, sequence=sequence
+        )
+        cost_time = timer.get_time()
+        if cache is not None:
+            cache.store(sampler, n, sampler.sequence)
+    elif n > 0:
         r = compute_sample_r(vertices, triangles, n)
-        sampler = ImportanceSampler(vertices, triangles, importance, 50000)
+        sampler = ImportanceSampler(
+            vertices, triangles, importance, 50000, sequence=sequence
+        )
         timer = Timer()
         sampler.update()
         sampler.poisson_disk_resample(r, 4)
         cost_time = timer.get_time()
+        if cache is not None:
+            cache.store(sampler, n, sampler.sequence)
     else:
-        sampler = ImportanceSampler(vertices, triangles, importance, 1000)
+        sampler = ImportanceSampler(
+            vertices, triangles, importance, 1000, sequence=sequence
+        )
         timer = Timer()
         sampler.update()
         cost_time = timer.get_time()
     return sampler, cost_time
 
 
+def coarsen_sampler(sampler, r):
+    """
+    Poisson-disk subset of the samples with radius r / sqrt(importance), so
+    the subset keeps a density proportional to the importance.
+    """
+    keep = torch.zeros(
+        sampler.num_samples, dtype=torch.bool, device=sampler.points.device
+    )
+    for level in torch.unique(sampler.points_importance):
+        ids = torch.nonzero(sampler.points_importance == level).squeeze(-1)
+        mask = sampler.backend.get("poisson_disk_resample")(
+            sampler.points[ids].contiguous(),
+            sampler.points_normals[ids].contiguous(),
+            sampler.min_bound,
+            sampler.max_bound,
+            r / float(level) ** 0.5,
+            4,
+            *getattr(sampler, "seed_args", ()),
+        ).bool()
+        keep[ids[mask]] = True
+    coarse = copy.copy(sampler)
+    for name in (
+        "points",
+        "points_normals",
+        "points_importance",
+        "points_neumann",
+        "points_index",
+    ):
+        setattr(coarse, name, getattr(sampler, name)[keep])
+    coarse.num_samples = int(keep.sum())
+    return coarse
+
+
+class BandSamplers:
+    """
+    Nested sample sets for frequency bands. A band with largest wavenumber k
+    needs a radius of about 2 pi / k / points_per_wavelength. The radii are
+    rounded up to levels r * 2^(j / 2), each holding about half the samples
+    of the previous one, and every level is a Poisson-disk subset of the next
+    finer one, the finest being the n samples of sampler. Levels with fewer
+    than min_samples samples are not built, as they no longer resolve the
+    geometry.
+    """
+
+    def __init__(self, sampler, n, points_per_wavelength, min_samples=512):
+        self.r = (float(sampler.cdf[-1]) / (2 * n)) ** 0.5
+        self.points_per_wavelength = points_per_wavelength
+        self.min_samples = min_samples
+        self.levels = [sampler]
+
+    def level(self, k):
+        r = 2 * np.pi / float(k) / self.points_per_wavelength
+        return max(0, int(np.floor(2 * np.log2(max(r, self.r) / self.r))))
+
+    def get(self, k):
+        j = self.level(k)
+        while len(self.levels) <= j:
+            if self.levels[-1].num_samples < 2 * self.min_samples:
+                break
+            r = self.r * 2 ** (len(self.levels) / 2)
+            self.levels.append(coarsen_sampler(self.levels[-1], r))
+        return self.levels[min(j, len(self.levels) - 1)]
+
+
+def resolve_failed(G1_batch, precond, b, x, info, tol, nsteps, restart):
+    """
+    Solve the columns of x that did not converge again with restarted GMRES,
+    whose residual never increases, starting from their last iterate. The
+    other columns are left as they are, info is updated in place.
+    """
+    failed = torch.nonzero(~info["converged"]).squeeze(-1).to(b.device)
+    modes = failed.tolist()
+    solver = GMRES_batch(
+        lambda x: G1_batch.matvec(x.permute(2, 0, 1), modes).permute(1, 2, 0) - x,
+        device=b.device,
+        restart=restart,
+        precond=None if precond is None else lambda x: precond(x, modes),
+    )
+    x_failed, _ = solver.solve(b[..., failed], x[..., failed], nsteps, tol)
+    x[..., failed] = x_failed
+    failed = failed.cpu()
+    info["iterations"][failed] += solver.info["iterations"]
+    info["restarts"][failed] += solver.info["restarts"] + 1
+    info["residuals"][failed] = solver.info["residuals"]
+    info["converged"][failed] = solver.info["converged"]
+    return x, bool(info["converged"].all())
+
+
 def monte_carlo_sampler_solve(
     sampler,
     neumann_tri,
@@ -58,31 +197,109 @@ def monte_carlo_sampler_solve(
     nsteps=100,
     plot=False,
     check_converge=True,
+    memory_budget=DENSE_MEMORY_BUDGET,
+    method="auto",
+    operator_tol=1e-4,
+    operator_cache_dir=None,
+    scratch_dir=None,
+    operator_precision="complex64",
+    krylov="bicgstab",
+    restart=30,
+    precond=None,
+    precond_side="right",
+    recycle=None,
+    return_info=False,
 ):
-    G0_constructor = MonteCarloWeight(sampler.points, sampler)
-    G1_constructor = MonteCarloWeight(sampler.points, sampler, deriv=True)
-    G0_batch = G0_constructor.get_weights_boundary_ks(ks)
-    G1_batch = G1_constructor.get_weights_boundary_ks(ks)
+    """
+    recycle is an optional RecycleSpace of earlier solves on this sampler. It
+    warm-starts each wavenumber from the solution of the nearest solved one,
+    and with krylov="gcrodr" also recycles its deflation subspace. With
+    check_converge, the modes that did not converge are solved again on their
+    own, see resolve_failed. With return_info, the per-mode iterations,
+    relative residuals, convergence flags and restarts are returned as well.
+    """
+    G0_batch, G1_batch = get_boundary_operators(
+        sampler,
+        ks,
+        memory_budget,
+        method,
+        operator_tol,
+        operator_cache_dir,
+        scratch_dir,
+        operator_precision,
+    )
     # print(neumann_tri.shape)
     neumann = neumann_tri[:, sampler.points_index].unsqueeze(-1)
     # print(G0_batch.shape, G1_batch.shape, neumann.shape)
-    b_batch = torch.bmm(G0_batch, neumann).permute(1, 2, 0)
-    solver = BiCGSTAB_batch(
-        lambda x: (torch.bmm(G1_batch, x.permute(2, 0, 1)).permute(1, 2, 0) - x)
-    )
-    dirichlet, convergence = solver.solve(b_batch, tol=tol, nsteps=nsteps)
+    b_batch = G0_batch.matvec(neumann).permute(1, 2, 0)
+    if precond == "near_field":
+        near_field = NearFieldPreconditioner(sampler, ks)
+        precond = lambda x, modes=None: near_field.apply(
+            x.permute(2, 0, 1), modes
+        ).permute(1, 2, 0)
+    elif precond is not None:
+        raise ValueError(f"unknown preconditioner {precond}")
+    if krylov == "bicgstab":
+        solver = BiCGSTAB_batch(
+            lambda x, modes: (
+                G1_batch.matvec(x.permute(2, 0, 1), modes).permute(1, 2, 0) - x
+            ),
+            device=sampler.points.device,
+            active_set=True,
+            precond=precond,
+            precond_side=precond_side,
+        )
+    elif krylov in ("gmres", "fgmres"):
+        solver = GMRES_batch(
+            lambda x: (G1_batch.matvec(x.permute(2, 0, 1)).permute(1, 2, 0) - x),
+            device=sampler.points.device,
+            restart=restart,
+            flexible=krylov == "fgmres",
+            precond=precond,
+            precond_side=precond_side,
+        )
+    elif krylov == "gcrodr":
+        solver = GCRODR_batch(
+            lambda x: (G1_batch.matvec(x.permute(2, 0, 1)).permute(1, 2, 0) - x),
+            device=sampler.points.device,
+            restart=restart,
+            precond=precond,
+            precond_side=precond_side,
+        )
+    else:
+        raise ValueError(f"unknown krylov solver {krylov}")
+    x0, kwargs = None, {}
+    if recycle is not None and krylov == "gcrodr":
+        kwargs["U"] = recycle.basis(ks, len(b_batch))
+    elif recycle is not None:
+        x_prev = recycle.initial_guess(ks, len(b_batch))
+        if x_prev is not None:
+            columns = (torch.arange(len(ks)),) if krylov == "bicgstab" else ()
+            x0 = warm_start(solver.Ax_gen, b_batch, x_prev, *columns)
+    dirichlet, convergence = solver.solve(b_batch, x0, tol=tol, nsteps=nsteps, **kwargs)
+    info = {key: value.clone() for key, value in solver.info.items()}
     if not convergence and check_converge:
-        return None, False
+        dirichlet, convergence = resolve_failed(
+            G1_batch, precond, b_batch, dirichlet, info, tol, nsteps, restart
+        )
+    if recycle is not None:
+        recycle.update(ks, dirichlet, getattr(solver, "U", None))
     dirichlet = dirichlet.permute(2, 0, 1)
     if plot:
         CombinedFig().add_points(sampler.points, dirichlet[0].real).show()
         CombinedFig().add_points(sampler.points, dirichlet[0].imag).show()
-    G0_constructor = MonteCarloWeight(trg_points, sampler)
-    G1_constructor = MonteCarloWeight(trg_points, sampler, deriv=True)
-    G0 = G0_constructor.get_weights_potential_ks(ks)
-    G1 = G1_constructor.get_weights_potential_ks(ks)
-    ffat_map = G1 @ dirichlet - G0 @ neumann
-    return ffat_map.squeeze(-1), convergence
+    if method == "treecode":
+        G0, G1 = get_potential_operators(
+            trg_points, sampler, ks, "treecode", operator_tol
+        )
+        ffat_map = (G1.matvec(dirichlet) - G0.matvec(neumann)).squeeze(-1)
+    else:
+        ffat_map = evaluate_potential(
+            trg_points, sampler, ks, dirichlet.squeeze(-1), neumann.squeeze(-1)
+        )
+    if return_info:
+        return ffat_map, convergence, info
+    return ffat_map, convergence
 
 
 def monte_carlo_solve(
@@ -97,18 +314,82 @@ def monte_carlo_solve(
     plot=False,
     check_converge=True,
     return_cost_time=False,
+    batch_step=8,
+    memory_budget=DENSE_MEMORY_BUDGET,
+    method="auto",
+    operator_tol=1e-4,
+    operator_cache_dir=None,
+    scratch_dir=None,
+    operator_precision="complex64",
+    krylov="bicgstab",
+    restart=30,
+    precond=None,
+    precond_side="right",
+    recycle=False,
+    sampler=None,
+    sample_cache=None,
+    importance=None,
+    sequence="random",
+    points_per_wavelength=None,
+    return_info=False,
 ):
-    sampler, sampler_cost_time = get_sampler(vertices, triangles, n)
+    """
+    sampler replaces the samples drawn on vertices and triangles, e.g. a Scene
+    whose intra-body operator blocks are reused across poses. sample_cache is
+    an optional SampleCache passed to get_sampler. importance="adaptive"
+    concentrates the samples around the vibrating triangles of neumann_tri,
+    see adaptive_importance, a tensor is used as the per-triangle importance.
+    sequence="sobol" or "stratified" draws the Poisson-disk candidates from a
+    quasi-Monte Carlo sequence instead of i.i.d. samples, see ImportanceSampler.
+    scratch_dir is where boundary operators beyond memory_budget are stored
+    out of core. operator_precision="bfloat16", "float16" or "int8" stores
+    the dense boundary weights in reduced precision, see precision_report.
+    With points_per_wavelength, every batch of modes is solved on the
+    coarsest nested subset of the n samples that still resolves its shortest
+    wavelength, see BandSamplers. recycle=True warm-starts every batch from
+    the earlier batches of this call, a RecycleSpace carries the solutions
+    across calls on the same samples, e.g. with sampler= over a sweep.
+    Modes that do not converge do not stop the sweep: convergence is whether
+    all modes converged, and with return_info a dict of per-mode iterations,
+    relative residuals, convergence flags and restarts is returned last.
+    """
+    if isinstance(importance, str) and importance == "adaptive":
+        importance = adaptive_importance(vertices, triangles, neumann_tri, ks)
+    elif isinstance(importance, str):
+        raise ValueError(f"unknown importance policy {importance}")
+    if sampler is None:
+        sampler, sampler_cost_time = get_sampler(
+            vertices, triangles, n, sample_cache, importance, sequence
+        )
+    else:
+        sampler_cost_time = 0
     print("sample points: ", sampler.num_samples)
     timer = Timer()
     idx = 0
-    batch_step = 8
     mode_num = len(ks)
-    ffat_map = torch.zeros(mode_num, len(trg_points), dtype=torch.complex64).cuda()
+    ffat_map = torch.zeros(
+        mode_num, len(trg_points), dtype=torch.complex64, device=trg_points.device
+    )
     neumann_tri = neumann_tri * 1e4
+    bands = None
+    if points_per_wavelength is not None and n > 0:
+        if hasattr(sampler, "boundary_operators"):
+            raise ValueError("points_per_wavelength is not supported for scenes")
+        bands = BandSamplers(sampler, n, points_per_wavelength)
+    # warm starts need the same samples, so each band has its own space
+    if isinstance(recycle, RecycleSpace):
+        if bands is not None:
+            raise ValueError("a RecycleSpace needs a single sample set")
+        recycle = {id(sampler): recycle}
+    else:
+        recycle = {} if recycle else None
+    infos = []
     while idx < mode_num:
-        ffat_map_batch, convergence = monte_carlo_sampler_solve(
-            sampler,
+        batch_sampler = sampler
+        if bands is not None:
+            batch_sampler = bands.get(ks[idx : idx + batch_step].max())
+        ffat_map_batch, _, info = monte_carlo_sampler_solve(
+            batch_sampler,
             neumann_tri[idx : idx + batch_step],
             ks[idx : idx + batch_step],
             trg_points,
@@ -116,15 +397,35 @@ def monte_carlo_solve(
             nsteps=nsteps,
             plot=plot and idx == 0,
             check_converge=check_converge,
+            memory_budget=memory_budget,
+            method=method,
+            operator_tol=operator_tol,
+            operator_cache_dir=operator_cache_dir,
+            scratch_dir=scratch_dir,
+            operator_precision=operator_precision,
+            krylov=krylov,
+            restart=restart,
+            precond=precond,
+            precond_side=precond_side,
+            recycle=(
+                None
+                if recycle is None
+                else recycle.setdefault(id(batch_sampler), RecycleSpace())
+            ),
+            return_info=True,
         )
-        if not convergence and check_converge:
-            return None, False
+        infos.append(info)
         ffat_map[idx : idx + batch_step] = ffat_map_batch
         idx += batch_step
+    info = {key: torch.cat([i[key] for i in infos]) for key in infos[0]}
+    convergence = bool(info["converged"].all())
     if return_cost_time:
-        return ffat_map.cpu().numpy() * 1e-4, timer.get_time() + sampler_cost_time
+        result = (ffat_map.cpu().numpy() * 1e-4, timer.get_time() + sampler_cost_time)
     else:
-        return ffat_map.cpu().numpy() * 1e-4, convergence
+        result = (ffat_map.cpu().numpy() * 1e-4, convergence)
+    if return_info:
+        return (*result, info)
+    return result
 
 
 def bem_solve(
@@ -0,0 +1,411 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from numba import njit, prange
+from .cpu_imp import green_func, green_func_ks, uniform_step, self_term
+from .treecode import ClusterTree
+
+# Hierarchical matrix of the Monte Carlo weights. Blocks of well separated
+# target / source clusters are compressed per wavenumber by adaptive cross
+# approximation (ACA) with partial pivoting, the remaining near field blocks
+# are stored dense. The operator can be saved and reloaded so that repeated
+# solves on the same samples and wavenumbers skip the assembly.
+
+# bumped whenever the weights change, so stale cached operators are rebuilt
+CACHE_VERSION = 2
+
+
+@njit()
+def _weight(
+    trgs,
+    srcs,
+    normals,
+    weights,
+    trg_ids,
+    src_ids,
+    radius,
+    boundary,
+    i,
+    j,
+    k,
+    deriv,
+):
+    if boundary and trg_ids[i] == src_ids[j]:
+        return self_term(k, radius[j], deriv)
+    return green_func(trgs[i], srcs[j], normals[j], k, deriv) * weights[j]
+
+
+@njit(parallel=True)
+def _dense_block(
+    trgs,
+    srcs,
+    normals,
+    weights,
+    trg_ids,
+    src_ids,
+    radius,
+    boundary,
+    ks,
+    dk,
+    deriv,
+    out,
+):
+    for i in prange(len(trgs)):
+        g = np.empty(len(ks), np.complex128)
+        for j in range(len(srcs)):
+            if boundary and trg_ids[i] == src_ids[j]:
+                for k_i in range(len(ks)):
+                    out[k_i, i, j] = self_term(ks[k_i], radius[j], deriv)
+                continue
+            green_func_ks(trgs[i], srcs[j], normals[j], ks, dk, deriv, g)
+            for k_i in range(len(ks)):
+                out[k_i, i, j] = g[k_i] * weights[j]
+
+
+@njit()
+def _aca(
+    trgs,
+    srcs,
+    normals,
+    weights,
+    trg_ids,
+    src_ids,
+    radius,
+    boundary,
+    k,
+    deriv,
+    tol,
+    max_rank,
+):
+    m, n = len(trgs), len(srcs)
+    U = np.zeros((max_rank, m), np.complex128)
+    V = np.zeros((max_rank, n), np.complex128)
+    used = np.zeros(m, np.bool_)
+    norm2 = 0.0
+    rank = 0
+    i = 0
+    while rank < max_rank:
+        used[i] = True
+        row = np.empty(n, np.complex128)
+        for j in range(n):
+            row[j] = _weight(
+                trgs,
+                srcs,
+                normals,
+                weights,
+                trg_ids,
+                src_ids,
+                radius,
+                boundary,
+                i,
+                j,
+                k,
+                deriv,
+            )
+        for l in range(rank):
+            row -= U[l, i] * V[l]
+        j = np.argmax(np.abs(row))
+        if np.abs(row[j]) == 0:
+            # zero residual row, try the next unused one
+            remaining = np.flatnonzero(~used)
+            if len(remaining) == 0:
+                return U[:rank], V[:rank], True
+            i = remaining[0]
+            continue
+        V[rank] = row / row[j]
+        for r in range(m):
+            U[rank, r] = _weight(
+                trgs,
+                srcs,
+                normals,
+                weights,
+                trg_ids,
+                src_ids,
+                radius,
+                boundary,
+                r,
+                j,
+                k,
+                deriv,
+            )
+        for l in range(rank):
+            U[rank] -= V[l, j] * U[l]
+        u_norm = np.sqrt((np.abs(U[rank]) ** 2).sum())
+        v_norm = np.sqrt((np.abs(V[rank]) ** 2).sum())
+        for l in range(rank):
+            norm2 += 2 * (np.vdot(U[l], U[rank]) * np.vdot(V[l], V[rank])).real
+        norm2 += (u_norm * v_norm) ** 2
+        rank += 1
+        if u_norm * v_norm <= tol * np.sqrt(norm2):
+            return U[:rank], V[:rank], True
+        candidates = np.abs(U[rank - 1]).copy()
+        candidates[used] = -1
+        i = np.argmax(candidates)
+        if candidates[i] < 0:
+            return U[:rank], V[:rank], True
+    return U[:rank], V[:rank], False
+
+
+def admissible(tree_t, t, tree_s, s, eta):
+    gap = np.maximum(
+        0, np.maximum(tree_s.lo[s] - tree_t.hi[t], tree_t.lo[t] - tree_s.hi[s])
+    )
+    dist = np.linalg.norm(gap)
+    diam = 2 * min(tree_t.radius[t], tree_s.radius[s])
+    return dist > 0 and diam <= eta * dist
+
+
+def block_cluster_tree(tree_t, tree_s, eta):
+    """
+    Split the (target, source) index space into admissible and near blocks.
+    """
+    far, near = [], []
+    stack = [(0, 0)]
+    while stack:
+        t, s = stack.pop()
+        t_leaf, s_leaf = tree_t.left[t] == -1, tree_s.left[s] == -1
+        if admissible(tree_t, t, tree_s, s, eta):
+            far.append((t, s))
+        elif t_leaf and s_leaf:
+            near.append((t, s))
+        elif t_leaf:
+            stack += [(t, tree_s.left[s]), (t, tree_s.right[s])]
+        elif s_leaf:
+            stack += [(tree_t.left[t], s), (tree_t.right[t], s)]
+        else:
+            for t_child in (tree_t.left[t], tree_t.right[t]):
+                for s_child in (tree_s.left[s], tree_s.right[s]):
+                    stack.append((t_child, s_child))
+    return far, near
+
+
+def csr_pattern(rows, cols, num_rows):
+    """
+    Row pointers, column indices and the entry order of a CSR matrix with
+    the given (unique) coordinates, shared by every mode of the batch.
+    """
+    order = np.lexsort((cols, rows))
+    crow = np.zeros(num_rows + 1, np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=crow[1:])
+    return torch.from_numpy(crow), torch.from_numpy(cols[order]), order
+
+
+def sparse_csr(crow, col, values, shape):
+    values = torch.from_numpy(np.ascontiguousarray(values, dtype=np.complex64))
+    return torch.sparse_csr_tensor(crow, col, values, shape)
+
+
+def operator_key(trg_points, sampler, ks, deriv, boundary, tol, eta, leaf_size):
+    h = hashlib.sha1()
+    for tensor in (
+        trg_points,
+        sampler.points,
+        sampler.points_normals,
+        sampler.points_importance,
+        torch.as_tensor(ks, dtype=torch.float32),
+    ):
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    h.update(
+        np.array(
+            [deriv, boundary, tol, eta, leaf_size, float(sampler.cdf[-1])]
+        ).tobytes()
+    )
+    h.update(np.array([CACHE_VERSION]).tobytes())
+    return h.hexdigest()
+
+
+class HMatrixOperator:
+    """
+    H-matrix approximation of the Monte Carlo weight matrix (batch, Ntrg, M)
+    with relative block accuracy tol.
+    """
+
+    def __init__(
+        self,
+        trg_points,
+        sampler,
+        ks,
+        deriv=False,
+        boundary=False,
+        tol=1e-4,
+        eta=1.0,
+        leaf_size=64,
+    ):
+        self.device = sampler.points.device
+        ks = np.asarray(torch.as_tensor(ks).cpu(), dtype=np.float64).reshape(-1)
+        src_tree = ClusterTree(sampler.points.detach().cpu().numpy(), leaf_size)
+        trg_tree = (
+            src_tree
+            if boundary
+            else ClusterTree(trg_points.detach().cpu().numpy(), leaf_size)
+        )
+        trgs = trg_tree.points[trg_tree.perm]
+        srcs = src_tree.points[src_tree.perm]
+        normals = sampler.points_normals.detach().cpu().double().numpy()[src_tree.perm]
+        importance = (
+            sampler.points_importance.detach().cpu().double().numpy()[src_tree.perm]
+        )
+        cdf_sum = float(sampler.cdf[-1])
+        M = len(srcs)
+        weights = cdf_sum / importance / M * (2 if boundary else 1)
+        radius = np.sqrt(cdf_sum / (np.pi * importance * M))
+        far, near = block_cluster_tree(trg_tree, src_tree, eta)
+        dk = uniform_step(ks)
+
+        def block_args(t, s):
+            ts, te = int(trg_tree.start[t]), int(trg_tree.end[t])
+            ss, se = int(src_tree.start[s]), int(src_tree.end[s])
+            return (ts, te, ss, se), (
+                trgs[ts:te],
+                srcs[ss:se],
+                normals[ss:se],
+                weights[ss:se],
+                trg_tree.perm[ts:te],
+                src_tree.perm[ss:se],
+                radius[ss:se],
+                boundary,
+            )
+
+        def dense(span, args):
+            ts, te, ss, se = span
+            out = np.empty((len(ks), te - ts, se - ss), np.complex64)
+            _dense_block(*args, ks, dk, deriv, out)
+            near_blocks.append((span, out))
+
+        near_blocks = []
+        low_rank_blocks = [[] for _ in ks]
+        for t, s in near:
+            dense(*block_args(t, s))
+        for t, s in far:
+            span, args = block_args(t, s)
+            m, n = span[1] - span[0], span[3] - span[2]
+            max_rank = max(1, m * n // (m + n))
+            factors = []
+            for k in ks:
+                U, V, converged = _aca(*args, k, deriv, tol, max_rank)
+                if not converged:
+                    break
+                factors.append((U.T, V))
+            if len(factors) < len(ks):
+                dense(span, args)
+                continue
+            for b, (U, V) in enumerate(factors):
+                low_rank_blocks[b].append((span, U, V))
+        N = len(trgs)
+        self.shape = (len(ks), N, M)
+        # near field blocks share one sparsity pattern across the batch
+        rows, cols, values = [], [], []
+        for (ts, te, ss, se), D in near_blocks:
+            rows.append(np.repeat(trg_tree.perm[ts:te], se - ss))
+            cols.append(np.tile(src_tree.perm[ss:se], te - ts))
+            values.append(D.reshape(len(ks), -1))
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        values = np.concatenate(values, axis=1)
+        del near_blocks
+        crow, col, order = csr_pattern(rows, cols, N)
+        self.near = [
+            sparse_csr(crow, col, values[b, order], (N, M)).to(self.device)
+            for b in range(len(ks))
+        ]
+        del values
+        # far field of mode b as U (N, R) @ V (R, M) with block sparse factors
+        self.U, self.V = [], []
+        for blocks in low_rank_blocks:
+            U_rows, U_cols, U_values = [], [], []
+            V_rows, V_cols, V_values = [], [], []
+            offset = 0
+            for (ts, te, ss, se), U, V in blocks:
+                r = U.shape[1]
+                U_rows.append(np.repeat(trg_tree.perm[ts:te], r))
+                U_cols.append(np.tile(np.arange(offset, offset + r), te - ts))
+                U_values.append(U.reshape(-1))
+                V_rows.append(np.repeat(np.arange(offset, offset + r), se - ss))
+                V_cols.append(np.tile(src_tree.perm[ss:se], r))
+                V_values.append(V.reshape(-1))
+                offset += r
+            concat = lambda arrays, dtype: np.concatenate(arrays + [np.zeros(0, dtype)])
+            crow, col, order = csr_pattern(
+                concat(U_rows, np.int64), concat(U_cols, np.int64), N
+            )
+            U_values = concat(U_values, np.complex128)[order]
+            self.U.append(sparse_csr(crow, col, U_values, (N, offset)).to(self.device))
+            crow, col, order = csr_pattern(
+                concat(V_rows, np.int64), concat(V_cols, np.int64), offset
+            )
+            V_values = concat(V_values, np.complex128)[order]
+            self.V.append(sparse_csr(crow, col, V_values, (offset, M)).to(self.device))
+
+    def compression_rate(self):
+        stored = sum(A._nnz() for A in self.near + self.U + self.V)
+        return stored / np.prod(self.shape)
+
+    def matvec(self, x, modes=None):
+        modes = range(self.shape[0]) if modes is None else [int(m) for m in modes]
+        y = torch.empty(
+            x.shape[0], self.shape[1], x.shape[2], dtype=x.dtype, device=x.device
+        )
+        for i, b in enumerate(modes):
+            y[i] = self.near[b] @ x[i] + self.U[b] @ (self.V[b] @ x[i])
+        return y
+
+    def save(self, path):
+        def parts(A):
+            return [A.crow_indices(), A.col_indices(), A.values(), list(A.shape)]
+
+        torch.save(
+            {
+                "shape": list(self.shape),
+                "near": [parts(A.cpu()) for A in self.near],
+                "U": [parts(A.cpu()) for A in self.U],
+                "V": [parts(A.cpu()) for A in self.V],
+            },
+            path,
+        )
+
+    @staticmethod
+    def load(path, device="cpu"):
+        data = torch.load(path)
+
+        def rebuild(parts):
+            crow, col, values, shape = parts
+            return torch.sparse_csr_tensor(crow, col, values, shape).to(device)
+
+        op = HMatrixOperator.__new__(HMatrixOperator)
+        op.device = torch.device(device)
+        op.shape = tuple(data["shape"])
+        op.near = [rebuild(parts) for parts in data["near"]]
+        op.U = [rebuild(parts) for parts in data["U"]]
+        op.V = [rebuild(parts) for parts in data["V"]]
+        return op
+
+    @staticmethod
+    def cached(
+        cache_dir,
+        trg_points,
+        sampler,
+        ks,
+        deriv=False,
+        boundary=False,
+        tol=1e-4,
+        eta=1.0,
+        leaf_size=64,
+    ):
+        """
+        Load the operator for these samples and wavenumbers from cache_dir, or
+        build and store it there.
+        """
+        key = operator_key(
+            trg_points, sampler, ks, deriv, boundary, tol, eta, leaf_size
+        )
+        path = os.path.join(cache_dir, f"hmatrix_{key}.pt")
+        if os.path.exists(path):
+            return HMatrixOperator.load(path, sampler.points.device)
+        op = HMatrixOperator(
+            trg_points, sampler, ks, deriv, boundary, tol, eta, leaf_size
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        op.save(tmp_path)
+        os.replace(tmp_path, path)
+        return op
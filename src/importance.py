@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+from .cuda_imp import ImportanceSampler
+
+# Per-triangle sampling importance. The field is driven by the vibrating
+# triangles and scattered by the surface around them, and the scattered part
+# decays over a wavelength, so triangles far from any vibration (e.g. a static
+# table) get fewer samples. The Monte Carlo weights divide by the importance,
+# so the estimate stays unbiased for any positive importance.
+
+
+def triangle_areas(vertices, triangles):
+    t = triangles.long()
+    v0, v1, v2 = vertices[t[:, 0]], vertices[t[:, 1]], vertices[t[:, 2]]
+    return 0.5 * torch.linalg.norm(torch.cross(v1 - v0, v2 - v0, dim=1), dim=1)
+
+
+def adaptive_importance(
+    vertices, triangles, neumann_tri, ks, floor=0.05, tol=1e-2, chunk_size=4096
+):
+    """
+    Importance floor + (1 - floor) * max_s a_s exp(-|c_t - c_s| / lambda) of
+    every triangle t, where a_s is the |Neumann| of triangle s over the modes
+    relative to its maximum, c the triangle centroids and lambda the longest
+    wavelength of ks. Triangles with a_s < tol are not treated as sources.
+    """
+    device = vertices.device
+    a = neumann_tri.abs().reshape(-1, len(triangles)).amax(0).float()
+    a = a / a.max().clamp(min=1e-30)
+    centroids = vertices[triangles.long()].mean(1)
+    src = torch.nonzero(a >= tol).squeeze(-1)
+    if len(src) == 0:
+        return torch.ones(len(triangles), dtype=torch.float32, device=device)
+    wavelength = 2 * np.pi / float(torch.as_tensor(ks).min())
+    near = torch.empty(len(triangles), dtype=torch.float32, device=device)
+    for start in range(0, len(triangles), chunk_size):
+        d = torch.cdist(centroids[start : start + chunk_size], centroids[src])
+        near[start : start + chunk_size] = (a[src] * torch.exp(-d / wavelength)).amax(1)
+    return floor + (1 - floor) * near
+
+
+def quantize_importance(importance, max_levels=8):
+    """
+    Round the importance to powers of two relative to its maximum, at most
+    max_levels distinct values.
+    """
+    importance = importance / importance.max()
+    level = torch.round(-torch.log2(importance)).clamp(0, max_levels - 1)
+    return 2.0 ** (-level)
+
+
+def poisson_importance_sampler(
+    vertices,
+    triangles,
+    importance,
+    n,
+    num_candidates=50000,
+    seed=None,
+    sequence="random",
+):
+    """
+    Poisson-disk samples with a density proportional to importance. The
+    resampling radius is fixed per kernel call, so the importance is
+    quantized and every level is resampled on its own with the radius
+    r / sqrt(level), about n samples in total. The candidates of every level
+    are drawn from sequence, level i with the seed seed + i.
+    """
+    importance = quantize_importance(importance).float()
+    area = triangle_areas(vertices, triangles)
+    total = float((area * importance).sum())
+    r = (total / (2 * n)) ** 0.5
+    parts = []
+    for i, level in enumerate(torch.unique(importance)):
+        tri_ids = torch.nonzero(importance == level).squeeze(-1)
+        share = float((area[tri_ids] * level).sum()) / total
+        sub = ImportanceSampler(
+            vertices,
+            triangles[tri_ids].contiguous(),
+            torch.ones(len(tri_ids), dtype=torch.float32, device=vertices.device),
+            max(1000, int(num_candidates * share)),
+            seed=None if seed is None else seed + i,
+            sequence=sequence,
+        )
+        sub.update()
+        sub.poisson_disk_resample(r / float(level) ** 0.5, 4)
+        parts.append((sub, tri_ids, level))
+    num_samples = sum(int(sub.num_samples) for sub, _, _ in parts)
+    sampler = ImportanceSampler(
+        vertices, triangles, importance, num_samples, sequence=sequence
+    )
+    sampler.points = torch.cat([sub.points for sub, _, _ in parts])
+    sampler.points_normals = torch.cat([sub.points_normals for sub, _, _ in parts])
+    sampler.points_importance = torch.cat(
+        [torch.full_like(sub.points_importance, level) for sub, _, level in parts]
+    )
+    sampler.points_index = torch.cat(
+        [tri_ids[sub.points_index.long()].int() for sub, tri_ids, _ in parts]
+    )
+    sampler.points_neumann = sampler.triangle_neumann[sampler.points_index.long()]
+    sampler.num_samples = num_samples
+    return sampler
@@ -0,0 +1,440 @@
+import numpy as np
+import torch
+from .cuda_imp import MonteCarloWeight, get_backend, get_weights_potential_ks_base
+
+EPS = 1e-3
+# Dense (batch, N, N) weights of G0 and G1 are only materialized below this size.
+DENSE_MEMORY_BUDGET = 8 * 1024**3
+# Bytes of kernel values evaluated at once by the tiled matrix-free matvec.
+TILE_BYTES = 64 * 1024**2
+# Bytes per stored weight of the dense boundary operators.
+PRECISION_BYTES = {"complex64": 8, "bfloat16": 4, "float16": 4, "int8": 2}
+
+
+def green_func_tile(trg_points, src_points, src_normals, ks, deriv):
+    """
+    Green's function values of shape (batch, Ntrg, Nsrc), matching Green_func
+    in src/cuda/bind.cu.
+    """
+    d = src_points.unsqueeze(0) - trg_points.unsqueeze(1)
+    r = torch.linalg.norm(d, dim=-1)
+    near = r < EPS
+    ikr = 1j * ks.reshape(-1, 1, 1) * r
+    if deriv:
+        dot = (d * src_normals.unsqueeze(0)).sum(-1)
+        weight = -torch.exp(ikr) / (4 * np.pi * r**3) * (1 - ikr) * dot
+        return weight.masked_fill(near, 0)
+    return torch.exp(ikr) / (4 * np.pi * torch.where(near, 1.0, r))
+
+
+def boundary_src_weights(sampler):
+    M = sampler.num_samples
+    return 2 * sampler.cdf[-1] / sampler.points_importance / M
+
+
+def boundary_self_terms(sampler, ks, deriv):
+    """
+    Diagonal (batch, N) of the boundary weights: twice the Green's function
+    integrated over the disc of the area each sample stands for, matching
+    self_term in src/cpu_imp.py.
+    """
+    M = sampler.num_samples
+    radius = torch.sqrt(sampler.cdf[-1] / (np.pi * sampler.points_importance * M))
+    if deriv:
+        return torch.zeros(
+            len(ks), M, dtype=torch.complex64, device=sampler.points.device
+        )
+    k = ks.reshape(-1, 1)
+    return (torch.exp(1j * k * radius) - 1) / (1j * k)
+
+
+def boundary_weight_tile(sampler, ks, start, end, deriv, self_terms):
+    """
+    Rows start:end of the boundary weights, of shape (batch, end - start, N).
+    """
+    # potential weights cdf / imp / N rescaled to the boundary weights
+    tile = get_weights_potential_ks_base(
+        ks,
+        sampler.points[start:end],
+        sampler.points,
+        sampler.points_normals,
+        sampler.points_importance,
+        sampler.cdf[-1],
+        deriv,
+    ).mul_(2)
+    rows = torch.arange(end - start, device=tile.device)
+    tile[:, rows, rows + start] = self_terms[:, start:end]
+    return tile
+
+
+class DenseOperator:
+    """
+    Operator backed by explicit (batch, Ntrg, Nsrc) weights.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.shape = weights.shape
+
+    @staticmethod
+    def boundary(sampler, ks, deriv=False, precision="complex64"):
+        if precision != "complex64":
+            return QuantizedOperator.boundary(sampler, ks, deriv, precision)
+        constructor = MonteCarloWeight(sampler.points, sampler, deriv=deriv)
+        return DenseOperator(constructor.get_weights_boundary_ks(ks))
+
+    def matvec(self, x, modes=None):
+        """
+        Product with x of shape (batch, Nsrc, C), or with x of shape
+        (len(modes), Nsrc, C) for the listed modes only.
+        """
+        if modes is None:
+            return torch.bmm(self.weights, x)
+        return torch.stack([self.weights[m] @ x[i] for i, m in enumerate(modes)])
+
+
+class QuantizedOperator:
+    """
+    Dense operator with the weights stored in reduced precision, the real and
+    imaginary parts as bfloat16 / float16 pairs or as int8 scaled by the
+    largest part of every group of group_size columns of a row. The
+    Green's kernel spans orders of magnitude along a row, so one scale per
+    row would round most far-field weights to zero. The matvec dequantizes
+    row tiles to complex64 and accumulates in fp32.
+    """
+
+    def __init__(self, shape, precision, device, group_size=64, tile_bytes=TILE_BYTES):
+        if precision not in ("bfloat16", "float16", "int8"):
+            raise ValueError(f"unknown weight precision {precision}")
+        B, N, M = shape
+        self.shape = shape
+        self.precision = precision
+        # columns padded to whole groups, the padding stays zero
+        self.group_size = group_size if precision == "int8" else M
+        G = (M + self.group_size - 1) // self.group_size
+        dtype = torch.int8 if precision == "int8" else getattr(torch, precision)
+        self.values = torch.zeros(
+            B, N, G, self.group_size, 2, dtype=dtype, device=device
+        )
+        self.scale = None
+        if precision == "int8":
+            self.scale = torch.empty(B, N, G, 1, 1, dtype=torch.float32, device=device)
+        # complex64 tile plus the float parts it is dequantized from
+        self.tile_size = max(1, int(tile_bytes // (B * M * 8 * 2)))
+
+    @staticmethod
+    def boundary(sampler, ks, deriv=False, precision="bfloat16"):
+        ks = torch.as_tensor(ks, dtype=torch.float32, device=sampler.points.device)
+        N = sampler.num_samples
+        op = QuantizedOperator((len(ks), N, N), precision, sampler.points.device)
+        self_terms = boundary_self_terms(sampler, ks, deriv)
+        for start in range(0, N, op.tile_size):
+            end = min(start + op.tile_size, N)
+            tile = boundary_weight_tile(sampler, ks, start, end, deriv, self_terms)
+            op.store(start, end, tile)
+        return op
+
+    def store(self, start, end, weights):
+        B, _, M = weights.shape
+        G = self.values.shape[2]
+        parts = torch.view_as_real(weights)
+        parts = torch.nn.functional.pad(parts, (0, 0, 0, G * self.group_size - M))
+        parts = parts.reshape(B, end - start, G, self.group_size, 2)
+        if self.scale is None:
+            self.values[:, start:end] = parts
+            return
+        scale = parts.abs().amax(dim=(3, 4), keepdim=True).clamp(min=1e-30) / 127
+        self.scale[:, start:end] = scale
+        self.values[:, start:end] = torch.round(parts / scale)
+
+    def dequantize(self, start, end, modes=None):
+        """
+        Rows start:end as complex64 of shape (batch, end - start, Mpad) with
+        the columns padded to whole groups.
+        """
+        values = self.values[:, start:end]
+        if modes is not None:
+            values = values[modes]
+        parts = values.float()
+        if self.scale is not None:
+            scale = self.scale[:, start:end]
+            parts *= scale if modes is None else scale[modes]
+        return torch.view_as_complex(parts.flatten(2, 3))
+
+    def nbytes(self):
+        nbytes = self.values.numel() * self.values.element_size()
+        if self.scale is not None:
+            nbytes += self.scale.numel() * self.scale.element_size()
+        return nbytes
+
+    def matvec(self, x, modes=None):
+        """
+        Product with x of shape (batch, Nsrc, C), or with x of shape
+        (len(modes), Nsrc, C) for the listed modes only.
+        """
+        N, M = self.shape[1:]
+        padding = self.values.shape[2] * self.group_size - M
+        x_pad = torch.nn.functional.pad(x, (0, 0, 0, padding))
+        y = x.new_empty(x.shape[0], N, x.shape[2])
+        for start in range(0, N, self.tile_size):
+            end = min(start + self.tile_size, N)
+            y[:, start:end] = torch.bmm(self.dequantize(start, end, modes), x_pad)
+        return y
+
+
+def precision_report(sampler, ks, precisions=("bfloat16", "float16", "int8")):
+    """
+    Relative matvec error against the complex64 weights and the storage
+    ratio of each reduced precision, as {precision: {"G0": err, "G1": err,
+    "bytes": ratio}}. The matvecs are applied to random complex vectors.
+    """
+    ks = torch.as_tensor(ks, dtype=torch.float32, device=sampler.points.device)
+    N = sampler.num_samples
+    x = torch.randn(len(ks), N, 1, dtype=torch.complex64, device=ks.device)
+    report = {p: {} for p in precisions}
+    for name, deriv in (("G0", False), ("G1", True)):
+        y = DenseOperator.boundary(sampler, ks, deriv).matvec(x)
+        for precision in precisions:
+            op = QuantizedOperator.boundary(sampler, ks, deriv, precision)
+            error = (op.matvec(x) - y).norm() / y.norm()
+            report[precision][name] = float(error)
+            report[precision]["bytes"] = op.nbytes() / (len(ks) * N * N * 8)
+    return report
+
+
+class MatrixFreeOperator:
+    """
+    Boundary operator of the Monte Carlo weights that never stores them. The
+    Green's kernel is re-evaluated in row tiles on every matvec, so memory is
+    O(N * batch) instead of O(N^2 * batch).
+    """
+
+    def __init__(self, sampler, ks, deriv=False, tile_bytes=TILE_BYTES):
+        self.sampler = sampler
+        self.points = sampler.points
+        self.ks = torch.as_tensor(ks, dtype=torch.float32, device=self.points.device)
+        self.deriv = deriv
+        N = sampler.num_samples
+        self.shape = (len(self.ks), N, N)
+        self.backend = get_backend(self.points)
+        self.kernel_name = "monte_carlo_matvec_boundary" + str(int(deriv))
+        # complex kernel values plus the distance / phase temporaries
+        self.tile_size = max(1, int(tile_bytes // (len(self.ks) * N * 8 * 4)))
+        self.src_weights = boundary_src_weights(sampler)
+
+    def matvec(self, x, modes=None):
+        ks = self.ks if modes is None else self.ks[modes]
+        if self.backend.has(self.kernel_name):
+            return self.backend.get(self.kernel_name)(
+                self.points,
+                self.points,
+                self.sampler.points_normals,
+                self.sampler.points_importance,
+                ks,
+                self.sampler.cdf[-1],
+                x,
+            )
+        N = self.shape[1]
+        y = torch.empty_like(x)
+        self_terms = boundary_self_terms(self.sampler, ks, self.deriv)
+        for start in range(0, N, self.tile_size):
+            end = min(start + self.tile_size, N)
+            G = green_func_tile(
+                self.points[start:end],
+                self.points,
+                self.sampler.points_normals,
+                ks,
+                self.deriv,
+            )
+            G *= self.src_weights
+            rows = torch.arange(end - start, device=x.device)
+            G[:, rows, rows + start] = self_terms[:, start:end]
+            y[:, start:end] = torch.bmm(G, x)
+        return y
+
+
+class NearFieldPreconditioner:
+    """
+    Block-Jacobi preconditioner of the boundary system (G1 - I) x = b. The
+    samples are grouped into spatially compact clusters (the leaves of a
+    kd-tree), and the near-field block of G1 - I between the samples of each
+    cluster is inverted once for every wavenumber of the batch.
+    """
+
+    def __init__(self, sampler, ks, leaf_size=128):
+        from .treecode import ClusterTree
+
+        points = sampler.points
+        device = points.device
+        tree = ClusterTree(points.detach().cpu().numpy(), leaf_size)
+        leaves = np.flatnonzero(tree.left == -1)
+        size = int((tree.end[leaves] - tree.start[leaves]).max())
+        N = sampler.num_samples
+        # (leaf, size) sample indices, padded with the dummy index N
+        index = np.full((len(leaves), size), N)
+        for i, leaf in enumerate(leaves):
+            members = tree.perm[tree.start[leaf] : tree.end[leaf]]
+            index[i, : len(members)] = members
+        self.index = torch.from_numpy(index).to(device)
+        self.N = N
+        ks = torch.as_tensor(ks, dtype=torch.float32, device=device)
+        src_weights = boundary_src_weights(sampler)
+        eye = torch.eye(size, dtype=torch.complex64, device=device)
+        blocks = eye.repeat(len(ks), len(leaves), 1, 1)
+        for i, leaf in enumerate(leaves):
+            members = self.index[i, : tree.end[leaf] - tree.start[leaf]]
+            n = len(members)
+            G = green_func_tile(
+                points[members],
+                points[members],
+                sampler.points_normals[members],
+                ks,
+                deriv=True,
+            )
+            # the diagonal of G1 vanishes, G(r < EPS) = 0 for the double layer
+            blocks[:, i, :n, :n] = G * src_weights[members] - eye[:n, :n]
+        self.inv_blocks = torch.linalg.inv(blocks)
+
+    def apply(self, x, modes=None):
+        """
+        Apply the block inverse to x of shape (batch, N, C), or of shape
+        (len(modes), N, C) for the listed modes only.
+        """
+        inv_blocks = self.inv_blocks if modes is None else self.inv_blocks[modes]
+        B, N, C = x.shape
+        x = torch.cat([x, x.new_zeros(B, 1, C)], dim=1)
+        y = inv_blocks @ x[:, self.index]
+        out = x.new_empty(B, N + 1, C)
+        out[:, self.index.flatten()] = y.reshape(B, -1, C)
+        return out[:, :N]
+
+
+def dense_boundary_bytes(num_samples, batch_size, precision="complex64"):
+    # G0 and G1 of shape (batch, N, N)
+    return 2 * batch_size * int(num_samples) ** 2 * PRECISION_BYTES[precision]
+
+
+def get_boundary_operators(
+    sampler,
+    ks,
+    memory_budget=DENSE_MEMORY_BUDGET,
+    method="auto",
+    tol=1e-4,
+    cache_dir=None,
+    scratch_dir=None,
+    precision="complex64",
+):
+    """
+    Return the (G0, G1) boundary operators. method is one of "dense",
+    "matrix_free", "out_of_core", "treecode", "hmatrix", "scene" or "auto",
+    which picks the blockwise operators of a Scene, dense if both fit into
+    memory_budget bytes, out-of-core if a scratch_dir is given and
+    matrix-free otherwise. tol is the relative accuracy of the treecode and
+    H-matrix, cache_dir is where H-matrices are stored for reuse and
+    scratch_dir where the out-of-core weights are written. precision is the
+    storage of the dense weights, one of PRECISION_BYTES, see
+    QuantizedOperator.
+    """
+    if method == "auto" and hasattr(sampler, "boundary_operators"):
+        method = "scene"
+    if method == "scene":
+        return sampler.boundary_operators(ks)
+    if method == "auto":
+        dense_bytes = dense_boundary_bytes(sampler.num_samples, len(ks), precision)
+        if dense_bytes <= memory_budget:
+            method = "dense"
+        elif scratch_dir is not None:
+            method = "out_of_core"
+        else:
+            method = "matrix_free"
+    if method == "dense":
+        return (
+            DenseOperator.boundary(sampler, ks, False, precision),
+            DenseOperator.boundary(sampler, ks, True, precision),
+        )
+    if method == "matrix_free":
+        return (
+            MatrixFreeOperator(sampler, ks, deriv=False),
+            MatrixFreeOperator(sampler, ks, deriv=True),
+        )
+    if method == "out_of_core":
+        from .out_of_core import OutOfCoreOperator
+
+        return (
+            OutOfCoreOperator(sampler, ks, deriv=False, scratch_dir=scratch_dir),
+            OutOfCoreOperator(sampler, ks, deriv=True, scratch_dir=scratch_dir),
+        )
+    if method == "treecode":
+        return (
+            MonteCarloWeight(sampler.points, sampler).get_treecode_boundary_ks(ks, tol),
+            MonteCarloWeight(
+                sampler.points, sampler, deriv=True
+            ).get_treecode_boundary_ks(ks, tol),
+        )
+    if method == "hmatrix":
+        return (
+            MonteCarloWeight(sampler.points, sampler).get_hmatrix_boundary_ks(
+                ks, tol, cache_dir
+            ),
+            MonteCarloWeight(
+                sampler.points, sampler, deriv=True
+            ).get_hmatrix_boundary_ks(ks, tol, cache_dir),
+        )
+    raise ValueError(f"unknown boundary operator method {method}")
+
+
+def evaluate_potential(
+    trg_points, sampler, ks, dirichlet, neumann, tile_bytes=TILE_BYTES
+):
+    """
+    Field G1 dirichlet - G0 neumann of shape (batch, Ntrg) at trg_points for
+    sample densities of shape (batch, M). The weights are evaluated on the fly
+    in target tiles, so peak memory does not grow with Ntrg * M.
+    """
+    ks = torch.as_tensor(ks, dtype=torch.float32, device=sampler.points.device)
+    backend = get_backend(sampler.points)
+    if backend.has("monte_carlo_potential"):
+        return backend.get("monte_carlo_potential")(
+            trg_points,
+            sampler.points,
+            sampler.points_normals,
+            sampler.points_importance,
+            ks,
+            sampler.cdf[-1],
+            dirichlet,
+            neumann,
+        )
+    M = sampler.num_samples
+    src_weights = sampler.cdf[-1] / sampler.points_importance / M
+    dirichlet = (dirichlet * src_weights).unsqueeze(-1)
+    neumann = (neumann * src_weights).unsqueeze(-1)
+    # two complex kernel tiles plus the distance / phase temporaries
+    tile_size = max(1, int(tile_bytes // (len(ks) * M * 8 * 6)))
+    out = torch.empty(
+        len(ks), len(trg_points), dtype=torch.complex64, device=trg_points.device
+    )
+    for start in range(0, len(trg_points), tile_size):
+        trgs = trg_points[start : start + tile_size]
+        normals = sampler.points_normals
+        G0 = green_func_tile(trgs, sampler.points, normals, ks, False)
+        G1 = green_func_tile(trgs, sampler.points, normals, ks, True)
+        field = torch.bmm(G1, dirichlet) - torch.bmm(G0, neumann)
+        out[:, start : start + tile_size] = field.squeeze(-1)
+    return out
+
+
+def get_potential_operators(trg_points, sampler, ks, method="dense", tol=1e-4):
+    """
+    Return the (G0, G1) operators from the samples to trg_points.
+    """
+    G0_constructor = MonteCarloWeight(trg_points, sampler)
+    G1_constructor = MonteCarloWeight(trg_points, sampler, deriv=True)
+    if method == "treecode":
+        return (
+            G0_constructor.get_treecode_potential_ks(ks, tol),
+            G1_constructor.get_treecode_potential_ks(ks, tol),
+        )
+    return (
+        DenseOperator(G0_constructor.get_weights_potential_ks(ks)),
+        DenseOperator(G1_constructor.get_weights_potential_ks(ks)),
+    )
@@ -1,7 +1,9 @@
 import os
 import numpy as np
+import scipy.sparse
 from torch.utils.cpp_extension import load
 import torch
+from numba import njit
 
 
 def scipy2torch(M, device="cuda"):
@@ -13,6 +15,17 @@ def scipy2torch(M, device="cuda"):
     return M_torch.coalesce()
 
 
+def csr2torch(M, device="cpu"):
+    M = M.tocsr()
+    return torch.sparse_csr_tensor(
+        torch.from_numpy(M.indptr).long(),
+        torch.from_numpy(M.indices).long(),
+        torch.from_numpy(M.data).float(),
+        size=M.shape,
+        device=device,
+    )
+
+
 def LOBPCG_solver(stiff_matrix, mass_matrix, k):
     vals, vecs = torch.lobpcg(
         stiff_matrix, 6 + k, mass_matrix, tracker=None, largest=False
@@ -78,29 +91,169 @@ class Material(object):
         ) ** 0.5
 
 
-cuda_dir = os.path.dirname(__file__) + "/cuda"
-cuda_include_dir = cuda_dir + "/include"
-os.environ["TORCH_EXTENSIONS_DIR"] = cuda_dir + "/build"
-src_file = cuda_dir + "/computeMatrix.cu"
-cuda_module = load(
-    name="matrixAssemble",
-    sources=[src_file],
-    extra_include_paths=[cuda_include_dir],
-    # extra_cuda_cflags=['-O3'],
-    # extra_cuda_cflags=['-G -g'],
-    #    verbose=True,
-)
+class MATRIX_ASSEMBLE_MODULE:
+    # the FEM assembly extension, compiled on first use like the BEM
+    # extension in src/cuda_imp.py
+    _module = None
+
+    @staticmethod
+    def get(name):
+        if MATRIX_ASSEMBLE_MODULE._module is None:
+            MATRIX_ASSEMBLE_MODULE.load()
+        return getattr(MATRIX_ASSEMBLE_MODULE._module, name)
+
+    @staticmethod
+    def load():
+        cuda_dir = os.path.dirname(__file__) + "/cuda"
+        cuda_include_dir = cuda_dir + "/include"
+        os.environ["TORCH_EXTENSIONS_DIR"] = cuda_dir + "/build"
+        src_file = cuda_dir + "/computeMatrix.cu"
+        MATRIX_ASSEMBLE_MODULE._module = load(
+            name="matrixAssemble",
+            sources=[src_file],
+            extra_include_paths=[cuda_include_dir],
+            # extra_cuda_cflags=['-O3'],
+            # extra_cuda_cflags=['-G -g'],
+            #    verbose=True,
+        )
+        return MATRIX_ASSEMBLE_MODULE._module
+
+
+@njit
+def _scatter_mass(volumes, pair_index, density, blocks):
+    # linear tet element mass V (1 + delta_ij) / 20 of every vertex pair
+    for t in range(len(volumes)):
+        for i in range(4):
+            for j in range(4):
+                m = density * volumes[t] * (2.0 if i == j else 1.0) / 20
+                p = pair_index[t, i * 4 + j]
+                for a in range(3):
+                    blocks[p, a, a] += m
+
+
+@njit
+def _scatter_stiffness(volumes, grads, pair_index, lam, mu, blocks):
+    # V B_i^T D B_j = V (lam g_i g_j^T + mu g_j g_i^T + mu (g_i . g_j) I)
+    for t in range(len(volumes)):
+        V = volumes[t]
+        for i in range(4):
+            for j in range(4):
+                p = pair_index[t, i * 4 + j]
+                dot = 0.0
+                for c in range(3):
+                    dot += grads[t, i, c] * grads[t, j, c]
+                for a in range(3):
+                    blocks[p, a, a] += V * mu * dot
+                    for b in range(3):
+                        blocks[p, a, b] += V * (
+                            lam * grads[t, i, a] * grads[t, j, b]
+                            + mu * grads[t, i, b] * grads[t, j, a]
+                        )
+
+
+class TetAssembler:
+    """
+    CPU assembly of the linear tet mass and stiffness matrices into CSR. The
+    sparsity pattern and the shape function gradients only depend on the
+    mesh, so they are computed once and every assembly for a new material is
+    one pass over the tets scattering into the CSR values. The 3x3 blocks of
+    a vertex pair are contiguous in the pattern, so it is built over the 16
+    vertex pairs of each tet instead of its 144 entries.
+    """
+
+    def __init__(self, vertices, tets):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        tets = np.asarray(tets, dtype=np.int64)
+        self.num_dofs = 3 * len(vertices)
+        edges = vertices[tets[:, 1:]] - vertices[tets[:, :1]]
+        self.volumes = np.abs(np.linalg.det(edges)) / 6
+        # gradients of the barycentric coordinates, (T, 4, 3)
+        grads = np.linalg.inv(edges).transpose(0, 2, 1)
+        self.grads = np.concatenate([-grads.sum(1, keepdims=True), grads], axis=1)
+        # unique vertex pairs in row-major order and the pair of every
+        # (tet, i, j) entry
+        n = len(vertices)
+        pairs = (tets[:, :, None] * n + tets[:, None, :]).reshape(-1)
+        keys, pair_index = np.unique(pairs, return_inverse=True)
+        self.pair_index = pair_index.reshape(len(tets), 16).astype(np.int32)
+        self.num_pairs = len(keys)
+        pair_rows, pair_cols = keys // n, keys % n
+        vptr = np.concatenate([[0], np.cumsum(np.bincount(pair_rows, minlength=n))])
+        degree = np.diff(vptr)[pair_rows]
+        position = np.arange(len(keys)) - vptr[pair_rows]
+        # CSR slot of component (a, b) of every vertex pair block
+        a = np.arange(3)[:, None]
+        b = np.arange(3)[None, :]
+        self.csr_slot = (
+            9 * vptr[pair_rows, None, None]
+            + 3 * degree[:, None, None] * a
+            + 3 * position[:, None, None]
+            + b
+        ).reshape(-1)
+        self.indptr = np.concatenate(
+            [[0], np.repeat(3 * np.diff(vptr), 3).cumsum()]
+        ).astype(np.int64)
+        cols = np.broadcast_to(3 * pair_cols[:, None, None] + b, (len(keys), 3, 3))
+        self.indices = np.empty(9 * len(keys), dtype=np.int32)
+        self.indices[self.csr_slot] = cols.reshape(-1)
+        self.stiffness_cache = {}
+
+    def to_csr(self, blocks):
+        data = np.empty(len(self.csr_slot))
+        data[self.csr_slot] = blocks.reshape(-1)
+        return scipy.sparse.csr_matrix(
+            (data, self.indices, self.indptr), shape=(self.num_dofs, self.num_dofs)
+        )
+
+    def mass_matrix(self, density):
+        blocks = np.zeros((self.num_pairs, 3, 3))
+        _scatter_mass(self.volumes, self.pair_index, density, blocks)
+        return self.to_csr(blocks)
+
+    def stiffness_matrix(self, youngs, poisson):
+        # K is linear in the Young's modulus, the unit matrix is reused
+        if poisson not in self.stiffness_cache:
+            lam = poisson / (1 + poisson) / (1 - 2 * poisson)
+            mu = 0.5 / (1 + poisson)
+            blocks = np.zeros((self.num_pairs, 3, 3))
+            _scatter_stiffness(
+                self.volumes, self.grads, self.pair_index, lam, mu, blocks
+            )
+            self.stiffness_cache[poisson] = self.to_csr(blocks)
+        return self.stiffness_cache[poisson] * youngs
 
 
 class FEMmodel:
-    def __init__(self, vertices, tets, material=Material(MatSet.Ceramic)):
+    def __init__(self, vertices, tets, material=Material(MatSet.Ceramic), device=None):
         self.vertices = vertices.astype(np.float32)
         self.tets = tets.astype(np.int32)
         self.material = material
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.assembler_ = None
+        self.stiffness_matrix_, self.mass_matrix_ = None, None
+
+    @property
+    def assembler(self):
+        if self.assembler_ is None:
+            self.assembler_ = TetAssembler(self.vertices, self.tets)
+        return self.assembler_
+
+    def set_material(self, material):
+        """
+        Swap the material, the CPU sparsity pattern and the unit stiffness of
+        the same Poisson's ratio are reused.
+        """
+        self.material = material
         self.stiffness_matrix_, self.mass_matrix_ = None, None
 
     @property
     def mass_matrix(self):
+        if self.mass_matrix_ is None and self.device == "cpu":
+            self.mass_matrix_ = csr2torch(
+                self.assembler.mass_matrix(self.material.density)
+            )
         if self.mass_matrix_ is None:
             values = torch.zeros(
                 12 * 12 * self.tets.shape[0], dtype=torch.float32
@@ -121,7 +274,7 @@ class FEMmodel:
                 .contiguous()
                 .cuda()
             )
-            cuda_module.assemble_mass_matrix(
+            MATRIX_ASSEMBLE_MODULE.get("assemble_mass_matrix")(
                 vertices_, tets_, values, rows, cols, self.material.density
             )
             indices = torch.stack([rows, cols], dim=0).long()
@@ -131,6 +284,12 @@ class FEMmodel:
 
     @property
     def stiffness_matrix(self):
+        if self.stiffness_matrix_ is None and self.device == "cpu":
+            self.stiffness_matrix_ = csr2torch(
+                self.assembler.stiffness_matrix(
+                    self.material.youngs, self.material.poison
+                )
+            )
         if self.stiffness_matrix_ is None:
             values = torch.zeros(
                 12 * 12 * self.tets.shape[0], dtype=torch.float32
@@ -151,7 +310,7 @@ class FEMmodel:
                 .contiguous()
                 .cuda()
             )
-            cuda_module.assemble_stiffness_matrix(
+            MATRIX_ASSEMBLE_MODULE.get("assemble_stiffness_matrix")(
                 vertices_,
                 tets_,
                 values,
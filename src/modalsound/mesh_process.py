@@ -2,6 +2,9 @@ import torch
 import meshio
 import subprocess
 import os
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import numpy as np
 
@@ -19,26 +22,108 @@ def update_triangle_normals(vertices, triangles):
     return normals
 
 
-def tetra_from_mesh(input_mesh, log=False):
-    result = subprocess.run(
-        ["FloatTetwild_bin", "-i", input_mesh, "--max-threads", "8"],
-        capture_output=True,
-        text=True,
-    )
-    if log:
-        print(result.stdout, result.stderr)
+# FloatTetwild results keyed by the input mesh bytes and the tetwild
+# arguments. Thread counts do not change the result and are not part of the key.
+TETRA_CACHE_DIR = os.environ.get(
+    "TETRA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tetwild")
+)
+
 
-    tetra_file = input_mesh + "_.msh"
-    surface_file = input_mesh + "__sf.obj"
-    tetra_mesh = meshio.read(tetra_file)
-    surface_mesh = meshio.read(surface_file)
-    # remove input_mesh_*
-    for f in glob(input_mesh + "_*"):
-        os.remove(f)
+def tetra_key(input_mesh, tetwild_args=()):
+    h = hashlib.sha1()
+    with open(input_mesh, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(os.path.splitext(input_mesh)[1].encode())
+    h.update(" ".join(tetwild_args).encode())
+    return h.hexdigest()
 
+
+def run_tetwild(input_mesh, tetwild_args=(), max_threads=8, log=False):
+    # outputs go to a private directory, so concurrent runs on the same input
+    # do not collide
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, "mesh")
+        result = subprocess.run(
+            ["FloatTetwild_bin", "-i", input_mesh, "-o", output]
+            + ["--max-threads", str(max_threads)]
+            + list(tetwild_args),
+            capture_output=True,
+            text=True,
+        )
+        if log:
+            print(result.stdout, result.stderr)
+        tetra_files = glob(os.path.join(tmp_dir, "*.msh"))
+        surface_files = glob(os.path.join(tmp_dir, "*_sf.obj"))
+        if not tetra_files or not surface_files:
+            raise RuntimeError(f"FloatTetwild failed on {input_mesh}: {result.stderr}")
+        tetra_mesh = meshio.read(tetra_files[0])
+        surface_mesh = meshio.read(surface_files[0])
     return (
         tetra_mesh.points,
         tetra_mesh.cells[0].data,
         surface_mesh.points,
         surface_mesh.cells[0].data,
     )
+
+
+def tetra_from_mesh(
+    input_mesh, log=False, cache_dir=TETRA_CACHE_DIR, tetwild_args=(), max_threads=8
+):
+    """
+    Tetrahedralize input_mesh with FloatTetwild, returning the tet vertices,
+    the tets and the surface vertices and triangles. With a cache_dir the
+    result is stored as an npz keyed by the mesh content and tetwild_args and
+    reused by later calls, also from other processes.
+    """
+    if cache_dir is None:
+        return run_tetwild(input_mesh, tetwild_args, max_threads, log)
+    path = os.path.join(cache_dir, f"tetra_{tetra_key(input_mesh, tetwild_args)}.npz")
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return (
+                data["vertices"],
+                data["tets"],
+                data["surf_vertices"],
+                data["surf_triangles"],
+            )
+    vertices, tets, surf_vertices, surf_triangles = run_tetwild(
+        input_mesh, tetwild_args, max_threads, log
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        vertices=vertices,
+        tets=tets,
+        surf_vertices=surf_vertices,
+        surf_triangles=surf_triangles,
+    )
+    os.replace(tmp_path, path)
+    return vertices, tets, surf_vertices, surf_triangles
+
+
+def _cache_tetra(args):
+    input_mesh, cache_dir, tetwild_args, max_threads = args
+    tetra_from_mesh(input_mesh, False, cache_dir, tetwild_args, max_threads)
+    return input_mesh
+
+
+def tetra_from_directory(
+    mesh_dir,
+    pattern="*.obj",
+    cache_dir=TETRA_CACHE_DIR,
+    tetwild_args=(),
+    num_workers=None,
+):
+    """
+    Tetrahedralize every mesh of mesh_dir matching pattern into the cache in
+    a process pool, splitting the cores between the FloatTetwild runs.
+    Return the processed mesh paths.
+    """
+    mesh_paths = sorted(glob(os.path.join(mesh_dir, pattern)))
+    num_workers = num_workers or min(len(mesh_paths), os.cpu_count()) or 1
+    max_threads = max(1, os.cpu_count() // num_workers)
+    jobs = [(p, cache_dir, tuple(tetwild_args), max_threads) for p in mesh_paths]
+    with ProcessPoolExecutor(num_workers) as pool:
+        return list(pool.map(_cache_tetra, jobs))
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+from .fem import Material
+from .modal_solver import ModalSolver
+
+# Modal results of a geometry transfer to other materials and sizes in closed
+# form. Scaling the mesh by s scales the stiffness by E s and the mass by
+# rho s^3, so with the same Poisson's ratio
+#   lambda = lambda_1 E / (rho s^2),   x = x_1 / sqrt(rho s^3)
+# for the eigenpairs (lambda_1, x_1) of the unit material at unit size, the
+# omega_rate and vibration_rate of NeuralSound/classic/fem/femModel.py.
+
+
+def geometry_key(vertices, tets, poisson):
+    """
+    Return the translation and scale invariant key of a tet mesh and its RMS
+    vertex radius about the centroid.
+    """
+    v = np.asarray(vertices, dtype=np.float64)
+    v = v - v.mean(0)
+    size = float(np.sqrt((v**2).sum(1).mean()))
+    h = hashlib.sha1()
+    h.update(np.round(v / size, 5).astype(np.float32).tobytes())
+    h.update(np.ascontiguousarray(tets, dtype=np.int32).tobytes())
+    h.update(np.array([poisson], dtype=np.float64).tobytes())
+    return h.hexdigest(), size
+
+
+class Modes:
+    """
+    Eigenpairs of one (material, size) query with the Rayleigh damping
+    0.5 (alpha + beta lambda) and the damped frequencies.
+    """
+
+    def __init__(self, eigenvalues, eigenvectors, material):
+        self.eigenvalues = eigenvalues
+        self.eigenvectors = eigenvectors
+        self.damps = 0.5 * (material.alpha + material.beta * eigenvalues)
+        omega2 = np.clip(eigenvalues - self.damps**2, 0, None)
+        self.frequencies = omega2**0.5 / (2 * np.pi)
+
+
+class ModalCache:
+    """
+    Eigenpairs of the unit material at unit RMS radius, one entry per
+    geometry and Poisson's ratio, serving any material and scale of it. Only
+    a new geometry, a new Poisson's ratio or more modes than stored trigger
+    a solve. At most max_entries geometries are kept, the least recently
+    used ones are dropped first.
+    """
+
+    def __init__(self, solver=None, max_entries=16):
+        self.solver = ModalSolver() if solver is None else solver
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, vertices, tets, material, k=32, scale=1.0):
+        """
+        Modes of the k smallest non-rigid eigenpairs of the mesh scaled by
+        scale about its centroid, for the given material.
+        """
+        key, size = geometry_key(vertices, tets, material.poison)
+        entry = self.entries.get(key)
+        if entry is None or entry[0].shape[0] < k:
+            unit = Material((1.0, 1.0, material.poison, 0.0, 0.0))
+            v = np.asarray(vertices, dtype=np.float64)
+            entry = self.solver.solve((v - v.mean(0)) / size, tets, unit, k)
+            self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        vals, vecs = entry[0][:k], entry[1][:, :k]
+        s = size * scale
+        vals = vals * material.youngs / (material.density * s**2)
+        vecs = vecs / (material.density * s**3) ** 0.5
+        return Modes(vals, vecs, material)
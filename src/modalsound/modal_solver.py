@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import scipy.sparse.linalg
+from .fem import TetAssembler
+
+# Shift-invert eigensolver of the linear tet model K x = lambda M x. For an
+# isotropic material K = E K1(nu) and M = rho M1, so the factorization of
+# K1 - sigma M1 of the unit material serves every material with the same
+# Poisson's ratio: K - (sigma E / rho) M = E (K1 - sigma M1). The
+# factorizations are cached per mesh and Poisson's ratio, a new ratio on a
+# known mesh is solved by LOBPCG preconditioned with the nearest one.
+
+# Number of rigid body modes at the eigenvalue 0.
+RIGID_MODES = 6
+
+
+def mesh_hash(vertices, tets):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+    h.update(np.ascontiguousarray(tets, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+
+class Factorization:
+    """
+    Sparse LU of K1 - sigma M1 for the unit Young's modulus and density. The
+    shift is placed below the rigid body modes at 0, a fraction of the
+    smallest diagonal ratio of K1 and M1, so the shifted matrix is positive
+    definite.
+    """
+
+    def __init__(self, stiffness, mass, shift_rate=1e-4):
+        self.stiffness = stiffness
+        self.mass = mass
+        ratio = stiffness.diagonal() / mass.diagonal()
+        self.sigma = -shift_rate * ratio.min()
+        self.lu = scipy.sparse.linalg.splu(
+            (stiffness - self.sigma * mass).tocsc(), permc_spec="MMD_AT_PLUS_A"
+        )
+        # unit material eigenpairs by the number of modes
+        self.modes = {}
+
+    def operator(self, scale=1.0):
+        """
+        (K1 - sigma M1)^-1 / scale as a LinearOperator.
+        """
+        n = self.stiffness.shape[0]
+        return scipy.sparse.linalg.LinearOperator(
+            (n, n), matvec=lambda x: self.lu.solve(x) / scale, dtype=np.float64
+        )
+
+
+class ModalSolver:
+    """
+    Smallest k non-rigid eigenpairs of tet meshes, keeping the assemblers and
+    factorizations of the last max_meshes meshes. method="shift_invert"
+    factorizes every new Poisson's ratio, method="lobpcg" reuses any
+    factorization of the mesh as the LOBPCG preconditioner and only
+    factorizes the first material of a mesh.
+    """
+
+    def __init__(self, max_meshes=4, method="shift_invert", tol=1e-8):
+        self.max_meshes = max_meshes
+        self.method = method
+        self.tol = tol
+        self.meshes = OrderedDict()
+
+    def entry(self, vertices, tets):
+        key = mesh_hash(vertices, tets)
+        if key not in self.meshes:
+            self.meshes[key] = {
+                "assembler": TetAssembler(vertices, tets),
+                "factorizations": {},
+                # LOBPCG eigenpairs of unfactorized ratios by (poisson, k)
+                "modes": {},
+            }
+            while len(self.meshes) > self.max_meshes:
+                self.meshes.popitem(last=False)
+        self.meshes.move_to_end(key)
+        return self.meshes[key]
+
+    def factorization(self, entry, poisson):
+        factorizations = entry["factorizations"]
+        if poisson not in factorizations:
+            assembler = entry["assembler"]
+            factorizations[poisson] = Factorization(
+                assembler.stiffness_matrix(1.0, poisson), assembler.mass_matrix(1.0)
+            )
+        return factorizations[poisson]
+
+    def solve(self, vertices, tets, material, k):
+        """
+        Eigenvalues (k,) and M-orthonormal eigenvectors (3 * V, k) of the
+        smallest k non-rigid modes, like LOBPCG_solver.
+        """
+        entry = self.entry(vertices, tets)
+        poisson = material.poison
+        factorizations = entry["factorizations"]
+        if self.method == "lobpcg" and factorizations and poisson not in factorizations:
+            nearest = min(factorizations, key=lambda p: abs(p - poisson))
+            vals, vecs = self.lobpcg(entry, factorizations[nearest], poisson, k)
+        elif self.method in ("shift_invert", "lobpcg"):
+            vals, vecs = self.shift_invert(self.factorization(entry, poisson), k)
+        else:
+            raise ValueError(f"unknown modal solver method {self.method}")
+        # unit material to (youngs, density)
+        vals = vals * material.youngs / material.density
+        vecs = vecs / material.density**0.5
+        return vals[RIGID_MODES:], vecs[:, RIGID_MODES:]
+
+    def shift_invert(self, factorization, k):
+        if k in factorization.modes:
+            return factorization.modes[k]
+        vals, vecs = scipy.sparse.linalg.eigsh(
+            factorization.stiffness,
+            RIGID_MODES + k,
+            factorization.mass,
+            sigma=factorization.sigma,
+            which="LM",
+            OPinv=factorization.operator(),
+            tol=self.tol,
+        )
+        order = np.argsort(vals)
+        factorization.modes[k] = vals[order], vecs[:, order]
+        return factorization.modes[k]
+
+    def lobpcg(self, entry, factorization, poisson, k):
+        modes = entry["modes"]
+        if (poisson, k) in modes:
+            return modes[poisson, k]
+        assembler = entry["assembler"]
+        stiffness = assembler.stiffness_matrix(1.0, poisson)
+        mass = assembler.mass_matrix(1.0)
+        # start from the modes of the nearest Poisson's ratio
+        _, X = self.shift_invert(factorization, k)
+        vals, vecs = scipy.sparse.linalg.lobpcg(
+            stiffness,
+            X,
+            B=mass,
+            M=factorization.operator(),
+            tol=self.tol**0.5,
+            maxiter=200,
+            largest=False,
+        )
+        order = np.argsort(vals)
+        modes[poisson, k] = vals[order], vecs[:, order]
+        return modes[poisson, k]
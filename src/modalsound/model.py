@@ -5,7 +5,7 @@ from .bempp import BEMModel
 from .mesh_process import tetra_from_mesh, update_triangle_normals
 from scipy.spatial import KDTree
 from .fem import FEMmodel, LOBPCG_solver, Material, MatSet
-from ..cuda_imp import multipole
+from ..cuda_imp import multipole, default_device
 import torch
 from numba import njit
 
@@ -31,21 +31,21 @@ def complex_ssim(x, y):
 
 class MultipoleModel:
     def __init__(self, x0, n0, k, M):
-        self.x0 = torch.tensor(x0).float().cuda()
-        self.n0 = torch.tensor(n0).float().cuda()
+        self.x0 = torch.tensor(x0).float().to(default_device())
+        self.n0 = torch.tensor(n0).float().to(default_device())
         self.k = k
         self.M = M
 
     def solve_dirichlet(self, points):
         if isinstance(points, np.ndarray):
-            points = torch.tensor(points).float().cuda().reshape(-1, 3)
+            points = torch.tensor(points).float().to(self.x0.device).reshape(-1, 3)
         return multipole(self.x0, self.n0, points, points, self.k, self.M, False)
 
     def solve_neumann(self, points, normals):
         if isinstance(points, np.ndarray):
-            points = torch.tensor(points).float().cuda().reshape(-1, 3)
+            points = torch.tensor(points).float().to(self.x0.device).reshape(-1, 3)
         if isinstance(normals, np.ndarray):
-            normals = torch.tensor(normals).float().cuda().reshape(-1, 3)
+            normals = torch.tensor(normals).float().to(self.x0.device).reshape(-1, 3)
         return multipole(self.x0, self.n0, points, normals, self.k, self.M, True)
 
 
@@ -97,7 +97,7 @@ def get_spherical_surface_points(vertices, scale=2):
     points = unit_sphere_surface_points(32)
     points = points.reshape(-1, 3)
     points = points * get_mesh_size(vertices) * scale + get_mesh_center(vertices)
-    points = torch.tensor(points).float().cuda()
+    points = torch.tensor(points).float().to(default_device())
     return points
 
 
@@ -164,11 +164,27 @@ class ModalSoundObj:
         self.size = (self.bbox_max - self.bbox_min).max()
         self.center = (self.bbox_max + self.bbox_min) / 2
 
-    def modal_analysis(self, k=32, material=Material(MatSet.Plastic)):
-        self.fem_model = FEMmodel(self.vertices, self.tets, material)
-        eigenvalues, eigenvectors = LOBPCG_solver(
-            self.fem_model.stiffness_matrix, self.fem_model.mass_matrix, k
-        )
+    def modal_analysis(
+        self, k=32, material=Material(MatSet.Plastic), solver=None, cache=None
+    ):
+        """
+        solver is an optional ModalSolver, whose shift-invert factorizations
+        are reused by later calls on the same tet mesh. cache is an optional
+        ModalCache, which serves other materials and sizes of an analysed
+        geometry without a solve.
+        """
+        if cache is not None:
+            modes = cache.get(self.vertices, self.tets, material, k)
+            eigenvalues, eigenvectors = modes.eigenvalues, modes.eigenvectors
+        elif solver is not None:
+            eigenvalues, eigenvectors = solver.solve(
+                self.vertices, self.tets, material, k
+            )
+        else:
+            self.fem_model = FEMmodel(self.vertices, self.tets, material)
+            eigenvalues, eigenvectors = LOBPCG_solver(
+                self.fem_model.stiffness_matrix, self.fem_model.mass_matrix, k
+            )
         eigenvectors = eigenvectors.reshape(-1, 3, k)
         kd_tree = KDTree(self.vertices)
         _, surf_points_index = kd_tree.query(self.surf_vertices)
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import numpy as np
+import torch
+from .mc_operator import boundary_self_terms, boundary_weight_tile
+
+# Bytes of weights read from the scratch file at once. Two tiles are held in
+# memory, one multiplied while the next one is read.
+DISK_TILE_BYTES = 256 * 1024**2
+
+
+class OutOfCoreOperator:
+    """
+    Boundary operator of the Monte Carlo weights stored in a scratch file.
+    The weights are computed once in row tiles and written to an np.memmap of
+    shape (N, batch, N), so every row tile is contiguous on disk. The matvec
+    streams the tiles back and reads the next tile in a background thread
+    while the current one is multiplied, so memory is O(tile) and the
+    throughput is bounded by the disk bandwidth.
+    """
+
+    def __init__(
+        self, sampler, ks, deriv=False, scratch_dir=None, tile_bytes=DISK_TILE_BYTES
+    ):
+        self.device = sampler.points.device
+        ks = torch.as_tensor(ks, dtype=torch.float32, device=self.device)
+        N = sampler.num_samples
+        B = len(ks)
+        self.shape = (B, N, N)
+        self.tile_size = max(1, int(tile_bytes // (B * N * 8)))
+        # unlinked on creation, the space is released once the file is closed
+        self.file = tempfile.TemporaryFile(dir=scratch_dir)
+        self.weights = np.memmap(
+            self.file, dtype=np.complex64, mode="w+", shape=(N, B, N)
+        )
+        self_terms = boundary_self_terms(sampler, ks, deriv)
+        for start in range(0, N, self.tile_size):
+            end = min(start + self.tile_size, N)
+            tile = boundary_weight_tile(sampler, ks, start, end, deriv, self_terms)
+            self.weights[start:end] = tile.permute(1, 0, 2).cpu().numpy()
+        self.weights.flush()
+        self.buffers = [
+            np.empty((self.tile_size, B, N), dtype=np.complex64) for _ in range(2)
+        ]
+
+    def read(self, i, modes):
+        start = i * self.tile_size
+        end = min(start + self.tile_size, self.shape[1])
+        buffer = self.buffers[i % 2][: end - start]
+        if modes is None:
+            np.copyto(buffer, self.weights[start:end])
+            return buffer
+        buffer = buffer[:, : len(modes)]
+        for j, m in enumerate(modes):
+            np.copyto(buffer[:, j], self.weights[start:end, m])
+        return buffer
+
+    def matvec(self, x, modes=None):
+        """
+        Product with x of shape (batch, N, C), or with x of shape
+        (len(modes), N, C) for the listed modes only.
+        """
+        if modes is not None:
+            modes = [int(m) for m in modes]
+        N = self.shape[1]
+        num_tiles = (N + self.tile_size - 1) // self.tile_size
+        y = torch.empty_like(x)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self.read, 0, modes)
+            for i in range(num_tiles):
+                tile = future.result()
+                if i + 1 < num_tiles:
+                    future = pool.submit(self.read, i + 1, modes)
+                start = i * self.tile_size
+                G = torch.from_numpy(tile).to(x.device).permute(1, 0, 2)
+                y[:, start : start + len(tile)] = torch.bmm(G, x)
+        return y
+
+    def close(self):
+        del self.weights
+        self.file.close()
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+import torch
+from .cuda_imp import ImportanceSampler
+
+# Poisson-disk sample sets keyed by the mesh shape, the sample count and the
+# candidate sequence of the ImportanceSampler. The key and the stored points
+# are normalized by the RMS vertex radius, so a uniformly scaled mesh hits the
+# same entry and gets the samples rescaled analytically: the Poisson radius
+# sqrt(area / 2n) scales with the mesh, and the normals and triangle indices
+# do not change.
+
+
+def mesh_key(vertices, triangles, n, importance=None, sequence="random"):
+    """
+    Return the scale invariant key of a mesh and its RMS vertex radius.
+    """
+    if importance is None:
+        importance = torch.ones(len(triangles))
+    v = vertices.detach().cpu().double().numpy()
+    scale = float(np.sqrt((v**2).sum(1).mean()))
+    h = hashlib.sha1()
+    h.update(np.round(v / scale, 5).astype(np.float32).tobytes())
+    h.update(triangles.detach().cpu().numpy().astype(np.int32).tobytes())
+    h.update(importance.detach().cpu().numpy().astype(np.float32).tobytes())
+    h.update(np.array([n], dtype=np.int64).tobytes())
+    h.update(sequence.encode())
+    return h.hexdigest(), scale
+
+
+class SampleCache:
+    """
+    In-memory and optional on-disk cache of sample sets. At most max_entries
+    sets are kept in memory and at most max_bytes on disk, the least recently
+    used ones are evicted first.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=32, max_bytes=1024**3):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"samples_{key}.npz")
+
+    def load(self, vertices, triangles, importance, n, sequence="random"):
+        """
+        Return a sampler with the cached samples of this mesh, or None.
+        """
+        key, scale = mesh_key(vertices, triangles, n, importance, sequence)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+        elif self.cache_dir is not None and os.path.exists(self.path(key)):
+            with np.load(self.path(key)) as data:
+                entry = dict(data)
+            os.utime(self.path(key))
+            self.insert(key, entry)
+        else:
+            return None
+        num_samples = len(entry["points"])
+        sampler = ImportanceSampler(
+            vertices, triangles, importance, num_samples, sequence=sequence
+        )
+        device = vertices.device
+        points = torch.from_numpy(entry["points"] * scale).float()
+        sampler.points = points.to(device)
+        sampler.points_normals = torch.from_numpy(entry["normals"]).to(device)
+        sampler.points_importance = torch.from_numpy(entry["importance"]).to(device)
+        sampler.points_index = torch.from_numpy(entry["index"]).to(device)
+        sampler.points_neumann = sampler.triangle_neumann[sampler.points_index.long()]
+        return sampler
+
+    def store(self, sampler, n, sequence="random"):
+        key, scale = mesh_key(
+            sampler.vertices,
+            sampler.triangles,
+            n,
+            sampler.triangle_importance,
+            sequence,
+        )
+        entry = {
+            "points": sampler.points.cpu().double().numpy() / scale,
+            "normals": sampler.points_normals.cpu().numpy(),
+            "importance": sampler.points_importance.cpu().numpy(),
+            "index": sampler.points_index.cpu().numpy(),
+        }
+        self.insert(key, entry)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **entry)
+        os.replace(tmp_path, path)
+        self.evict_disk()
+
+    def discard(self, vertices, triangles, n, importance=None, sequence="random"):
+        """
+        Drop the samples of this mesh, e.g. after they failed to converge.
+        """
+        key, _ = mesh_key(vertices, triangles, n, importance, sequence)
+        self.entries.pop(key, None)
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def evict_disk(self):
+        files = [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir)
+            if f.startswith("samples_") and f.endswith(".npz") and ".tmp" not in f
+        ]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        while files and total > self.max_bytes:
+            f = files.pop(0)
+            total -= os.path.getsize(f)
+            os.remove(f)
@@ -0,0 +1,239 @@
+from collections import OrderedDict
+import torch
+from .cuda_imp import (
+    ImportanceSampler,
+    get_weights_boundary_ks_base,
+    get_weights_potential_ks_base,
+)
+from .mc_operator import boundary_self_terms, DENSE_MEMORY_BUDGET
+import numpy as np
+
+# A scene of rigid bodies sampled once in their own frames. The Green's kernel
+# between two samples of the same body only depends on their relative position
+# and the source normal, both invariant under rigid motion, so the intra-body
+# blocks of the boundary weights are cached across poses and only the blocks
+# between different bodies are rebuilt after a pose change.
+
+
+def quaternion_to_matrix(q):
+    """
+    Rotation matrix of a quaternion (w, x, y, z).
+    """
+    w, x, y, z = q / q.norm()
+    return torch.stack(
+        [
+            torch.stack(
+                [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)]
+            ),
+            torch.stack(
+                [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)]
+            ),
+            torch.stack(
+                [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]
+            ),
+        ]
+    )
+
+
+class RigidBody:
+    """
+    Triangle mesh given in its own frame, placed in the scene by a rotation
+    matrix and a translation.
+    """
+
+    def __init__(self, vertices, triangles, importance=None):
+        self.vertices = vertices
+        self.triangles = triangles
+        if importance is None:
+            importance = torch.ones(
+                len(triangles), dtype=torch.float32, device=vertices.device
+            )
+        self.importance = importance
+        self.rotation = torch.eye(3, dtype=torch.float32, device=vertices.device)
+        self.translation = torch.zeros(3, dtype=torch.float32, device=vertices.device)
+        self.sampler = None
+
+    def set_pose(self, rotation=None, translation=None):
+        if rotation is not None:
+            self.rotation = rotation.to(self.vertices)
+        if translation is not None:
+            self.translation = translation.to(self.vertices)
+
+    def sample(self, r, num_candidates):
+        """
+        Poisson-disk samples of radius r in the body frame, or plain
+        importance samples if r is None.
+        """
+        sampler = ImportanceSampler(
+            self.vertices, self.triangles, self.importance, num_candidates
+        )
+        sampler.update()
+        if r is not None:
+            sampler.poisson_disk_resample(r, 4)
+        self.sampler = sampler
+
+    def world_points(self):
+        return self.sampler.points @ self.rotation.T + self.translation
+
+    def world_normals(self):
+        return self.sampler.points_normals @ self.rotation.T
+
+    def world_vertices(self):
+        return self.vertices @ self.rotation.T + self.translation
+
+
+class SceneOperator:
+    """
+    Boundary operator assembled from (batch, Ni, Nj) blocks between the
+    samples of body i and body j.
+    """
+
+    def __init__(self, blocks, offsets):
+        self.blocks = blocks
+        self.offsets = offsets
+        N = offsets[-1]
+        self.shape = (len(next(iter(blocks.values()))), N, N)
+
+    def matvec(self, x, modes=None):
+        """
+        Product with x of shape (batch, N, C), or with x of shape
+        (len(modes), N, C) for the listed modes only.
+        """
+        y = torch.zeros_like(x)
+        o = self.offsets
+        for (i, j), block in self.blocks.items():
+            if modes is not None:
+                block = block[modes]
+            y[:, o[i] : o[i + 1]] += torch.bmm(block, x[:, o[j] : o[j + 1]])
+        return y
+
+
+class Scene:
+    """
+    Rigid bodies sharing one Monte Carlo sample set. It exposes the attributes
+    of an ImportanceSampler, so it can replace one in monte_carlo_solve and
+    evaluate_potential, and builds its boundary operators blockwise with the
+    intra-body blocks cached across poses. cache_budget bounds the bytes of
+    cached blocks, the least recently used wavenumber batches are dropped
+    first.
+    """
+
+    def __init__(
+        self, bodies, n, num_candidates=50000, cache_budget=DENSE_MEMORY_BUDGET
+    ):
+        self.bodies = bodies
+        self.n = n
+        self.num_candidates = num_candidates
+        self.cache_budget = cache_budget
+        self.resample()
+
+    def resample(self):
+        """
+        Draw new samples for every body and drop the cached blocks.
+        """
+        areas = []
+        for body in self.bodies:
+            v = body.vertices
+            t = body.triangles.long()
+            cross = torch.cross(v[t[:, 1]] - v[t[:, 0]], v[t[:, 2]] - v[t[:, 0]], dim=1)
+            areas.append(0.5 * torch.norm(cross, dim=1).sum().item())
+        total_area = sum(areas)
+        # a common radius keeps the sample density uniform across bodies
+        r = (total_area / (2 * self.n)) ** 0.5 if self.n > 0 else None
+        candidates = self.num_candidates if self.n > 0 else 1000
+        for body, area in zip(self.bodies, areas):
+            body.sample(r, max(1000, int(candidates * area / total_area)))
+        counts = [int(body.sampler.num_samples) for body in self.bodies]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        self.num_samples = self.offsets[-1]
+        cdfs, points_index = [], []
+        cdf_offset, tri_offset = 0, 0
+        for body in self.bodies:
+            cdfs.append(body.sampler.cdf + cdf_offset)
+            points_index.append(body.sampler.points_index + tri_offset)
+            cdf_offset = cdfs[-1][-1]
+            tri_offset += len(body.triangles)
+        self.cdf = torch.cat(cdfs)
+        self.points_index = torch.cat(points_index)
+        self.points_importance = torch.cat(
+            [body.sampler.points_importance for body in self.bodies]
+        )
+        self.points_neumann = torch.cat(
+            [body.sampler.points_neumann for body in self.bodies]
+        )
+        self.block_cache = OrderedDict()
+        self.update_pose()
+
+    def set_pose(self, index, rotation=None, translation=None):
+        self.bodies[index].set_pose(rotation, translation)
+        self.update_pose()
+
+    def update_pose(self):
+        self.points = torch.cat([body.world_points() for body in self.bodies])
+        self.points_normals = torch.cat([body.world_normals() for body in self.bodies])
+        self.vertices = torch.cat([body.world_vertices() for body in self.bodies])
+        offsets = np.cumsum([0] + [len(body.vertices) for body in self.bodies])
+        self.triangles = torch.cat(
+            [body.triangles + int(o) for body, o in zip(self.bodies, offsets)]
+        )
+
+    def intra_blocks(self, ks, deriv):
+        key = (tuple(ks.tolist()), deriv)
+        if key in self.block_cache:
+            self.block_cache.move_to_end(key)
+            return self.block_cache[key]
+        cdf_sum = self.cdf[-1]
+        M = self.num_samples
+        self_terms = boundary_self_terms(self, ks, deriv)
+        blocks = []
+        for b, body in enumerate(self.bodies):
+            s = body.sampler
+            block = get_weights_boundary_ks_base(
+                ks, s.points, s.points_normals, s.points_importance, cdf_sum, deriv
+            )
+            # the kernel normalizes by the body's own sample count, which also
+            # sizes its self-term discs
+            block.mul_(s.num_samples / M)
+            diagonal = self_terms[:, self.offsets[b] : self.offsets[b + 1]]
+            block.diagonal(dim1=1, dim2=2).copy_(diagonal)
+            blocks.append(block)
+        self.block_cache[key] = blocks
+        nbytes = lambda bs: sum(b.numel() * b.element_size() for b in bs)
+        while (
+            len(self.block_cache) > 1
+            and sum(nbytes(bs) for bs in self.block_cache.values()) > self.cache_budget
+        ):
+            self.block_cache.popitem(last=False)
+        return blocks
+
+    def cross_block(self, ks, i, j, deriv):
+        # potential weights cdf / imp / Mj rescaled to the boundary weights
+        # 2 cdf / imp / M
+        src = self.bodies[j]
+        block = get_weights_potential_ks_base(
+            ks,
+            self.bodies[i].world_points(),
+            src.world_points(),
+            src.world_normals(),
+            src.sampler.points_importance,
+            self.cdf[-1],
+            deriv,
+        )
+        return block.mul_(2 * src.sampler.num_samples / self.num_samples)
+
+    def boundary_operators(self, ks):
+        """
+        (G0, G1) boundary operators of the scene in its current pose.
+        """
+        ks = torch.as_tensor(ks, dtype=torch.float32, device=self.points.device)
+        operators = []
+        for deriv in (False, True):
+            blocks = {}
+            for i, block in enumerate(self.intra_blocks(ks, deriv)):
+                blocks[(i, i)] = block
+            for i in range(len(self.bodies)):
+                for j in range(len(self.bodies)):
+                    if i != j:
+                        blocks[(i, j)] = self.cross_block(ks, i, j, deriv)
+            operators.append(SceneOperator(blocks, self.offsets))
+        return tuple(operators)
@@ -110,10 +110,75 @@ class BiCGSTAB:
         return self.x
 
 
+def precondition(Ax_gen, precond, side, b, x=None, active_set=False):
+    """
+    Left (M A x = M b) or right (A M y = b - A x0, x = x0 + M y) preconditioned
+    form of the batched system. precond has the signature of Ax_gen. Returns
+    the new Ax_gen, right hand side and initial guess, and the function that
+    maps the solution of the new system back to x.
+    """
+    columns = (torch.arange(b.shape[2], device=b.device),) if active_set else ()
+    if side == "left":
+        return (
+            lambda x, *c: precond(Ax_gen(x, *c), *c),
+            precond(b, *columns),
+            x,
+            lambda y: y,
+        )
+    if side == "right":
+        x0 = torch.zeros_like(b) if x is None else x
+        r0 = b if x is None else b - Ax_gen(x0, *columns)
+        return (
+            lambda y, *c: Ax_gen(precond(y, *c), *c),
+            r0,
+            None,
+            lambda y: x0 + precond(y, *columns),
+        )
+    raise ValueError(f"unknown preconditioner side {side}")
+
+
 class BiCGSTAB_batch:
-    def __init__(self, Ax_gen, device="cuda"):
+    def __init__(
+        self,
+        Ax_gen,
+        device="cuda",
+        active_set=False,
+        stall_steps=None,
+        max_restarts=3,
+        check_every=None,
+        history_size=64,
+        precond=None,
+        precond_side="right",
+    ):
+        """
+        Ax_gen: A function that takes x of shape (n, 1, batch_size) and output Ax
+
+        With active_set=True, Ax_gen(x, columns) is called with x of shape
+        (n, 1, len(columns)) holding only the listed batch columns, so that
+        converged columns are dropped from the matvec. A column that breaks
+        down is restarted from its current x. With stall_steps=N, so is a
+        column whose best residual has not decreased in the last N iterations.
+        A column is flagged as failed after more than max_restarts restarts in
+        a row that did not lower its best residual.
+
+        With check_every=N, convergence is only checked (and the host only
+        synchronized) every N iterations, work buffers are updated in place
+        and the residual history is kept on-device in a ring buffer of
+        history_size iterations. Converged columns are frozen in place if
+        active_set is False.
+
+        precond is an optional preconditioner with the signature of Ax_gen,
+        applied from the left or the right as given by precond_side.
+        """
         self.Ax_gen = Ax_gen
         self.device = device
+        self.active_set = active_set
+        self.stall_steps = stall_steps
+        self.max_restarts = max_restarts
+        self.check_every = check_every
+        self.history_size = history_size
+        self.precond = precond
+        self.precond_side = precond_side
         self.log_rerr = []
 
     def init_params(self, b, x=None, nsteps=None, tol=1e-10, atol=1e-16):
@@ -177,14 +242,35 @@ class BiCGSTAB_batch:
             self.r = s - self.omega * t  # r_i <- s - w_i t
             return False
 
-    def solve(self, *args, **kwargs):
+    def solve(self, b, x=None, return_info=False, **kwargs):
         """
         Method to find the solution.
 
-        Returns the final answer of x
+        Returns the final answer of x and whether all columns converged. The
+        active set solver also returns a dict with the per-column iterations,
+        relative residuals, convergence flags and restarts if return_info.
 
         """
-        self.init_params(*args, **kwargs)
+        if self.precond is None:
+            return self.solve_system(b, x, return_info, **kwargs)
+        Ax_gen = self.Ax_gen
+        self.Ax_gen, b, x, recover = precondition(
+            Ax_gen, self.precond, self.precond_side, b, x, self.active_set
+        )
+        try:
+            x, *result = self.solve_system(b, x, return_info, **kwargs)
+        finally:
+            self.Ax_gen = Ax_gen
+        self.x = recover(x)
+        return (self.x, *result)
+
+    def solve_system(self, b, x=None, return_info=False, **kwargs):
+        if self.active_set or self.check_every is not None:
+            x, convergence = self.solve_active(b, x, **kwargs)
+            if return_info:
+                return x, convergence, self.info
+            return x, convergence
+        self.init_params(b, x, **kwargs)
         if self.status:
             return self.x, True
         iter_count = 0
@@ -201,6 +287,161 @@ class BiCGSTAB_batch:
         print("Convergence has failed :(")
         return self.x, False
 
+    def solve_active(self, b, x=None, nsteps=None, tol=1e-10, atol=1e-16):
+        n, _, batch_size = b.shape
+        device = b.device
+        check_every = self.check_every or 1
+        compact = self.active_set
+        if compact:
+            Ax = self.Ax_gen
+        else:
+            Ax = lambda x, cols: self.Ax_gen(x)
+        b = b.clone().detach()
+        x_out = torch.zeros_like(b) if x is None else x.clone()
+        bdotb = self.batch_vdot(b, b)[0]
+        residual_tol = torch.clamp(tol * bdotb, min=atol)
+        nsteps = n if nsteps is None else nsteps
+        iterations = torch.zeros(batch_size, dtype=torch.long, device=device)
+        restarts = torch.zeros(batch_size, dtype=torch.long, device=device)
+        # consecutive restarts without a new best residual, per active column
+        strikes = torch.zeros(batch_size, dtype=torch.long, device=device)
+        converged = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        residuals = torch.zeros(batch_size, device=device)
+        self.history = torch.full((self.history_size, batch_size), float("nan"))
+        self.history = self.history.to(device)
+        # state of the active columns, compacted whenever columns finish
+        cols = torch.arange(batch_size, device=device)
+        x = x_out.clone()
+        r = b - Ax(x, cols)
+        rdotr = self.batch_vdot(r, r)[0]
+        r_hat = r.clone()
+        p, s = torch.zeros_like(b), torch.zeros_like(b)
+        v = torch.zeros_like(b)
+        rho = torch.ones(1, 1, batch_size, device=device, dtype=b.dtype)
+        alpha, omega = rho.clone(), rho.clone()
+        # best iterate of every column, restarts and failed columns use it
+        best, x_best = rdotr.clone(), x.clone()
+        restart_best = rdotr.clone()
+        since_best = torch.zeros(batch_size, dtype=torch.long, device=device)
+        # columns that broke down since the last check, or are frozen
+        broken = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        frozen = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        for step in range(nsteps + 1):
+            if step % check_every == 0 or step == nsteps:
+                stalled = broken
+                if self.stall_steps is not None:
+                    stalled = stalled | (since_best >= self.stall_steps)
+                # the recursive residual is confirmed with the true one before
+                # a column is frozen, stalled columns restart from the true
+                # residual of their best iterate
+                refresh = ((rdotr < residual_tol[cols]) | stalled) & ~frozen
+                x[..., stalled & ~frozen] = x_best[..., stalled & ~frozen]
+                if refresh.any():
+                    if compact:
+                        r_true = b[..., cols[refresh]] - Ax(
+                            x[..., refresh], cols[refresh]
+                        )
+                    else:
+                        r_true = (b - Ax(x, cols))[..., refresh]
+                    r[..., refresh] = r_true
+                    rdotr[refresh] = self.batch_vdot(r_true, r_true)[0]
+                done = (rdotr < residual_tol[cols]) & ~frozen
+                restart = refresh & stalled & ~done
+                if restart.any():
+                    restarts[cols[restart]] += 1
+                    progress = best < restart_best
+                    strikes = torch.where(
+                        restart, torch.where(progress, 0, strikes + 1), strikes
+                    )
+                    restart_best = torch.where(
+                        restart, torch.minimum(best, restart_best), restart_best
+                    )
+                    r_hat[..., restart] = r[..., restart]
+                    p[..., restart] = 0
+                    v[..., restart] = 0
+                    rho[..., restart] = 1
+                    alpha[..., restart] = 1
+                    omega[..., restart] = 1
+                    best[restart] = rdotr[restart]
+                    since_best[restart] = 0
+                    broken[restart] = False
+                finished = (done | (strikes > self.max_restarts)) & ~frozen
+                if step == nsteps:
+                    finished = ~frozen
+                if finished.any():
+                    idx = cols[finished]
+                    ok = done[finished]
+                    x_out[..., idx] = torch.where(
+                        ok, x[..., finished], x_best[..., finished]
+                    )
+                    converged[idx] = ok
+                    rdotr_out = torch.where(ok, rdotr[finished], best[finished])
+                    residuals[idx] = (rdotr_out / bdotb[idx]).sqrt()
+                    iterations[idx] = step
+                    if compact:
+                        keep = ~finished
+                        cols = cols[keep]
+                        x, r, r_hat = x[..., keep], r[..., keep], r_hat[..., keep]
+                        x_best = x_best[..., keep]
+                        p, s, v = p[..., keep], s[..., keep], v[..., keep]
+                        rho, alpha = rho[..., keep], alpha[..., keep]
+                        omega = omega[..., keep]
+                        rdotr, best = rdotr[keep], best[keep]
+                        restart_best, strikes = restart_best[keep], strikes[keep]
+                        since_best, broken = since_best[keep], broken[keep]
+                        frozen = frozen[keep]
+                    else:
+                        frozen |= finished
+                    if frozen.all() or len(cols) == 0:
+                        break
+            # broken down and frozen columns get zero step sizes, which
+            # leaves x and r unchanged without any host synchronization
+            hold = (broken | frozen).view(1, 1, -1)
+            rho_new = self.batch_dot(r, r_hat)  # rho_i <- <r0, r^>
+            beta = (rho_new / rho) * (alpha / omega)
+            broken |= ~torch.isfinite(beta).view(-1)
+            beta = torch.where(hold | ~torch.isfinite(beta), 0, beta)
+            rho.copy_(rho_new)
+            # p_i <- r_{i-1} + beta x (p_{i-1} - w_{i-1} v_{i-1})
+            p.addcmul_(v, omega, value=-1).mul_(beta).add_(r)
+            v = Ax(p, cols)  # v_i <- Ap_i
+            alpha = rho / self.batch_dot(r_hat, v)  # alpha <- rho_i/<r^, v_i>
+            broken |= ~torch.isfinite(alpha).view(-1)
+            alpha = torch.where((broken | frozen).view(1, 1, -1), 0, alpha)
+            torch.sub(r, torch.mul(v, alpha, out=s), out=s)  # s <- r - alpha v_i
+            t = Ax(s, cols)  # t <- As
+            omega = self.batch_dot(t, s) / self.batch_dot(t, t)
+            broken |= ~torch.isfinite(omega).view(-1)
+            omega = torch.where((broken | frozen).view(1, 1, -1), 0, omega)
+            x.addcmul_(p, alpha).addcmul_(s, omega)  # x_i <- x + alpha p + w_i s
+            torch.sub(s, torch.mul(t, omega, out=r), out=r)  # r_i <- s - w_i t
+            rdotr = self.batch_vdot(r, r)[0]
+            self.history[step % self.history_size, cols] = (rdotr / bdotb[cols]).sqrt()
+            improved = rdotr < best
+            best = torch.where(improved, rdotr, best)
+            x_best = torch.where(improved, x, x_best)
+            since_best = torch.where(improved, 0, since_best + 1)
+        self.num_steps = step
+        self.x = x_out
+        self.info = {
+            "iterations": iterations.cpu(),
+            "residuals": residuals.cpu(),
+            "converged": converged.cpu(),
+            "restarts": restarts.cpu(),
+        }
+        if not converged.all():
+            print("Convergence has failed :(")
+        return x_out, bool(converged.all())
+
+    def residual_history(self):
+        """
+        Relative residuals of the last history_size iterations of the active set
+        solver in chronological order, NaN for columns that had finished.
+        """
+        size = min(self.num_steps, self.history_size)
+        slots = torch.arange(self.num_steps - size, self.num_steps)
+        return self.history[slots % self.history_size].cpu()
+
 
 class BiCGSTAB_batch2:
     def __init__(self, Ax_gen, device="cuda"):
@@ -290,3 +531,414 @@ class BiCGSTAB_batch2:
             self.nsteps -= 1
         print("Convergence has failed :(")
         return self.x
+
+
+class GMRES_batch:
+    """
+    Restarted GMRES(m) for a batch of systems, with the b layout and Ax_gen
+    callback of BiCGSTAB_batch. precond is an optional right preconditioner
+    with the same signature as Ax_gen (or a left one with precond_side="left");
+    flexible=True gives FGMRES, which allows the preconditioner to change from
+    one iteration to the next.
+
+    Example:
+
+    solver = GMRES_batch(Ax_gen, restart=30)
+    x, convergence = solver.solve(b, tol=1e-10, nsteps=500)
+
+    """
+
+    def __init__(
+        self,
+        Ax_gen,
+        device="cuda",
+        restart=30,
+        precond=None,
+        flexible=False,
+        precond_side="right",
+    ):
+        self.Ax_gen = Ax_gen
+        self.device = device
+        self.restart = restart
+        self.precond = precond
+        self.flexible = flexible
+        self.precond_side = precond_side
+        self.log_rerr = []
+
+    def batch_vdot(self, x, y):
+        return torch.linalg.vecdot(x, y, dim=0).real
+
+    def givens(self, a, b):
+        # complex rotation [c s; -conj(s) c] that zeroes b below a
+        abs_a = a.abs()
+        d = torch.sqrt(abs_a**2 + b.abs() ** 2)
+        phase = torch.where(abs_a > 0, a / abs_a.clamp(min=1e-30), 1)
+        c = torch.where(d > 0, abs_a / d.clamp(min=1e-30), 1)
+        s = torch.where(d > 0, phase * b.conj() / d.clamp(min=1e-30), 0)
+        return c.to(a.dtype), s, phase * d
+
+    def converged(self, rdotr):
+        return (rdotr < self.residual_tol) | (rdotr < self.atol)
+
+    def init_params(self, b, x, nsteps, tol, atol):
+        self.b = b.clone().detach()
+        self.x = torch.zeros_like(b) if x is None else x.clone()
+        self.residual_tol = tol * self.batch_vdot(self.b, self.b)[0]
+        self.atol = torch.tensor(atol, device=b.device)
+        self.nsteps = b.shape[0] if nsteps is None else nsteps
+        self.iterations = torch.zeros(b.shape[2], dtype=torch.long, device=b.device)
+        self.cycles = 0
+
+    def check(self, rdotr):
+        """
+        Mark the columns of the true residual rdotr that still need steps and
+        store the per-column info like BiCGSTAB_batch.info. Returns whether
+        all columns converged.
+        """
+        self.active = ~self.converged(rdotr)
+        bdotb = self.batch_vdot(self.b, self.b)[0]
+        restarts = max(self.cycles - 1, 0)
+        self.info = {
+            "iterations": self.iterations.cpu(),
+            "residuals": (rdotr / bdotb).sqrt().cpu(),
+            "converged": (~self.active).cpu(),
+            "restarts": torch.full_like(self.iterations, restarts).cpu(),
+        }
+        return not self.active.any()
+
+    def arnoldi(self, r, beta):
+        """
+        Run up to restart Arnoldi steps from r with norm beta and return the
+        update of x, stopping early once the estimated residual of all
+        columns is below the tolerance.
+        """
+        n, _, batch_size = r.shape
+        m = self.restart
+        V = torch.zeros(m + 1, n, batch_size, dtype=r.dtype, device=r.device)
+        Z = torch.zeros_like(V[:m]) if self.flexible else None
+        H = torch.zeros(m + 1, m, batch_size, dtype=r.dtype, device=r.device)
+        cs = torch.zeros(m, batch_size, dtype=r.dtype, device=r.device)
+        sn = torch.zeros(m, batch_size, dtype=r.dtype, device=r.device)
+        g = torch.zeros(m + 1, batch_size, dtype=r.dtype, device=r.device)
+        g[0] = beta
+        V[0] = r[:, 0] / torch.where(beta > 0, beta, 1)
+        k = 0
+        while k < m and self.nsteps > 0:
+            v = V[k].unsqueeze(1)
+            if self.precond is not None:
+                v = self.precond(v)
+            if self.flexible:
+                Z[k] = v[:, 0]
+            w = self.Ax_gen(v)[:, 0]
+            # classical Gram-Schmidt, applied twice for orthogonality
+            for _ in range(2):
+                h = torch.einsum("jnb,nb->jb", V[: k + 1].conj(), w)
+                w = w - torch.einsum("jnb,jb->nb", V[: k + 1], h)
+                H[: k + 1, k] += h
+            h_next = torch.linalg.vector_norm(w, dim=0)
+            H[k + 1, k] = h_next
+            V[k + 1] = w / torch.where(h_next > 0, h_next, 1)
+            for i in range(k):
+                a, b = H[i, k].clone(), H[i + 1, k].clone()
+                H[i, k] = cs[i] * a + sn[i] * b
+                H[i + 1, k] = -sn[i].conj() * a + cs[i] * b
+            cs[k], sn[k], H[k, k] = self.givens(H[k, k], H[k + 1, k])
+            H[k + 1, k] = 0
+            g[k + 1] = -sn[k].conj() * g[k]
+            g[k] = cs[k] * g[k]
+            k += 1
+            self.nsteps -= 1
+            self.iterations += self.active
+            rdotr = g[k].abs() ** 2
+            self.log_rerr.append(rdotr.mean().item())
+            self.active &= ~self.converged(rdotr)
+            if not self.active.any():
+                break
+        R = H[:k, :k].permute(2, 0, 1)
+        diag = torch.diagonal(R, dim1=1, dim2=2)
+        R = R + torch.diag_embed((diag == 0).to(R.dtype))
+        y = torch.linalg.solve_triangular(R, g[:k].T.unsqueeze(-1), upper=True)
+        basis = Z[:k] if self.flexible else V[:k]
+        dx = torch.einsum("jnb,bj->nb", basis, y[..., 0]).unsqueeze(1)
+        if self.precond is not None and not self.flexible:
+            dx = self.precond(dx)
+        return dx
+
+    def solve(self, b, x=None, nsteps=None, tol=1e-10, atol=1e-16):
+        """
+        Method to find the solution.
+
+        Returns the final answer of x and whether all columns converged,
+        the per-column iterations, residuals and convergence flags are kept
+        in info like for BiCGSTAB_batch.
+
+        """
+        if self.precond is not None and self.precond_side == "left":
+            Ax_gen, precond = self.Ax_gen, self.precond
+            self.Ax_gen, b, x, _ = precondition(Ax_gen, precond, "left", b, x)
+            self.precond = None
+            try:
+                return self.solve(b, x, nsteps, tol, atol)
+            finally:
+                self.Ax_gen, self.precond = Ax_gen, precond
+        # b: The R.H.S of the system. of shape (n, 1, batch_size)
+        self.init_params(b, x, nsteps, tol, atol)
+        while True:
+            r = self.b - self.Ax_gen(self.x)
+            rdotr = self.batch_vdot(r, r)[0]
+            if self.check(rdotr):
+                return self.x, True
+            if self.nsteps <= 0:
+                break
+            self.cycles += 1
+            self.x = self.x + self.arnoldi(r, rdotr.sqrt())
+        print("Convergence has failed :(")
+        return self.x, False
+
+
+class GCRODR_batch(GMRES_batch):
+    """
+    GCRO-DR(m, k) for a batch of systems: restarted GMRES that deflates a
+    recycled subspace U of k vectors per column, with A U = C and C
+    orthonormal. U is refined from harmonic Ritz vectors after every cycle and
+    can be handed to the next system of a sequence, e.g. the next wavenumbers
+    of a sweep, with solve(..., U=solver.U).
+    """
+
+    def __init__(
+        self,
+        Ax_gen,
+        device="cuda",
+        restart=30,
+        recycle=5,
+        precond=None,
+        precond_side="right",
+    ):
+        super().__init__(Ax_gen, device, restart, precond, False, precond_side)
+        self.recycle = recycle
+        self.U = None
+        self.C = None
+
+    def apply(self, X):
+        # A applied to the vectors X of shape (j, n, batch_size)
+        return torch.stack(
+            [self.Ax_gen(X[i].unsqueeze(1))[:, 0] for i in range(len(X))]
+        )
+
+    def orthonormalize(self, U, C):
+        """
+        Return U and C rotated by the SVD C = W S Vh per column, U Vh^H S^-1
+        and W, so that A U = C still holds and C is orthonormal. Only the
+        directions above 1e-6 of the largest singular value in every column
+        are kept, dependent ones are dropped. Returns None, None if no
+        direction is left.
+        """
+        W, S, Vh = torch.linalg.svd(C.permute(2, 1, 0), full_matrices=False)
+        keep = int((S > 1e-6 * S[:, :1]).sum(-1).min())
+        if keep == 0:
+            return None, None
+        T = Vh.mH[..., :keep] / S[:, None, :keep].to(Vh.dtype)
+        U = U.permute(2, 1, 0) @ T
+        return U.permute(2, 1, 0), W[..., :keep].permute(2, 1, 0)
+
+    def update_recycle(self, U, C, V, H, Bm):
+        """
+        Keep the k harmonic Ritz vectors of smallest magnitude of the
+        augmented Arnoldi relation A [U V_s] = [C V_s+1] G as the new U.
+        """
+        s = H.shape[1]
+        if U is None:
+            W_in, W_out, G = V[:s], V, H.permute(2, 0, 1)
+        else:
+            k = len(U)
+            d = 1 / torch.linalg.vector_norm(U, dim=1).clamp(min=1e-30)
+            W_in = torch.cat([U * d.unsqueeze(1), V[:s]])
+            W_out = torch.cat([C, V])
+            G = torch.zeros(
+                U.shape[2], k + s + 1, k + s, dtype=V.dtype, device=V.device
+            )
+            G[:, :k, :k] = torch.diag_embed(d.T.to(V.dtype))
+            G[:, :k, k:] = Bm.permute(2, 0, 1)
+            G[:, k:, k:] = H.permute(2, 0, 1)
+        M1 = G.mH @ G
+        M2 = G.mH @ torch.einsum("inb,jnb->bij", W_out.conj(), W_in)
+        theta, Z = torch.linalg.eig(torch.linalg.pinv(M2) @ M1)
+        order = theta.abs().argsort(-1)[:, : min(self.recycle, G.shape[2])]
+        P = Z.gather(2, order.unsqueeze(1).expand(-1, Z.shape[1], -1)).to(V.dtype)
+        # A W_in P = W_out G P
+        C = torch.einsum("jnb,bjl->lnb", W_out, G @ P)
+        U = torch.einsum("jnb,bjl->lnb", W_in, P)
+        self.U, self.C = self.orthonormalize(U, C)
+
+    def cycle(self, r, beta, U, C):
+        """
+        One deflated GMRES cycle of restart - k steps from r, returns the
+        update of x and refreshes the recycled subspace.
+        """
+        n, _, batch_size = r.shape
+        k = 0 if U is None else len(U)
+        m = max(self.restart - k, 1)
+        kw = dict(dtype=r.dtype, device=r.device)
+        V = torch.zeros(m + 1, n, batch_size, **kw)
+        H = torch.zeros(m + 1, m, batch_size, **kw)
+        H_raw = torch.zeros(m + 1, m, batch_size, **kw)
+        Bm = torch.zeros(k, m, batch_size, **kw)
+        cs = torch.zeros(m, batch_size, **kw)
+        sn = torch.zeros(m, batch_size, **kw)
+        g = torch.zeros(m + 1, batch_size, **kw)
+        g[0] = beta
+        V[0] = r[:, 0] / torch.where(beta > 0, beta, 1)
+        j = 0
+        while j < m and self.nsteps > 0:
+            w = self.Ax_gen(V[j].unsqueeze(1))[:, 0]
+            # (I - C C^H) A, then classical Gram-Schmidt, both applied twice
+            for _ in range(2):
+                if k:
+                    c = torch.einsum("inb,nb->ib", C.conj(), w)
+                    w = w - torch.einsum("inb,ib->nb", C, c)
+                    Bm[:, j] += c
+                h = torch.einsum("inb,nb->ib", V[: j + 1].conj(), w)
+                w = w - torch.einsum("inb,ib->nb", V[: j + 1], h)
+                H[: j + 1, j] += h
+            h_next = torch.linalg.vector_norm(w, dim=0)
+            H[j + 1, j] = h_next
+            V[j + 1] = w / torch.where(h_next > 0, h_next, 1)
+            H_raw[:, j] = H[:, j]
+            for i in range(j):
+                a, b = H[i, j].clone(), H[i + 1, j].clone()
+                H[i, j] = cs[i] * a + sn[i] * b
+                H[i + 1, j] = -sn[i].conj() * a + cs[i] * b
+            cs[j], sn[j], H[j, j] = self.givens(H[j, j], H[j + 1, j])
+            H[j + 1, j] = 0
+            g[j + 1] = -sn[j].conj() * g[j]
+            g[j] = cs[j] * g[j]
+            j += 1
+            self.nsteps -= 1
+            self.iterations += self.active
+            rdotr = g[j].abs() ** 2
+            self.log_rerr.append(rdotr.mean().item())
+            self.active &= ~self.converged(rdotr)
+            if not self.active.any():
+                break
+        R = H[:j, :j].permute(2, 0, 1)
+        diag = torch.diagonal(R, dim1=1, dim2=2)
+        R = R + torch.diag_embed((diag == 0).to(R.dtype))
+        y = torch.linalg.solve_triangular(R, g[:j].T.unsqueeze(-1), upper=True)[..., 0]
+        dx = torch.einsum("inb,bi->nb", V[:j], y)
+        if k:
+            # the C components are solved exactly by y_U = -B y
+            dx = dx - torch.einsum("inb,ilb,bl->nb", U, Bm[:, :j], y)
+        self.update_recycle(U, C, V[: j + 1], H_raw[: j + 1, :j], Bm[:, :j])
+        return dx.unsqueeze(1)
+
+    def solve(self, b, x=None, nsteps=None, tol=1e-10, atol=1e-16, U=None):
+        """
+        Method to find the solution, optionally recycling the subspace U of
+        shape (k, n, batch_size) from a previous system.
+
+        Returns the final answer of x and whether all columns converged,
+        the per-column iterations, residuals and convergence flags are kept
+        in info like for BiCGSTAB_batch.
+
+        """
+        if self.precond is not None:
+            Ax_gen, precond = self.Ax_gen, self.precond
+            self.Ax_gen, b, x, recover = precondition(
+                Ax_gen, precond, self.precond_side, b, x
+            )
+            self.precond = None
+            try:
+                x, convergence = self.solve(b, x, nsteps, tol, atol, U)
+            finally:
+                self.Ax_gen, self.precond = Ax_gen, precond
+            self.x = recover(x)
+            return self.x, convergence
+        self.init_params(b, x, nsteps, tol, atol)
+        C = None
+        if U is not None:
+            self.nsteps -= len(U)
+            U, C = self.orthonormalize(U, self.apply(U))
+        self.U, self.C = U, C
+        while True:
+            r = self.b - self.Ax_gen(self.x)
+            if self.C is not None:
+                # minimal residual correction in the recycled subspace
+                c = torch.einsum("inb,nb->ib", self.C.conj(), r[:, 0])
+                self.x = self.x + torch.einsum("inb,ib->nb", self.U, c).unsqueeze(1)
+                r = r - torch.einsum("inb,ib->nb", self.C, c).unsqueeze(1)
+            rdotr = self.batch_vdot(r, r)[0]
+            if self.check(rdotr):
+                return self.x, True
+            if self.nsteps <= 0:
+                break
+            self.cycles += 1
+            self.x = self.x + self.cycle(r, rdotr.sqrt(), self.U, self.C)
+        print("Convergence has failed :(")
+        return self.x, False
+
+
+def warm_start(Ax_gen, b, x_prev, *columns):
+    """
+    Initial guess a * x_prev with the per-column a that minimizes the residual
+    norm, so it is never worse than starting from zero.
+    """
+    Ax = Ax_gen(x_prev, *columns)
+    a = torch.linalg.vecdot(Ax, b, dim=0) / torch.linalg.vecdot(Ax, Ax, dim=0)
+    return torch.nan_to_num(a.unsqueeze(0)) * x_prev
+
+
+class RecycleSpace:
+    """
+    Solutions and recycled GCRO-DR subspaces of the wavenumbers solved so far
+    on one set of samples, used to seed the solves of the next wavenumbers.
+    Every new wavenumber takes the data of the nearest stored one.
+    """
+
+    def __init__(self, max_modes=64):
+        self.max_modes = max_modes
+        self.clear()
+
+    def clear(self):
+        self.ks, self.x, self.U = [], [], []
+
+    def __len__(self):
+        return len(self.ks)
+
+    def nearest(self, ks, n):
+        if len(self) == 0 or len(self.x[0]) != n:
+            self.clear()
+            return None
+        stored = torch.tensor(self.ks)
+        return [int((stored - float(k)).abs().argmin()) for k in ks]
+
+    def initial_guess(self, ks, n):
+        # (n, 1, batch_size) solutions of the nearest wavenumbers
+        idx = self.nearest(ks, n)
+        if idx is None:
+            return None
+        return torch.stack([self.x[i] for i in idx], -1).unsqueeze(1)
+
+    def basis(self, ks, n):
+        # (k + 1, n, batch_size) recycled subspaces plus the solutions
+        idx = self.nearest(ks, n)
+        if idx is None:
+            return None
+        x = torch.stack([self.x[i] for i in idx], -1)
+        x = x / torch.linalg.vector_norm(x, dim=0).clamp(min=1e-30)
+        if any(self.U[i] is None for i in idx):
+            return x.unsqueeze(0)
+        k = min(len(self.U[i]) for i in idx)
+        U = torch.stack([self.U[i][:k] for i in idx], -1)
+        return torch.cat([U, x.unsqueeze(0)])
+
+    def update(self, ks, x, U=None):
+        """
+        Store x of shape (n, 1, batch_size) and U of shape (k, n, batch_size).
+        """
+        for i, k in enumerate(ks):
+            self.ks.append(float(k))
+            self.x.append(x[:, 0, i].detach().clone())
+            self.U.append(None if U is None else U[..., i].detach().clone())
+        del self.ks[: -self.max_modes]
+        del self.x[: -self.max_modes]
+        del self.U[: -self.max_modes]
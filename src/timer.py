@@ -9,7 +9,8 @@ class Timer:
         self.record_time = 0
 
     def get_time(self):
-        torch.cuda.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
         cost_time = time.time() - self.start_time
         self.start_time = time.time()
         return cost_time
@@ -0,0 +1,371 @@
+import numpy as np
+import torch
+from numba import njit, prange
+from .cpu_imp import green_func_ks, uniform_step, length, self_term
+
+# Barycentric Lagrange treecode for the Monte Carlo weight sums. Each source
+# cluster of a kd-tree carries proxy charges at (p + 1)^3 Chebyshev points, the
+# degree p set by the tolerance plus about k * radius for the oscillation of
+# the kernel over the cluster. A target stops descending at every cluster that
+# is well separated (radius < theta * distance) and sums it through the
+# proxies, or through its samples directly when those are fewer, so each
+# target visits O(log N) clusters and a matvec costs O(N log N) instead of
+# O(N * M). Clusters too large to resolve the wavelength with max_degree are
+# never far and are always opened.
+
+
+def chebyshev_points(p):
+    i = np.arange(p + 1)
+    s = np.cos(np.pi * i / p)
+    w = (-1.0) ** i
+    w[0] *= 0.5
+    w[-1] *= 0.5
+    return s, w
+
+
+def treecode_degree(tol, theta, deriv=False):
+    # the relative matvec error measured on spheres at k * radius <= 3 is
+    # about (theta / 4)^(p + 2), the double layer kernel needs one degree more
+    # for the same accuracy
+    p = np.ceil(np.log(tol) / np.log(theta / 4)) - 2 + int(deriv)
+    return int(np.clip(p, 2, 10))
+
+
+def cluster_degrees(tree, k_max, tol, theta, deriv=False, max_degree=12):
+    """
+    Interpolation degree of every cluster, -1 for clusters that cannot be
+    interpolated within max_degree at the wavenumber k_max.
+    """
+    degree = treecode_degree(tol, theta, deriv) + np.ceil(k_max * tree.radius)
+    return np.where(degree <= max_degree, degree, -1).astype(np.int64)
+
+
+class ClusterTree:
+    """
+    kd-tree over a point set with contiguous clusters in the permuted order.
+    """
+
+    def __init__(self, points, leaf_size=64):
+        points = np.asarray(points, dtype=np.float64)
+        self.points = points
+        perm = np.arange(len(points))
+        starts, ends, lefts, rights, los, his = [], [], [], [], [], []
+        stack = [(0, len(points), -1, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(starts)
+            if parent >= 0:
+                (lefts if side == 0 else rights)[parent] = node
+            idx = perm[start:end]
+            lo, hi = points[idx].min(0), points[idx].max(0)
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            los.append(lo)
+            his.append(hi)
+            if end - start > leaf_size:
+                axis = np.argmax(hi - lo)
+                order = np.argsort(points[idx, axis], kind="stable")
+                perm[start:end] = idx[order]
+                mid = (start + end) // 2
+                stack.append((mid, end, node, 1))
+                stack.append((start, mid, node, 0))
+        self.perm = perm
+        self.start = np.array(starts, dtype=np.int64)
+        self.end = np.array(ends, dtype=np.int64)
+        self.left = np.array(lefts, dtype=np.int64)
+        self.right = np.array(rights, dtype=np.int64)
+        self.lo = np.array(los)
+        self.hi = np.array(his)
+        self.center = (self.lo + self.hi) / 2
+        self.radius = np.linalg.norm(self.hi - self.lo, axis=1) / 2
+
+    def __len__(self):
+        return len(self.start)
+
+    def proxy_points(self, nodes, degrees):
+        """
+        Chebyshev grids of the given degrees on the bounding boxes of nodes,
+        concatenated, and the offset of every node's grid.
+        """
+        sizes = (degrees + 1) ** 3
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        points = np.empty((offsets[-1], 3))
+        for node, p, o in zip(nodes, degrees, offsets):
+            s, _ = chebyshev_points(p)
+            grid = np.stack(np.meshgrid(s, s, s, indexing="ij"), -1).reshape(-1, 3)
+            half = (self.hi[node] - self.lo[node]) / 2
+            points[o : o + len(grid)] = self.center[node] + grid * half
+        return points, offsets
+
+
+@njit()
+def _lagrange_1d(t, lo, hi, s, w, out):
+    half = (hi - lo) / 2
+    if half <= 0:
+        out[:] = 0
+        out[0] = 1
+        return
+    u = (t - (lo + hi) / 2) / half
+    total = 0.0
+    for a in range(len(s)):
+        if abs(u - s[a]) < 1e-14:
+            out[:] = 0
+            out[a] = 1
+            return
+        out[a] = w[a] / (u - s[a])
+        total += out[a]
+    for a in range(len(s)):
+        out[a] /= total
+
+
+@njit(parallel=True)
+def _upward(
+    src_points,
+    src_normals,
+    charges,
+    nodes,
+    degrees,
+    offsets,
+    start,
+    end,
+    lo,
+    hi,
+    S,
+    W,
+    deriv,
+    q,
+):
+    # q: (proxies, D, B, C) with D = 3 normal components for the deriv kernel,
+    # the proxies of nodes[i] start at offsets[i]
+    for i in prange(len(nodes)):
+        node = nodes[i]
+        n = degrees[i] + 1
+        s = S[n - 1, :n]
+        w = W[n - 1, :n]
+        lx = np.empty(n)
+        ly = np.empty(n)
+        lz = np.empty(n)
+        for j in range(start[node], end[node]):
+            y = src_points[j]
+            _lagrange_1d(y[0], lo[node, 0], hi[node, 0], s, w, lx)
+            _lagrange_1d(y[1], lo[node, 1], hi[node, 1], s, w, ly)
+            _lagrange_1d(y[2], lo[node, 2], hi[node, 2], s, w, lz)
+            for a in range(n):
+                for b in range(n):
+                    lab = lx[a] * ly[b]
+                    for c in range(n):
+                        L = lab * lz[c]
+                        P = offsets[i] + (a * n + b) * n + c
+                        for d in range(q.shape[1]):
+                            Ld = L * src_normals[j, d] if deriv else L
+                            for k_i in range(charges.shape[1]):
+                                for e in range(charges.shape[2]):
+                                    q[P, d, k_i, e] += Ld * charges[j, k_i, e]
+
+
+@njit(parallel=True)
+def _evaluate(
+    trgs,
+    trg_ids,
+    src_points,
+    src_normals,
+    src_ids,
+    src_weights,
+    src_radius,
+    x,
+    ks,
+    dk,
+    deriv,
+    boundary,
+    start,
+    end,
+    left,
+    right,
+    center,
+    radius,
+    degree,
+    proxy,
+    offsets,
+    proxies,
+    q,
+    theta,
+    out,
+    counts,
+):
+    # counts: (Ntrg, 2) proxy and sample kernel evaluations of every target
+    B, C = x.shape[0], x.shape[2]
+    for i in prange(len(trgs)):
+        trg = trgs[i]
+        acc = np.zeros((B, C), np.complex128)
+        g_ks = np.empty(B, np.complex128)
+        stack = np.empty(128, np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            dist = length(trg, center[node])
+            far = degree[node] >= 0 and radius[node] < theta * dist
+            if far and proxy[node] >= 0:
+                lo, hi = offsets[proxy[node]], offsets[proxy[node] + 1]
+                counts[i, 0] += hi - lo
+                for p in range(lo, hi):
+                    y = proxies[p]
+                    r = length(trg, y)
+                    for k_i in range(B):
+                        ikr = 1j * ks[k_i] * r
+                        if deriv:
+                            g = -np.exp(ikr) / (4 * np.pi * r * r * r) * (1 - ikr)
+                            for d in range(3):
+                                gd = g * (y[d] - trg[d])
+                                for c in range(C):
+                                    acc[k_i, c] += gd * q[p, d, k_i, c]
+                        else:
+                            g = np.exp(ikr) / (4 * np.pi * r)
+                            for c in range(C):
+                                acc[k_i, c] += g * q[p, 0, k_i, c]
+            elif far or left[node] == -1:
+                # leaves, and far clusters with fewer samples than proxies
+                counts[i, 1] += end[node] - start[node]
+                for j in range(start[node], end[node]):
+                    if boundary and src_ids[j] == trg_ids[i]:
+                        for k_i in range(B):
+                            g = self_term(ks[k_i], src_radius[j], deriv)
+                            for c in range(C):
+                                acc[k_i, c] += g * x[k_i, j, c]
+                        continue
+                    green_func_ks(
+                        trg, src_points[j], src_normals[j], ks, dk, deriv, g_ks
+                    )
+                    for k_i in range(B):
+                        for c in range(C):
+                            acc[k_i, c] += g_ks[k_i] * src_weights[j] * x[k_i, j, c]
+            else:
+                stack[top] = left[node]
+                stack[top + 1] = right[node]
+                top += 2
+        for k_i in range(B):
+            for c in range(C):
+                out[k_i, i, c] = acc[k_i, c]
+
+
+class TreecodeOperator:
+    """
+    Treecode approximation of the Monte Carlo weight matrix (batch, Ntrg, M).
+    The tree over the source samples is built once and reused by every matvec.
+    After a matvec, evaluations holds its number of proxy ("far") and sample
+    ("near") kernel evaluations.
+    """
+
+    def __init__(
+        self,
+        trg_points,
+        sampler,
+        ks,
+        deriv=False,
+        boundary=False,
+        tol=1e-4,
+        theta=0.5,
+        leaf_size=64,
+        max_degree=12,
+    ):
+        self.device = sampler.points.device
+        self.trg_points = trg_points.detach().cpu().double().numpy()
+        self.ks = np.asarray(torch.as_tensor(ks).cpu(), dtype=np.float64).reshape(-1)
+        self.deriv = deriv
+        self.boundary = boundary
+        self.theta = theta
+        self.tree = ClusterTree(sampler.points.detach().cpu().numpy(), leaf_size)
+        tree = self.tree
+        self.degree = cluster_degrees(
+            tree, self.ks.max(), tol, theta, deriv, max_degree
+        )
+        # proxies only pay off for clusters with more samples than proxies
+        size = tree.end - tree.start
+        self.proxy_nodes = np.nonzero(
+            (self.degree >= 0) & ((self.degree + 1) ** 3 < size)
+        )[0]
+        self.proxy = np.full(len(tree), -1, dtype=np.int64)
+        self.proxy[self.proxy_nodes] = np.arange(len(self.proxy_nodes))
+        self.proxies, self.offsets = tree.proxy_points(
+            self.proxy_nodes, self.degree[self.proxy_nodes]
+        )
+        # Chebyshev points and weights of degree p in row p
+        self.S = np.zeros((max_degree + 1, max_degree + 1))
+        self.W = np.zeros((max_degree + 1, max_degree + 1))
+        for p in range(1, max_degree + 1):
+            self.S[p, : p + 1], self.W[p, : p + 1] = chebyshev_points(p)
+        perm = tree.perm
+        self.perm = torch.from_numpy(perm).to(self.device)
+        self.src_points = tree.points[perm]
+        self.src_normals = sampler.points_normals.detach().cpu().double().numpy()[perm]
+        importance = sampler.points_importance.detach().cpu().double().numpy()[perm]
+        cdf_sum = float(sampler.cdf[-1])
+        M = len(perm)
+        self.src_weights = cdf_sum / importance / M * (2 if boundary else 1)
+        self.src_radius = np.sqrt(cdf_sum / (np.pi * importance * M))
+        self.shape = (len(self.ks), len(self.trg_points), M)
+        self.evaluations = None
+
+    def matvec(self, x, modes=None):
+        ks = self.ks if modes is None else self.ks[torch.as_tensor(modes).cpu().numpy()]
+        xp = x[:, self.perm].detach().cpu().numpy().astype(np.complex128)
+        B, M, C = xp.shape
+        charges = xp * self.src_weights.reshape(1, -1, 1)
+        charges = np.ascontiguousarray(charges.transpose(1, 0, 2))
+        tree = self.tree
+        q = np.zeros(
+            (len(self.proxies), 3 if self.deriv else 1, B, C),
+            np.complex128,
+        )
+        _upward(
+            self.src_points,
+            self.src_normals,
+            charges,
+            self.proxy_nodes,
+            self.degree[self.proxy_nodes],
+            self.offsets,
+            tree.start,
+            tree.end,
+            tree.lo,
+            tree.hi,
+            self.S,
+            self.W,
+            self.deriv,
+            q,
+        )
+        out = np.empty((B, len(self.trg_points), C), np.complex128)
+        counts = np.zeros((len(self.trg_points), 2), np.int64)
+        _evaluate(
+            self.trg_points,
+            np.arange(len(self.trg_points)),
+            self.src_points,
+            self.src_normals,
+            tree.perm,
+            self.src_weights,
+            self.src_radius,
+            xp,
+            ks,
+            uniform_step(ks),
+            self.deriv,
+            self.boundary,
+            tree.start,
+            tree.end,
+            tree.left,
+            tree.right,
+            tree.center,
+            tree.radius,
+            self.degree,
+            self.proxy,
+            self.offsets,
+            self.proxies,
+            q,
+            self.theta,
+            out,
+            counts,
+        )
+        far, near = counts.sum(0)
+        self.evaluations = {"far": int(far), "near": int(near)}
+        return torch.from_numpy(out.astype(np.complex64)).to(self.device)